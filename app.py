@@ -7,13 +7,17 @@
 """
 
 import streamlit as st
-import numpy as np
-import cv2
-from PIL import Image, ImageDraw
-from io import BytesIO
-from collections import Counter
+from PIL import ImageDraw
 from streamlit_image_coordinates import streamlit_image_coordinates
 
+from pindou import LOW_CONFIDENCE, MAX_GRID, TRANSFORMS
+from pindou.encoding import OUTPUT_FORMATS
+from pindou.st_cache import (
+    cached_detect_grid, cached_detect_region, cached_preview, download_button, full_image,
+    load_upload, lookup_profile, process_with_progress, remember_profile, show_timings,
+)
+from pindou.timing import StageTimer
+
 st.set_page_config(
     page_title="拼豆图纸镜像工具 💕",
     page_icon="🎨",
@@ -86,101 +90,6 @@ st.markdown('<h1 class="main-title">🎨 拼豆图纸镜像工具</h1>', unsafe_
 st.markdown('<p class="subtitle">点击图片设置区域 → 一键镜像 ✨</p>', unsafe_allow_html=True)
 
 
-def remove_watermark_from_cell(cell_array):
-    """去除水印"""
-    h, w = cell_array.shape[:2]
-    result = cell_array.copy()
-    
-    pixels = cell_array.reshape(-1, 3)
-    
-    bg_candidates = []
-    for pixel in pixels:
-        r, g, b = int(pixel[0]), int(pixel[1]), int(pixel[2])
-        brightness = (r + g + b) / 3
-        
-        if brightness < 60:
-            continue
-        
-        diff = max(abs(r - g), abs(g - b), abs(r - b))
-        if diff < 15 and 100 < brightness < 200:
-            continue
-        
-        bg_candidates.append((r, g, b))
-    
-    if not bg_candidates:
-        return result
-    
-    color_counts = Counter([(c[0]//8*8, c[1]//8*8, c[2]//8*8) for c in bg_candidates])
-    if not color_counts:
-        return result
-    
-    dominant_quantized = color_counts.most_common(1)[0][0]
-    
-    bg_color = None
-    best_dist = float('inf')
-    for c in bg_candidates:
-        dist = sum((a - b) ** 2 for a, b in zip(c, dominant_quantized))
-        if dist < best_dist:
-            best_dist = dist
-            bg_color = c
-    
-    if bg_color is None:
-        bg_color = (255, 255, 255)
-    
-    for y in range(h):
-        for x in range(w):
-            r, g, b = int(result[y, x, 0]), int(result[y, x, 1]), int(result[y, x, 2])
-            brightness = (r + g + b) / 3
-            diff = max(abs(r - g), abs(g - b), abs(r - b))
-            
-            if diff < 20 and 90 < brightness < 210:
-                result[y, x] = bg_color
-    
-    return result
-
-
-def process_image(image, x1, y1, x2, y2, cols, rows, remove_watermark):
-    """处理图片"""
-    img_array = np.array(image)
-    new_img_array = img_array.copy()
-    
-    grid_width = x2 - x1
-    grid_height = y2 - y1
-    cell_width = grid_width / cols
-    cell_height = grid_height / rows
-    
-    for row in range(rows):
-        for col in range(cols):
-            src_left = int(x1 + col * cell_width)
-            src_right = int(x1 + (col + 1) * cell_width)
-            src_top = int(y1 + row * cell_height)
-            src_bottom = int(y1 + (row + 1) * cell_height)
-            
-            dst_col = cols - 1 - col
-            dst_left = int(x1 + dst_col * cell_width)
-            dst_right = int(x1 + (dst_col + 1) * cell_width)
-            dst_top = src_top
-            dst_bottom = src_bottom
-            
-            cell = img_array[src_top:src_bottom, src_left:src_right].copy()
-            
-            if cell.size == 0:
-                continue
-            
-            if remove_watermark:
-                cell = remove_watermark_from_cell(cell)
-            
-            target_h = dst_bottom - dst_top
-            target_w = dst_right - dst_left
-            
-            if cell.shape[0] != target_h or cell.shape[1] != target_w:
-                cell = cv2.resize(cell, (target_w, target_h), interpolation=cv2.INTER_NEAREST)
-            
-            new_img_array[dst_top:dst_bottom, dst_left:dst_right] = cell
-    
-    return Image.fromarray(new_img_array)
-
-
 def draw_selection(image, x1, y1, x2, y2):
     """绘制选区"""
     img_copy = image.copy()
@@ -231,22 +140,44 @@ if 'last_click' not in st.session_state:
 uploaded_file = st.file_uploader("📁 上传拼豆图纸", type=['png', 'jpg', 'jpeg', 'bmp', 'webp'])
 
 if uploaded_file is not None:
-    image = Image.open(uploaded_file).convert('RGB')
-    width, height = image.size
-    
-    # 设置默认值
+    # JPEG 只缩小解码出显示用的图片 (view)，原图在检测格子数和处理时才解码
+    upload = load_upload(uploaded_file)
+    image_key, view, factor = upload.key, upload.view, upload.factor
+    width, height = upload.size
+    
+    # 以前确认过同样布局的图纸时套用保存的区域和格子数，否则自动检测格子区域作为默认值
+    profile = lookup_profile(upload.size, uploaded_file)
+    if profile is not None:
+        detected_region, region_confidence = profile[0], 1.0
+    else:
+        detected_region, region_confidence = cached_detect_region(image_key, view, factor, upload.size)
     if st.session_state.x1 is None:
-        st.session_state.x1 = int(width * 0.025)
-        st.session_state.y1 = int(height * 0.035)
-        st.session_state.x2 = int(width * 0.975)
-        st.session_state.y2 = int(height * 0.83)
+        (st.session_state.x1, st.session_state.y1,
+         st.session_state.x2, st.session_state.y2) = detected_region
     
     # ===== 参数设置 =====
     with st.expander("⚙️ 格子设置", expanded=True):
         col1, col2, col3 = st.columns(3)
         with col1:
-            preset = st.selectbox("预设", ["52×47", "20×20", "29×29", "50×50", "100×100"])
-            if preset == "20×20":
+            presets = ["52×47", "20×20", "29×29", "50×50", "100×100", "自动检测", "自动检测 (霍夫直线)"]
+            if profile is not None:
+                presets.insert(0, "保存的布局")
+            preset = st.selectbox("预设", presets)
+            if preset == "保存的布局":
+                default_cols, default_rows = profile[1]
+            elif preset.startswith("自动检测"):
+                detect_region = (min(st.session_state.x1, st.session_state.x2),
+                                 min(st.session_state.y1, st.session_state.y2),
+                                 max(st.session_state.x1, st.session_state.x2),
+                                 max(st.session_state.y1, st.session_state.y2))
+                method = 'hough' if preset == "自动检测 (霍夫直线)" else 'periodic'
+                detected = cached_detect_grid(image_key, detect_region, full_image(uploaded_file), method)
+                if detected is None:
+                    st.warning("无法自动检测，请手动设置")
+                    default_cols, default_rows = 52, 47
+                else:
+                    default_cols, default_rows = detected
+            elif preset == "20×20":
                 default_cols, default_rows = 20, 20
             elif preset == "29×29":
                 default_cols, default_rows = 29, 29
@@ -259,11 +190,20 @@ if uploaded_file is not None:
             else:
                 default_cols, default_rows = 52, 47
         with col2:
-            cols = st.number_input("列", 1, 200, default_cols)
-            rows = st.number_input("行", 1, 200, default_rows)
+            # 默认值超出范围时 number_input 会报错，保存的布局可能来自命令行，一并限制
+            cols = st.number_input("列", 1, MAX_GRID, min(default_cols, MAX_GRID))
+            rows = st.number_input("行", 1, MAX_GRID, min(default_rows, MAX_GRID))
         with col3:
             remove_watermark = st.checkbox("去水印", value=True)
+            matrix_mode = st.checkbox("色块重绘", value=False, help="每格取一个颜色重新绘制，不保留格子里的文字 (采样时避开水印，比逐像素去水印快，但比不去水印慢)")
+            # 转置只适用于方形格子，行列数不同时不提供
+            transform = st.selectbox("格子排列", [name for name in TRANSFORMS if name != 'transpose' or cols == rows],
+                                     format_func=TRANSFORMS.get, help="格子怎样重排，格子里的文字保持正向")
             st.caption(f"图片: {width}×{height}")
+            if profile is not None:
+                st.caption("已套用保存的布局")
+            else:
+                st.caption(f"区域检测置信度: {region_confidence:.0%}")
     
     st.markdown("---")
     
@@ -287,13 +227,14 @@ if uploaded_file is not None:
     
     with col_btn3:
         if st.button("🔄 重置", use_container_width=True):
-            st.session_state.x1 = int(width * 0.025)
-            st.session_state.y1 = int(height * 0.035)
-            st.session_state.x2 = int(width * 0.975)
-            st.session_state.y2 = int(height * 0.83)
+            (st.session_state.x1, st.session_state.y1,
+             st.session_state.x2, st.session_state.y2) = detected_region
             st.session_state.click_mode = None
             st.rerun()
     
+    if region_confidence < LOW_CONFIDENCE:
+        st.warning("⚠️ 没能可靠地识别格子区域，请手动点击设置左上角和右下角")
+    
     # 显示当前模式或成功提示
     if st.session_state.last_action:
         st.success(st.session_state.last_action)
@@ -311,9 +252,10 @@ if uploaded_file is not None:
     with col_coord2:
         st.markdown(f'<div class="coord-box-blue">🔵 右下角<br/>({st.session_state.x2}, {st.session_state.y2})</div>', unsafe_allow_html=True)
     
-    # 绘制带标记的图片
-    display_image = draw_selection(image, st.session_state.x1, st.session_state.y1, 
-                                   st.session_state.x2, st.session_state.y2)
+    # 绘制带标记的图片 (坐标换算到显示用图片上)
+    display_image = draw_selection(view, *(None if v is None else round(v / factor) for v in
+                                           (st.session_state.x1, st.session_state.y1,
+                                            st.session_state.x2, st.session_state.y2)))
     
     # 可点击的图片
     coords = streamlit_image_coordinates(display_image, key="main_image")
@@ -326,7 +268,7 @@ if uploaded_file is not None:
         is_new_click = (st.session_state.last_click != current_click)
         
         if is_new_click and st.session_state.click_mode is not None:
-            click_x, click_y = current_click
+            click_x, click_y = min(current_click[0] * factor, width), min(current_click[1] * factor, height)
             st.session_state.last_click = current_click  # 记录这次点击
             
             if st.session_state.click_mode == 'topleft':
@@ -347,38 +289,58 @@ if uploaded_file is not None:
     # ===== 处理按钮 =====
     st.subheader("🚀 镜像处理")
     
-    if st.button("✨ 开始镜像处理", type="primary", use_container_width=True):
-        # 自动校正坐标顺序
-        x1 = min(st.session_state.x1, st.session_state.x2)
-        y1 = min(st.session_state.y1, st.session_state.y2)
-        x2 = max(st.session_state.x1, st.session_state.x2)
-        y2 = max(st.session_state.y1, st.session_state.y2)
+    # 自动校正坐标顺序
+    x1 = min(st.session_state.x1, st.session_state.x2)
+    y1 = min(st.session_state.y1, st.session_state.y2)
+    x2 = max(st.session_state.x1, st.session_state.x2)
+    y2 = max(st.session_state.y1, st.session_state.y2)
+    mode = 'matrix' if matrix_mode else 'pixels'
+    params = ((x1, y1, x2, y2), (cols, rows), remove_watermark, mode, transform)
+    
+    if x1 == x2 or y1 == y2:
+        st.error("❌ 区域太小！请重新设置")
+    else:
+        if st.button("✨ 开始镜像处理", type="primary", use_container_width=True):
+            st.session_state['pending_params'] = params
+            remember_profile(full_image(uploaded_file), (x1, y1, x2, y2), (cols, rows))
         
-        if x1 == x2 or y1 == y2:
-            st.error("❌ 区域太小！请重新设置")
-        else:
-            with st.spinner("处理中... ⏳"):
-                result = process_image(image, x1, y1, x2, y2, cols, rows, remove_watermark)
+        # 处理中途页面重跑 (比如点了别的按钮) 会中断处理，参数没变时下一次自动接着处理，
+        # 已经完成的部分不会重算
+        if st.session_state.get('pending_params') == params and st.session_state.get('result_params') != params:
+            if st.button("⏹ 取消处理", use_container_width=True):
+                st.session_state.pop('pending_params')
+                st.info("已取消")
+            else:
+                result, timings = process_with_progress(image_key, (x1, y1, x2, y2), (cols, rows), remove_watermark,
+                                                        full_image(uploaded_file), mode=mode, transform=transform)
                 st.session_state['result'] = result
-            st.success(f"✅ 完成！{cols}列 × {rows}行")
-            st.balloons()
-    
-    # 显示结果
-    if 'result' in st.session_state:
-        st.image(st.session_state['result'], caption="镜像结果", use_container_width=True)
-        
-        buf = BytesIO()
-        st.session_state['result'].save(buf, format='PNG')
-        buf.seek(0)
+                st.session_state['timings'] = timings
+                st.session_state['result_params'] = params
+                st.session_state.pop('pending_params')
+                st.success(f"✅ 完成！{cols}列 × {rows}行")
+                st.balloons()
         
-        st.download_button(
-            label="💾 下载镜像图片",
-            data=buf,
-            file_name="拼豆镜像图纸.png",
-            mime="image/png",
-            use_container_width=True,
-            type="primary"
-        )
+        if st.session_state.get('result_params') == params:
+            # 显示结果
+            page_timer = StageTimer()
+            with page_timer.stage('display'):
+                st.image(st.session_state['result'], caption="镜像结果", use_container_width=True)
+            
+            # 点击下载时才编码，同一结果和格式只编码一次
+            fmt = st.selectbox("下载格式", list(OUTPUT_FORMATS), index=list(OUTPUT_FORMATS).index('png-palette'),
+                               format_func=lambda name: OUTPUT_FORMATS[name].label)
+            download_button("💾 下载镜像图片", image_key, params, st.session_state['result'], fmt, "拼豆镜像图纸",
+                            use_container_width=True, type="primary")
+            show_timings(st.session_state['timings'], page_timer)
+        else:
+            # 快速预览：参数一变就在缩小的图上重新处理，原图只在点击处理后才处理
+            preview, preview_timings, downscale = cached_preview(image_key, (x1, y1, x2, y2), (cols, rows),
+                                                                 remove_watermark, view, factor, mode=mode,
+                                                                 transform=transform)
+            caption = f"镜像预览 (1/{downscale} 分辨率)" if downscale > 1 else "镜像预览"
+            st.image(preview, caption=caption, use_container_width=True)
+            st.caption("👆 这是快速预览，确认无误后点击「开始镜像处理」处理原图并下载")
+            show_timings(preview_timings)
 
 else:
     # 欢迎页面
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+拼豆图纸镜像引擎
+不依赖任何界面库，Tk 版和 Streamlit 版共用
+"""
+
+from .grid import cell_edges
+from .watermark import CellCache, remove_watermark_grid, remove_watermark_from_cell
+from .mirror import DEFAULT_TRANSFORM, TRANSFORMS, MirrorMap, build_mirror_map, mirror_grid, parse_transform
+from .detect import (
+    DEFAULT_GRID_METHOD, GRID_METHODS, LOW_CONFIDENCE, MAX_GRID, GridGuess, RegionGuess,
+    default_region, detect_grid_size, detect_region, snap_grid_edges,
+)
+from .matrix import render_cells, sample_cells
+from .pipeline import (
+    AUTO, MODES, STAGES, Cancelled, Job, ProcessOptions,
+    encode_image, load_image, normalize_region, output_name, process, process_many,
+)
+from .decoding import decode_image, decode_reduced, image_header
+from .encoding import DEFAULT_OUTPUT_FORMAT, OUTPUT_FORMATS, OutputFormat, output_format, save_image
+from .tiled import process_tiled
+from .incremental import Reprocessor
+from .profiles import MemoryProfileStore, Profile, ProfileStore, layout_fingerprint
+
+__all__ = [
+    'cell_edges',
+    'CellCache',
+    'remove_watermark_grid',
+    'remove_watermark_from_cell',
+    'MirrorMap',
+    'build_mirror_map',
+    'mirror_grid',
+    'DEFAULT_TRANSFORM',
+    'TRANSFORMS',
+    'parse_transform',
+    'DEFAULT_GRID_METHOD',
+    'GRID_METHODS',
+    'LOW_CONFIDENCE',
+    'MAX_GRID',
+    'GridGuess',
+    'RegionGuess',
+    'default_region',
+    'detect_grid_size',
+    'detect_region',
+    'snap_grid_edges',
+    'render_cells',
+    'sample_cells',
+    'AUTO',
+    'MODES',
+    'STAGES',
+    'Cancelled',
+    'Job',
+    'ProcessOptions',
+    'encode_image',
+    'load_image',
+    'normalize_region',
+    'output_name',
+    'process',
+    'process_many',
+    'decode_image',
+    'decode_reduced',
+    'image_header',
+    'DEFAULT_OUTPUT_FORMAT',
+    'OUTPUT_FORMATS',
+    'OutputFormat',
+    'output_format',
+    'save_image',
+    'process_tiled',
+    'Reprocessor',
+    'Profile',
+    'ProfileStore',
+    'MemoryProfileStore',
+    'layout_fingerprint',
+]
@@ -0,0 +1,8 @@
+# -*- coding: utf-8 -*-
+"""python -m pindou 图纸/*.png"""
+
+import sys
+
+from .cli import main
+
+sys.exit(main())
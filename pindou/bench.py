@@ -0,0 +1,398 @@
+# -*- coding: utf-8 -*-
+"""
+性能基准
+生成已知格子数的合成图纸 (色块、文字标注、平铺的灰色水印)，按阶段计时，
+和原始的逐格实现逐像素比对，结果写成 JSON，可以和保存的基线比较。
+
+用法: python -m pindou.bench --output bench.json --baseline 上次的bench.json
+"""
+
+import argparse
+import hashlib
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from collections import Counter
+
+import cv2
+import numpy as np
+
+from .detect import GRID_METHODS, detect_grid_size, detect_region
+from .mirror import DEFAULT_TRANSFORM, TRANSFORMS, axis_map, build_mirror_map
+from .pipeline import BAND_BYTES, Job, ProcessOptions, decode, detect, dewatermark, encode, encode_image, mirror
+from .timing import dedup_context
+from .watermark import remove_watermark_grid
+
+
+# (列数, 行数, 格子像素)
+DEFAULT_CASES = ((20, 20, 24), (52, 47, 16), (100, 100, 12), (200, 200, 8), (256, 256, 6))
+# 区域像素超过此值时不跑原始实现 (逐像素的 Python 循环太慢)，只比较结果摘要
+REFERENCE_LIMIT = 1_000_000
+# 自动检测的区域和真实区域允许的误差 (像素)
+REGION_TOLERANCE = 2
+# 比较基线时，慢了超过这个比例且超过 MIN_DELTA 秒才算变慢
+TOLERANCE = 0.2
+MIN_DELTA = 0.005
+
+
+def make_sheet(cols, rows, cell, seed=0, watermark=True):
+    """生成一张合成图纸，返回 (RGB 数组, 真实格子区域)
+
+    布局和真实图纸类似：上方和左侧是行列号，格子带文字标注、每 5 格一条粗线，
+    下方是色卡图例，整张图平铺半透明的灰色水印文字
+    """
+    rng = np.random.default_rng(seed)
+    x0, y0 = max(40, cell * 2), max(60, cell * 3)
+    width = x0 * 2 + cols * cell
+    height = y0 + rows * cell + 200
+    img = np.full((height, width, 3), 255, np.uint8)
+
+    palette = rng.integers(0, 256, (12, 3))
+    index = rng.integers(0, len(palette) + 1, (rows, cols))  # 最后一个值表示空格子
+    filled = index < len(palette)
+    cells = palette[np.minimum(index, len(palette) - 1)].astype(np.uint8)
+    cells[~filled] = 255
+    img[y0:y0 + rows * cell, x0:x0 + cols * cell] = np.repeat(np.repeat(cells, cell, axis=0), cell, axis=1)
+
+    scale = cell / 40
+    if cell >= 10:
+        for r, c in zip(*np.nonzero(filled)):
+            cv2.putText(img, 'A1', (x0 + c * cell + 2, y0 + (r + 1) * cell - cell // 4),
+                        cv2.FONT_HERSHEY_PLAIN, scale, (0, 0, 0), 1)
+    for c in range(cols + 1):
+        img[y0:y0 + rows * cell + 1, x0 + c * cell] = (40, 40, 40) if c % 5 == 0 else (120, 120, 120)
+    for r in range(rows + 1):
+        img[y0 + r * cell, x0:x0 + cols * cell + 1] = (40, 40, 40) if r % 5 == 0 else (120, 120, 120)
+    for c in range(0, cols, 5):
+        cv2.putText(img, str(c + 1), (x0 + c * cell, y0 - 8), cv2.FONT_HERSHEY_PLAIN, 0.8, (0, 0, 0), 1)
+    for r in range(0, rows, 5):
+        cv2.putText(img, str(r + 1), (4, y0 + (r + 1) * cell - 2), cv2.FONT_HERSHEY_PLAIN, 0.8, (0, 0, 0), 1)
+
+    legend_y = y0 + rows * cell + 50
+    for i, color in enumerate(palette[:min(len(palette), (width - x0) // 60)]):
+        color = tuple(int(v) for v in color)
+        cv2.rectangle(img, (x0 + i * 60, legend_y), (x0 + i * 60 + 40, legend_y + 25), color, -1)
+        cv2.rectangle(img, (x0 + i * 60, legend_y), (x0 + i * 60 + 40, legend_y + 25), (0, 0, 0), 1)
+        cv2.putText(img, f'C{i}', (x0 + i * 60, legend_y + 45), cv2.FONT_HERSHEY_PLAIN, 1, (0, 0, 0), 1)
+
+    if watermark:
+        overlay = img.copy()
+        for ty in range(80, height, 160):
+            for tx in range(-100 + (ty // 160) % 2 * 120, width, 240):
+                cv2.putText(overlay, 'WATERMARK', (tx, ty), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (160, 160, 160), 2)
+        img = cv2.addWeighted(overlay, 0.5, img, 0.5, 0)
+    return img, (x0, y0, x0 + cols * cell, y0 + rows * cell)
+
+
+def _reference_cell(cell_array):
+    """原始的逐像素去水印实现"""
+    h, w = cell_array.shape[:2]
+    result = cell_array.copy()
+    bg_candidates = []
+    for pixel in cell_array.reshape(-1, 3):
+        r, g, b = int(pixel[0]), int(pixel[1]), int(pixel[2])
+        brightness = (r + g + b) / 3
+        if brightness < 60:
+            continue
+        diff = max(abs(r - g), abs(g - b), abs(r - b))
+        if diff < 15 and 100 < brightness < 200:
+            continue
+        bg_candidates.append((r, g, b))
+    if not bg_candidates:
+        return result
+
+    color_counts = Counter([(c[0] // 8 * 8, c[1] // 8 * 8, c[2] // 8 * 8) for c in bg_candidates])
+    dominant_quantized = color_counts.most_common(1)[0][0]
+    bg_color = None
+    best_dist = float('inf')
+    for c in bg_candidates:
+        dist = sum((a - b) ** 2 for a, b in zip(c, dominant_quantized))
+        if dist < best_dist:
+            best_dist = dist
+            bg_color = c
+
+    for y in range(h):
+        for x in range(w):
+            r, g, b = int(result[y, x, 0]), int(result[y, x, 1]), int(result[y, x, 2])
+            brightness = (r + g + b) / 3
+            diff = max(abs(r - g), abs(g - b), abs(r - b))
+            if diff < 20 and 90 < brightness < 210:
+                result[y, x] = bg_color
+    return result
+
+
+def reference_process(img_array, region, grid, remove_watermark=True):
+    """原始的逐格镜像实现，作为比对基准"""
+    x1, y1, x2, y2 = region
+    cols, rows = grid
+    new_img_array = img_array.copy()
+    cell_width = (x2 - x1) / cols
+    cell_height = (y2 - y1) / rows
+    for row in range(rows):
+        for col in range(cols):
+            src_left = int(x1 + col * cell_width)
+            src_right = int(x1 + (col + 1) * cell_width)
+            src_top = int(y1 + row * cell_height)
+            src_bottom = int(y1 + (row + 1) * cell_height)
+            dst_col = cols - 1 - col
+            dst_left = int(x1 + dst_col * cell_width)
+            dst_right = int(x1 + (dst_col + 1) * cell_width)
+
+            cell = img_array[src_top:src_bottom, src_left:src_right].copy()
+            if cell.size == 0:
+                continue
+            if remove_watermark:
+                cell = _reference_cell(cell)
+            target_h = src_bottom - src_top
+            target_w = dst_right - dst_left
+            if cell.shape[0] != target_h or cell.shape[1] != target_w:
+                cell = cv2.resize(cell, (target_w, target_h), interpolation=cv2.INTER_NEAREST)
+            new_img_array[src_top:src_bottom, dst_left:dst_right] = cell
+    return new_img_array
+
+
+# 其他变换在格子编号上的效果，用来逐格核对 (与 mirror.parse_transform 的化简无关)
+REFERENCE_TRANSFORMS = {
+    'flip-v': lambda cells: cells[::-1],
+    'rotate-180': lambda cells: cells[::-1, ::-1],
+    'transpose': lambda cells: cells.T,
+}
+
+
+def reference_transform(region, x_edges, y_edges, transform):
+    """逐格搬运实现的 flip-v、rotate-180、transpose，region 为格子区域内容"""
+    rows, cols = len(y_edges) - 1, len(x_edges) - 1
+    source = REFERENCE_TRANSFORMS[transform](np.arange(rows * cols).reshape(rows, cols))
+    x_edges = np.asarray(x_edges) - x_edges[0]
+    y_edges = np.asarray(y_edges) - y_edges[0]
+    result = region.copy()
+    for row in range(source.shape[0]):
+        for col in range(source.shape[1]):
+            src_row, src_col = divmod(int(source[row, col]), cols)
+            cell = region[y_edges[src_row]:y_edges[src_row + 1], x_edges[src_col]:x_edges[src_col + 1]]
+            size = (x_edges[col + 1] - x_edges[col], y_edges[row + 1] - y_edges[row])
+            if (cell.shape[1], cell.shape[0]) != size:
+                cell = cv2.resize(cell, size, interpolation=cv2.INTER_NEAREST)
+            result[y_edges[row]:y_edges[row + 1], x_edges[col]:x_edges[col + 1]] = cell
+    return result
+
+
+def _best_time(fn, repeat):
+    """重复执行 repeat 次，返回 (最短用时, 最后一次的返回值)"""
+    best = float('inf')
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def _digest(array):
+    return hashlib.sha1(np.ascontiguousarray(array).tobytes()).hexdigest()[:16]
+
+
+def run_case(cols, rows, cell, seed=0, repeat=3, reference_limit=REFERENCE_LIMIT, threads=()):
+    """生成一张图纸并测量各阶段，返回结果字典
+
+    threads 中的每个线程数再测一遍去水印和镜像 (阶段名加 _t线程数)，并检查结果和单线程相同
+    """
+    img, truth = make_sheet(cols, rows, cell, seed)
+    png = encode_image(img)
+    stages = {}
+    checks = {}  # 结果正确性，失败即退出码非 0
+    accuracy = {}  # 自动检测是否找对，只做记录
+
+    job = Job(png, region=truth, grid=(cols, rows), options=ProcessOptions(output_format='PNG'))
+    stages['decode'], _ = _best_time(lambda: decode(job), repeat)
+
+    stages['detect_region'], guess = _best_time(lambda: detect_region(job.array), repeat)
+    accuracy['region'] = bool(max(abs(a - b) for a, b in zip(guess[:4], truth)) <= REGION_TOLERANCE)
+    for method in GRID_METHODS:
+        stages[f'grid_{method}'], grid = _best_time(lambda: detect_grid_size(job.array, truth, method), repeat)
+        accuracy[f'grid_{method}'] = grid is not None and (grid.cols, grid.rows) == (cols, rows)
+
+    def build_map():
+        build_mirror_map.cache_clear()
+        axis_map.cache_clear()
+        return detect(job)
+
+    stages['mirror_map'], _ = _best_time(build_map, repeat)
+    stats = {}
+    stages['dewatermark'], _ = _best_time(lambda: dewatermark(job), repeat)
+    remove_watermark_grid(job.array, job.mirror_map.x_edges, job.mirror_map.y_edges, stats=stats)
+    stages['mirror'], _ = _best_time(lambda: mirror(job), repeat)
+    stages['encode'], _ = _best_time(lambda: encode(job), repeat)
+    pixels_output = job.output
+
+    cleaned = job.cleaned
+    for count in threads:
+        job.options = ProcessOptions(threads=count)
+        stages[f'dewatermark_t{count}'], _ = _best_time(lambda: dewatermark(job), repeat)
+        stages[f'mirror_t{count}'], _ = _best_time(lambda: mirror(job), repeat)
+        checks[f'threads_{count}'] = bool(np.array_equal(job.cleaned, cleaned)
+                                          and np.array_equal(job.output, pixels_output))
+
+    # 结果写回原图时去水印和镜像的额外内存 (tracemalloc 能看到 NumPy 的分配)，不应超过 BAND_BYTES
+    in_place = Job(job.array.copy(), region=truth, grid=(cols, rows), options=ProcessOptions(in_place=True))
+    decode(in_place)
+    detect(in_place)
+    tracemalloc.start()
+    dewatermark(in_place)
+    mirror(in_place)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    checks['in_place'] = bool(np.array_equal(in_place.output, pixels_output) and peak <= BAND_BYTES)
+
+    # 其他变换 (转置只测方形格子)：计时，区域不太大时和逐格实现比对
+    region_pixels = (truth[2] - truth[0]) * (truth[3] - truth[1])
+    x1, y1, x2, y2 = job.mirror_map.bounds
+    for name in TRANSFORMS:
+        if name == DEFAULT_TRANSFORM or (name == 'transpose' and cols != rows):
+            continue
+        other = Job(job.array, region=truth, grid=(cols, rows), array=job.array, edges=job.edges, cleaned=cleaned,
+                    options=ProcessOptions(transform=name))
+        detect(other)
+        stages[f'mirror_{name}'], _ = _best_time(lambda: mirror(other), repeat)
+        if region_pixels <= reference_limit:
+            expected = reference_transform(cleaned, job.mirror_map.x_edges, job.mirror_map.y_edges, name)
+            checks[name] = bool(np.array_equal(other.output[y1:y2, x1:x2], expected))
+
+    job.options = ProcessOptions(mode='matrix')
+    stages['matrix'], _ = _best_time(lambda: mirror(job), repeat)
+    matrix_output = job.output
+
+    if region_pixels <= reference_limit:
+        start = time.perf_counter()
+        expected = reference_process(job.array, truth, (cols, rows))
+        stages['reference'] = time.perf_counter() - start
+        checks['reference'] = bool(np.array_equal(expected, pixels_output))
+    else:
+        checks['reference'] = None  # 太大，跳过
+
+    height, width = img.shape[:2]
+    return {
+        'name': f'{cols}x{rows}@{cell}',
+        'cols': cols,
+        'rows': rows,
+        'cell': cell,
+        'size': [width, height],
+        'stages': {name: round(seconds, 6) for name, seconds in stages.items()},
+        'checks': checks,
+        'accuracy': accuracy,
+        'digests': {'pixels': _digest(pixels_output), 'matrix': _digest(matrix_output)},
+        'dedup_rate': dedup_context(stats)['dedup_rate'],  # 去水印时相同格子省掉的比例
+        'in_place_peak_mb': round(peak / 2 ** 20, 1),
+    }
+
+
+def environment():
+    """记录运行环境，方便判断两次结果能否直接比较"""
+    return {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'opencv': cv2.__version__,
+        'machine': platform.machine(),
+        'system': platform.system(),
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+    }
+
+
+def compare(results, baseline, tolerance=TOLERANCE, min_delta=MIN_DELTA):
+    """和基线比较，返回 (变慢的阶段, 输出变化的用例, 检测变差的用例) 三个列表"""
+    old_cases = {case['name']: case for case in baseline.get('cases', [])}
+    slower = []
+    changed = []
+    worse = []
+    for case in results['cases']:
+        old = old_cases.get(case['name'])
+        if old is None:
+            continue
+        for stage, seconds in case['stages'].items():
+            before = old['stages'].get(stage)
+            if before and seconds > before * (1 + tolerance) and seconds - before > min_delta:
+                slower.append((case['name'], stage, before, seconds))
+        for mode, digest in case['digests'].items():
+            if old.get('digests', {}).get(mode) not in (None, digest):
+                changed.append((case['name'], mode))
+        for name, ok in case['accuracy'].items():
+            if old.get('accuracy', {}).get(name) and not ok:
+                worse.append((case['name'], name))
+    return slower, changed, worse
+
+
+def parse_case(text):
+    """'列x行@格子像素'，例如 52x47@16"""
+    try:
+        grid, cell = text.lower().split('@')
+        cols, rows = grid.split('x')
+        return int(cols), int(rows), int(cell)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"用例格式应为 列x行@格子像素: {text}")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='python -m pindou.bench', description="拼豆图纸镜像性能基准")
+    parser.add_argument('--case', dest='cases', type=parse_case, action='append',
+                        help="用例 列x行@格子像素，可重复，默认 " +
+                             ' '.join(f'{c}x{r}@{s}' for c, r, s in DEFAULT_CASES))
+    parser.add_argument('--repeat', type=int, default=3, help="每个阶段重复次数，取最短用时")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--reference-limit', type=int, default=REFERENCE_LIMIT,
+                        help="格子区域像素不超过此值时才和原始实现逐像素比对")
+    parser.add_argument('--threads', type=int, nargs='+', default=(), metavar='N',
+                        help="再用这些线程数测量去水印和镜像，例如 --threads 2 4 8")
+    parser.add_argument('--output', help="结果 JSON 路径")
+    parser.add_argument('--baseline', help="基线 JSON 路径，比较用时和输出摘要")
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE, help="允许变慢的比例")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    results = {'environment': environment(), 'cases': []}
+    failed = False
+    for cols, rows, cell in args.cases or DEFAULT_CASES:
+        case = run_case(cols, rows, cell, args.seed, args.repeat, args.reference_limit, args.threads)
+        results['cases'].append(case)
+        stages = '  '.join(f"{name} {seconds * 1000:.1f}ms" for name, seconds in case['stages'].items())
+        bad = [name for name, ok in case['checks'].items() if ok is False]
+        failed |= bool(bad)
+        status = f"✗ {', '.join(bad)}" if bad else "✓"
+        missed = [name for name, ok in case['accuracy'].items() if not ok]
+        if missed:
+            status += f"  (检测不准: {', '.join(missed)})"
+        print(f"{case['name']:>14} {case['size'][0]}×{case['size'][1]}  {status}  格子去重 {case['dedup_rate']:.0%}  "
+              f"原地处理额外内存 {case['in_place_peak_mb']}MB"
+              f"\n    {stages}")
+        speedups = '  '.join(
+            f"{count} 线程 {case['stages']['dewatermark'] / case['stages'][f'dewatermark_t{count}']:.2f}×"
+            f"/{case['stages']['mirror'] / case['stages'][f'mirror_t{count}']:.2f}×"
+            for count in args.threads)
+        if speedups:
+            print(f"    加速比 (去水印/镜像): {speedups}")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=1)
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        slower, changed, worse = compare(results, baseline, args.tolerance)
+        for name, stage, before, after in slower:
+            print(f"⚠ {name} {stage}: {before * 1000:.1f}ms → {after * 1000:.1f}ms ({after / before:.2f}×)")
+        for name, mode in changed:
+            print(f"✗ {name} {mode} 输出和基线不同")
+        for name, check in worse:
+            print(f"⚠ {name} {check}: 基线检测正确，现在不正确")
+        failed |= bool(changed)
+        if not slower and not changed and not worse:
+            print("与基线一致，没有变慢的阶段")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+"""
+命令行批量镜像
+用法: python pindou_mirror.py 图纸/*.png --grid 52x47 --workers 8
+
+区域或格子数为 auto 时先查布局档案 (见 profiles)；两者都手动指定时，
+处理成功的图纸的布局会存入档案，之后同样布局的图纸用 auto 就能直接套用。
+"""
+
+import argparse
+import glob
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from .detect import DEFAULT_GRID_METHOD, GRID_METHODS, LOW_CONFIDENCE
+from .encoding import DEFAULT_OUTPUT_FORMAT, OUTPUT_FORMATS, output_format
+from .mirror import DEFAULT_TRANSFORM, TRANSFORMS, parse_transform
+from .pipeline import AUTO, MODES, ProcessOptions, output_name, process
+from .profiles import ProfileStore, default_path
+from .tiled import DEFAULT_BAND_BYTES, TILED_FORMATS, process_tiled
+from .timing import PROFILE_ENV, TIMING_LOG_ENV
+
+
+def parse_region(text):
+    """'auto' 或 'x1,y1,x2,y2'"""
+    if text == AUTO:
+        return AUTO
+    try:
+        values = tuple(int(v) for v in text.split(','))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"无效的格子区域: {text}")
+    if len(values) != 4:
+        raise argparse.ArgumentTypeError(f"格子区域需要 4 个数: {text}")
+    return values
+
+
+def parse_grid(text):
+    """'auto' 或 '列x行' (也接受 '列,行' 和 '列×行')"""
+    if text == AUTO:
+        return AUTO
+    parts = text.replace('×', 'x').replace(',', 'x').lower().split('x')
+    try:
+        values = tuple(int(v) for v in parts)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"无效的格子数: {text}")
+    if len(values) != 2 or min(values) < 1:
+        raise argparse.ArgumentTypeError(f"格子数格式应为 列x行: {text}")
+    return values
+
+
+def check_transform(text):
+    """'flip-h'、'transpose+flip-h' 等 (见 mirror.TRANSFORMS)"""
+    try:
+        parse_transform(text)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+    return text
+
+
+def expand_inputs(patterns):
+    """展开通配符，目录则取其中所有图片，去重并保持顺序"""
+    extensions = ('.png', '.jpg', '.jpeg', '.bmp', '.gif', '.webp')
+    paths = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) or [pattern]
+        for path in matches:
+            if os.path.isdir(path):
+                paths.extend(sorted(os.path.join(path, name) for name in os.listdir(path)
+                                    if name.lower().endswith(extensions)))
+            else:
+                paths.append(path)
+    seen = set()
+    return [p for p in paths if not (p in seen or seen.add(p))]
+
+
+def mirror_file(path, region, grid, options, output_dir, band_bytes=None):
+    """处理单个文件 (在子进程中运行)，返回结果摘要
+
+    band_bytes 不为 None 时分块处理，内存占用约为 band_bytes (JPEG 等整张解码的原图除外，见 tiled)
+    """
+    start = time.perf_counter()
+    out_dir = output_dir or os.path.dirname(path)
+    out_path = os.path.join(out_dir, output_name(path, output_format(options.output_format).extension))
+    if band_bytes:
+        job = process_tiled(path, out_path, region, grid, options, band_bytes=band_bytes)
+    else:
+        job = process(path, region, grid, options)
+        with open(out_path, 'wb') as f:
+            f.write(job.encoded)
+
+    width, height = job.timer.context['width'], job.timer.context['height']
+    return {
+        'input': path,
+        'output': out_path,
+        'size': (width, height),
+        'region': job.region,
+        'confidence': job.region_confidence,
+        'grid': job.grid,
+        'edges': job.edges,
+        'profile': job.profile is not None,
+        # 区域和格子数都是手动指定的才算确认过，交给主进程存入布局档案
+        'fingerprint': job.fingerprint,
+        'seconds': time.perf_counter() - start,
+        'timings': job.timer.summary(),
+    }
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog='pindou_mirror',
+        description="批量镜像拼豆图纸，结果保存为 <原文件名>_镜像.<格式扩展名>")
+    parser.add_argument('inputs', nargs='+', help="图片路径、通配符或目录")
+    parser.add_argument('--region', type=parse_region, default=AUTO,
+                        help="格子区域 x1,y1,x2,y2，默认 auto")
+    parser.add_argument('--grid', type=parse_grid, default=AUTO,
+                        help="格子数 列x行，默认 auto (自动检测)")
+    parser.add_argument('--grid-method', choices=GRID_METHODS, default=DEFAULT_GRID_METHOD,
+                        help="自动检测格子数的方法: periodic 投影周期 (快)，hough 霍夫直线")
+    parser.add_argument('--no-watermark-removal', dest='remove_watermark', action='store_false',
+                        help="不去除水印")
+    parser.add_argument('--no-snap', dest='snap_edges', action='store_false',
+                        help="格子边界按格子数均分，不对齐检测到的网格线")
+    parser.add_argument('--mode', choices=MODES, default='pixels',
+                        help="pixels 逐像素搬运格子 (保留文字)，matrix 每格采样一个颜色后重绘 (避开水印，比 pixels 去水印快)")
+    parser.add_argument('--transform', type=check_transform, default=DEFAULT_TRANSFORM,
+                        help=f"格子怎样重排: {', '.join(TRANSFORMS)}，可用 + 按顺序组合 "
+                             f"(如 transpose+flip-h 为顺时针转 90°)，转置只适用于方形格子；默认 {DEFAULT_TRANSFORM}")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help="并行进程数，默认为 CPU 核数")
+    parser.add_argument('--threads', type=int, default=1,
+                        help="每张图纸去水印和镜像的线程数，0 为 CPU 核数，默认 %(default)s (已经按进程并行)")
+    parser.add_argument('--profiles', default=default_path(),
+                        help="布局档案文件，默认 %(default)s")
+    parser.add_argument('--no-profiles', dest='profiles', action='store_const', const=None,
+                        help="不查也不保存布局档案")
+    parser.add_argument('--output-dir', default=None, help="输出目录，默认与原图相同")
+    parser.add_argument('--format', choices=OUTPUT_FORMATS, default=DEFAULT_OUTPUT_FORMAT,
+                        help="输出格式: png、png-fast (压缩快)、png-palette (颜色少时体积小)、"
+                             "webp (无损)、jpeg，默认 %(default)s")
+    parser.add_argument('--tiled', action='store_true',
+                        help="分块处理超大图纸，原图和结果放在磁盘映射文件中 (只支持 png 和 png-fast)；"
+                             ".npy 和 8 位非隔行的 PNG 原图按条读入，内存与图片大小无关；JPEG 等其他格式仍要整张解码一次")
+    parser.add_argument('--tile-mb', type=int, default=DEFAULT_BAND_BYTES // (1024 * 1024),
+                        help="分块处理时每块占用的内存 (MB)，默认 %(default)s")
+    parser.add_argument('--timing-log', default=None,
+                        help="把每张图纸各阶段的用时追加写入此文件 (JSON lines)")
+    parser.add_argument('--profile', default=None, metavar='DIR',
+                        help="用 cProfile 剖析每张图纸，.prof 文件存到此目录")
+    parser.add_argument('-v', '--verbose', action='store_true', help="显示每张图纸各阶段的用时")
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.tiled and args.format not in TILED_FORMATS:
+        parser.error(f"--tiled 只支持 {', '.join(TILED_FORMATS)} 格式")
+
+    paths = expand_inputs(args.inputs)
+    if not paths:
+        print("没有找到图片", file=sys.stderr)
+        return 1
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+    # 子进程继承环境变量
+    if args.timing_log:
+        os.environ[TIMING_LOG_ENV] = os.path.abspath(args.timing_log)
+    if args.profile:
+        os.environ[PROFILE_ENV] = os.path.abspath(args.profile)
+
+    options = ProcessOptions(remove_watermark=args.remove_watermark, mode=args.mode, transform=args.transform,
+                             grid_method=args.grid_method, output_format=args.format,
+                             threads=args.threads, snap_edges=args.snap_edges, profiles=args.profiles,
+                             in_place=True)  # 原图解码后只用一次，结果直接写回原图
+    band_bytes = args.tile_mb * 1024 * 1024 if args.tiled else None
+    workers = max(1, min(args.workers, len(paths)))
+    print(f"共 {len(paths)} 张图纸，{workers} 个进程")
+
+    start = time.perf_counter()
+    done = 0
+    failed = 0
+    flagged = []
+    total_pixels = 0
+    layouts = {}  # (尺寸, 区域, 格子数) → 指纹，每种布局只存一次
+    from_profile = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(mirror_file, path, args.region, args.grid, options, args.output_dir, band_bytes): path
+            for path in paths
+        }
+        for future in as_completed(futures):
+            path = futures[future]
+            try:
+                info = future.result()
+            except Exception as e:
+                failed += 1
+                print(f"✗ {path}: {e}")
+                continue
+            done += 1
+            width, height = info['size']
+            total_pixels += width * height
+            cols, rows = info['grid']
+            confidence = info['confidence']
+            note = ""
+            if info['fingerprint']:
+                layouts[(info['size'], tuple(info['region']), tuple(info['grid']))] = info['fingerprint']
+            if info['profile']:
+                from_profile += 1
+                note = "  套用布局档案"
+            elif confidence is not None:
+                note = f"  置信度 {confidence:.2f}"
+                if confidence < LOW_CONFIDENCE:
+                    note += "  ⚠ 需人工确认区域"
+                    flagged.append(path)
+            print(f"✓ {path} → {info['output']}  {width}×{height}  {cols}列 × {rows}行  "
+                  f"区域 {info['region']}{note}  {info['seconds']:.2f}s")
+            if args.verbose:
+                print(f"    {info['timings']}")
+
+    elapsed = time.perf_counter() - start
+    print(f"完成 {done} 张，失败 {failed} 张，用时 {elapsed:.2f}s，"
+          f"{done / elapsed:.2f} 张/s，{total_pixels / elapsed / 1e6:.1f} 百万像素/s")
+    if from_profile:
+        print(f"{from_profile} 张套用了布局档案")
+    if layouts:
+        store = ProfileStore(args.profiles)
+        for (size, region, grid), fingerprint in layouts.items():
+            store.add(size, region, grid, fingerprint)
+        print(f"已保存 {len(layouts)} 种布局到 {args.profiles}")
+    if flagged:
+        print(f"⚠ {len(flagged)} 张图纸的格子区域置信度偏低，需要人工确认:")
+        for path in flagged:
+            print(f"  {path}")
+    return 1 if failed else 0
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+"""
+图片解码
+decode_image  路径、字节或文件对象用 cv2.imdecode 直接解码成 RGB 数组，比 PIL 解码、
+              convert 再转数组少两次整图复制；OpenCV 不支持的格式 (如 GIF) 退回 PIL
+decode_reduced  缩小整数倍解码。JPEG 用 DCT 缩放直接解出 1/2、1/4、1/8 尺寸，
+              不做整图解码；其他格式整图解码后按方块平均缩小
+image_header  只读文件头得到格式和尺寸
+decode_strips  按行分条解码 (分块处理超大图纸用)，8 位、非隔行的 PNG 边解压边解码
+各种解码和 PIL 的 Image.open(...).convert('RGB') 逐像素一致 (不按 EXIF 旋转)。
+"""
+
+import os
+import struct
+import zlib
+from collections import namedtuple
+from io import BytesIO
+
+import cv2
+import numpy as np
+from PIL import Image
+
+
+# JPEG 的 DCT 缩放支持的倍数
+JPEG_SCALES = (8, 4, 2)
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# 能分条解码的 PNG 颜色类型 (位深 8、非隔行) → 每像素字节数
+PNG_CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+# 分条解码时每次读取、解压的最大字节数
+PNG_READ_BYTES = 1 << 20
+
+PngHeader = namedtuple('PngHeader', ['width', 'height', 'color_type', 'chunks', 'offset'])
+
+
+def read_bytes(source):
+    """路径、字节或文件对象的全部内容"""
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return source
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, 'rb') as f:
+            return f.read()
+    if hasattr(source, 'getvalue'):
+        return source.getvalue()
+    return source.read()
+
+
+def decode_image(source):
+    """把路径、字节、文件对象、PIL 图片或数组转成 RGB 数组"""
+    if isinstance(source, np.ndarray):
+        return source
+    if isinstance(source, Image.Image):
+        return np.asarray(source.convert('RGB'))
+    data = read_bytes(source)
+    array = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION)
+    if array is None:
+        with Image.open(BytesIO(data)) as img:
+            return np.asarray(img.convert('RGB'))
+    return cv2.cvtColor(array, cv2.COLOR_BGR2RGB, dst=array)
+
+
+def image_header(source):
+    """(格式, (宽, 高))，只读文件头；数组和 PIL 图片的格式为 None"""
+    if isinstance(source, np.ndarray):
+        return None, (source.shape[1], source.shape[0])
+    if isinstance(source, Image.Image):
+        return None, source.size
+    with Image.open(BytesIO(read_bytes(source))) as img:
+        return img.format, img.size
+
+
+def image_size(source):
+    """图片尺寸 (宽, 高)，只读文件头"""
+    return image_header(source)[1]
+
+
+def draft_factor(limit):
+    """不超过 limit 的最大 JPEG DCT 缩放倍数 (1、2、4 或 8)，只求显示时用它解码最快"""
+    return next((s for s in JPEG_SCALES if s <= limit), 1)
+
+
+def decode_reduced(source, factor):
+    """缩小 factor 倍解码成 RGB PIL 图片，尺寸与 Image.reduce(factor) 相同
+
+    JPEG 先用 DCT 缩放解出能整除 factor 的最大倍数，剩下的倍数再按方块平均缩小
+    """
+    if isinstance(source, (np.ndarray, Image.Image)):
+        image = source if isinstance(source, Image.Image) else Image.fromarray(decode_image(source))
+        image = image if image.mode == 'RGB' else image.convert('RGB')
+        return image.reduce(factor) if factor > 1 else image
+    data = read_bytes(source)
+    scale = next((s for s in JPEG_SCALES if factor % s == 0), 1)
+    with Image.open(BytesIO(data)) as img:
+        if img.format == 'JPEG' and scale > 1:
+            width, height = img.size
+            _, box = img.draft('RGB', (-(-width // scale), -(-height // scale)))
+            scale = round(width / box[2])
+            image = img.convert('RGB')
+        else:
+            scale = 1
+            image = Image.fromarray(decode_image(data))
+    rest = factor // scale
+    return image.reduce(rest) if rest > 1 else image
+
+
+def _chunk(tag, data):
+    """一个 PNG 块 (长度、类型、数据、CRC)"""
+    crc = zlib.crc32(data, zlib.crc32(tag)) & 0xffffffff
+    return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', crc)
+
+
+def _chunk_header(f):
+    length, tag = struct.unpack('>I4s', f.read(8))
+    return length, tag
+
+
+def _png_header(f):
+    """读到第一个 IDAT 块为止的 PNG 文件头，不能分条解码的图片返回 None；读完回到原来的位置"""
+    start = f.tell()
+    try:
+        if f.read(8) != PNG_SIGNATURE or _chunk_header(f)[1] != b'IHDR':
+            return None
+        width, height, depth, color_type, _, _, interlace = struct.unpack('>IIBBBBB', f.read(13))
+        f.seek(4, os.SEEK_CUR)
+        if depth != 8 or interlace or color_type not in PNG_CHANNELS:
+            return None
+        chunks = []  # 解码要用到的调色板和透明色
+        while True:
+            length, tag = _chunk_header(f)
+            if tag == b'IDAT':
+                return PngHeader(width, height, color_type, chunks, f.tell() - 8)
+            if tag == b'IEND':
+                return None
+            data = f.read(length)
+            f.seek(4, os.SEEK_CUR)
+            if tag in (b'PLTE', b'tRNS'):
+                chunks.append((tag, data))
+    except struct.error:
+        return None
+    finally:
+        f.seek(start)
+
+
+def _idat_data(f, header):
+    """依次返回解压后的图像数据，每次不超过 PNG_READ_BYTES"""
+    inflate = zlib.decompressobj()
+    f.seek(header.offset)
+    while not inflate.eof:
+        length, tag = _chunk_header(f)
+        if tag == b'IEND':
+            break
+        if tag != b'IDAT':
+            f.seek(length + 4, os.SEEK_CUR)
+            continue
+        remaining = length
+        while remaining:
+            data = f.read(min(remaining, PNG_READ_BYTES))
+            if not data:
+                raise ValueError("PNG 文件不完整")
+            remaining -= len(data)
+            while True:
+                out = inflate.decompress(data, PNG_READ_BYTES)
+                if out:
+                    yield out
+                data = inflate.unconsumed_tail
+                if not data and len(out) < PNG_READ_BYTES:
+                    break
+        f.seek(4, os.SEEK_CUR)
+
+
+def _png_strip(header, data, count, previous):
+    """把 count 行过滤过的数据包成一张小 PNG 交给 PIL 解码，返回 (RGB 数组, 最后一行的原始像素)
+
+    previous 为上一条最后一行的原始像素，作为不过滤的一行接在最前面，
+    这样本条第一行的 Up、Average、Paeth 过滤也能还原；解码后再去掉这一行
+    """
+    if previous:
+        data = b'\0' + previous + data
+        count += 1
+    ihdr = struct.pack('>IIBBBBB', header.width, count, 8, header.color_type, 0, 0, 0)
+    png = b''.join([PNG_SIGNATURE, _chunk(b'IHDR', ihdr), *(_chunk(tag, body) for tag, body in header.chunks),
+                    _chunk(b'IDAT', zlib.compress(data, 0)), _chunk(b'IEND', b'')])
+    with Image.open(BytesIO(png)) as img:
+        last = img.crop((0, count - 1, header.width, count)).tobytes()
+        rgb = np.asarray(img.convert('RGB'))
+    return (rgb[1:] if previous else rgb), last
+
+
+def _png_strips(f, header, rows):
+    stride = header.width * PNG_CHANNELS[header.color_type] + 1  # 每行前有 1 字节过滤类型
+    pending = bytearray()
+    previous = b''
+    top = 0
+    for data in _idat_data(f, header):
+        pending += data
+        while top < header.height and len(pending) >= min(rows, header.height - top) * stride:
+            count = min(rows, header.height - top)
+            strip, previous = _png_strip(header, bytes(pending[:count * stride]), count, previous)
+            del pending[:count * stride]
+            top += count
+            yield strip
+    if top < header.height:
+        raise ValueError("PNG 文件不完整")
+
+
+def _pil_strips(img, rows):
+    with img:
+        width, height = img.size
+        for top in range(0, height, rows):
+            yield np.asarray(img.crop((0, top, width, min(height, top + rows))).convert('RGB'))
+
+
+def _closing(strips, f):
+    try:
+        yield from strips
+    finally:
+        if f is not None:
+            f.close()
+
+
+def decode_strips(source, rows):
+    """从上到下按每条 rows 行解码成 RGB 数组，返回 ((宽, 高), 各条数组的迭代器)
+
+    source 为路径或文件对象。8 位、非隔行的 PNG 边读边解压，同时只有一条在内存里；
+    其他图片 (JPEG、隔行或 16 位的 PNG 等) 由 PIL 整张解码一次再分条返回
+    """
+    own = isinstance(source, (str, os.PathLike))
+    f = open(source, 'rb') if own else source
+    try:
+        header = _png_header(f)
+        if header is not None:
+            return (header.width, header.height), _closing(_png_strips(f, header, rows), f if own else None)
+        img = Image.open(f)
+        img.load()
+    except BaseException:
+        if own:
+            f.close()
+        raise
+    if own:
+        f.close()
+    return img.size, _pil_strips(img, rows)
@@ -0,0 +1,498 @@
+# -*- coding: utf-8 -*-
+"""
+格子区域和格子数量检测
+"""
+
+from collections import namedtuple
+
+import cv2
+import numpy as np
+
+from .grid import cell_edges
+
+
+GridGuess = namedtuple('GridGuess', ['cols', 'rows', 'v_lines', 'h_lines'])
+
+# 格子数检测方法：periodic 为投影周期 (自相关)，hough 为霍夫直线
+GRID_METHODS = ('periodic', 'hough')
+DEFAULT_GRID_METHOD = 'periodic'
+
+# 自动检测区域的置信度低于此值时需要人工确认
+LOW_CONFIDENCE = 0.3
+
+# 自动检测的格子数上限，也是界面上行列数的上限 (霍夫直线另外限制在 5~200)
+MAX_GRID = 300
+
+# 格子边界对齐网格线：在均分位置 ± 格子边长 × SNAP_RADIUS 内找线，线的覆盖比例
+# 不低于 SNAP_MIN_STRENGTH 才算网格线，一半以上的边界找到线才对齐这个方向
+SNAP_RADIUS = 0.25
+SNAP_MIN_STRENGTH = 0.5
+# 计算投影时每次转灰度的行数，超大图纸 (磁盘映射) 也只占用这么多行的内存
+SNAP_CHUNK_ROWS = 256
+
+
+def default_region(width, height):
+    """基于典型布局估计格子区域 (x1, y1, x2, y2)"""
+    return (int(width * 0.025), int(height * 0.035),
+            int(width * 0.975), int(height * 0.83))
+
+
+def cluster_lines(lines, threshold=5):
+    """聚类去重（合并相近的线）"""
+    if not lines:
+        return []
+    lines = sorted(lines)
+    clusters = [[lines[0]]]
+    for line in lines[1:]:
+        if line - clusters[-1][-1] < threshold:
+            clusters[-1].append(line)
+        else:
+            clusters.append([line])
+    return [sum(c) // len(c) for c in clusters]
+
+
+def detect_grid_size_hough(img_array, region):
+    """用霍夫直线检测估计格子数量，检测不到直线时返回 None"""
+    x1, y1, x2, y2 = region
+    crop = img_array[y1:y2, x1:x2]
+
+    gray = _to_gray(crop)
+
+    # 边缘检测
+    edges = cv2.Canny(gray, 30, 100)
+
+    # 检测直线
+    lines = cv2.HoughLinesP(edges, 1, np.pi/180, threshold=30, minLineLength=20, maxLineGap=5)
+
+    if lines is None:
+        return None
+
+    h_lines = []  # 水平线的y坐标
+    v_lines = []  # 垂直线的x坐标
+
+    for x1_l, y1_l, x2_l, y2_l in lines.reshape(-1, 4):
+        # 判断是水平线还是垂直线
+        if abs(y2_l - y1_l) < 3:  # 水平线
+            h_lines.append((y1_l + y2_l) // 2)
+        elif abs(x2_l - x1_l) < 3:  # 垂直线
+            v_lines.append((x1_l + x2_l) // 2)
+
+    h_unique = cluster_lines(h_lines, threshold=8)
+    v_unique = cluster_lines(v_lines, threshold=8)
+
+    # 估计格子数
+    region_height = y2 - y1
+    region_width = x2 - x1
+
+    # 方法1：根据检测到的线条数量
+    detected_rows = max(1, len(h_unique) - 1)
+    detected_cols = max(1, len(v_unique) - 1)
+
+    # 方法2：根据线条间距估计
+    if len(h_unique) >= 3:
+        h_gaps = [h_unique[i+1] - h_unique[i] for i in range(len(h_unique)-1)]
+        avg_h_gap = sum(h_gaps) / len(h_gaps)
+        estimated_rows = round(region_height / avg_h_gap) if avg_h_gap > 5 else detected_rows
+    else:
+        estimated_rows = detected_rows
+
+    if len(v_unique) >= 3:
+        v_gaps = [v_unique[i+1] - v_unique[i] for i in range(len(v_unique)-1)]
+        avg_v_gap = sum(v_gaps) / len(v_gaps)
+        estimated_cols = round(region_width / avg_v_gap) if avg_v_gap > 5 else detected_cols
+    else:
+        estimated_cols = detected_cols
+
+    # 选择更合理的值
+    final_cols = estimated_cols if 5 < estimated_cols < 200 else detected_cols
+    final_rows = estimated_rows if 5 < estimated_rows < 200 else detected_rows
+
+    # 确保在合理范围内
+    final_cols = max(5, min(200, final_cols))
+    final_rows = max(5, min(200, final_rows))
+
+    return GridGuess(final_cols, final_rows, len(v_unique), len(h_unique))
+
+
+RegionGuess = namedtuple('RegionGuess', ['x1', 'y1', 'x2', 'y2', 'confidence'])
+
+
+def _to_gray(img_array):
+    if img_array.ndim == 2:
+        return img_array
+    return cv2.cvtColor(np.ascontiguousarray(img_array), cv2.COLOR_RGB2GRAY)
+
+
+def _line_profile(gray, axis, threshold=12):
+    """直线强度投影：axis=0 时为每行水平线的覆盖比例，axis=1 时为每列垂直线的覆盖比例"""
+    gray = gray.astype(np.int16)
+    if axis == 0:
+        edges = np.abs(np.diff(gray, axis=0)) > threshold
+        strength = edges.mean(axis=1)
+    else:
+        edges = np.abs(np.diff(gray, axis=1)) > threshold
+        strength = edges.mean(axis=0)
+    # 细线两侧各有一条边缘，合并到线所在的位置
+    profile = np.zeros(len(strength) + 1)
+    profile[:-1] = strength
+    profile[1:] = np.maximum(profile[1:], strength)
+    return profile
+
+
+def _estimate_pitch(profile, min_pitch=4, max_pitch=None):
+    """用自相关估计投影的周期 (格子边长)，找不到时返回 None"""
+    n = len(profile)
+    max_pitch = max_pitch or n // 3
+    if max_pitch <= min_pitch:
+        return None
+    centered = profile - profile.mean()
+    energy = float(np.dot(centered, centered))
+    if energy <= 0:
+        return None
+    size = 1 << int(np.ceil(np.log2(2 * n)))
+    spectrum = np.fft.rfft(centered, size)
+    acf = np.fft.irfft(spectrum * np.conj(spectrum), size)[:n] / energy
+
+    lags = np.arange(min_pitch, min(max_pitch, n - 2) + 1)
+    local_max = (acf[lags] >= acf[lags - 1]) & (acf[lags] >= acf[lags + 1]) & (acf[lags] > 0)
+    candidates = lags[local_max]
+    if len(candidates) == 0:
+        return None
+    # 取第一个足够高的峰，避免把两倍、三倍周期当成格子边长
+    best = acf[candidates].max()
+    lag = int(candidates[np.argmax(acf[candidates] >= best * 0.7)])
+    peak = float(acf[lag])
+    pitch = _parabolic_peak(acf, lag)
+
+    # 用 k 倍周期处的自相关峰细化周期，k 越大误差越小
+    k = 2
+    while k * pitch < n * 0.6:
+        center = int(round(k * pitch))
+        radius = max(2, int(pitch * 0.15))
+        lo, hi = max(1, center - radius), min(n - 2, center + radius)
+        if hi <= lo:
+            break
+        lag_k = lo + int(np.argmax(acf[lo:hi + 1]))
+        if acf[lag_k] < peak * 0.3:
+            break
+        pitch = _parabolic_peak(acf, lag_k) / k
+        k *= 2
+    return pitch, peak
+
+
+def _parabolic_peak(values, i):
+    """抛物线插值得到亚像素峰位置"""
+    y0, y1, y2 = values[i - 1], values[i], values[i + 1]
+    denom = y0 - 2 * y1 + y2
+    offset = 0.5 * (y0 - y2) / denom if denom < 0 else 0.0
+    return i + float(np.clip(offset, -0.5, 0.5))
+
+
+def _comb_span(profile, pitch, max_missing=1):
+    """按周期找出网格线 (梳状采样)，返回最长连续一段线的 (起点, 终点, 置信度, 线数)
+
+    允许中间最多连续漏掉 max_missing 条线，找不到至少 3 条线时返回 None
+    """
+    n = len(profile)
+    teeth_count = int((n - 1) // pitch) + 1
+    if teeth_count < 3:
+        return None
+
+    # 找相位：梳齿上 (±1 像素内) 的强度之和最大
+    padded = np.concatenate([profile, np.zeros(int(np.ceil(pitch)) + 2)])
+    local = np.maximum(np.maximum(padded[:-2], padded[1:-1]), padded[2:])
+    local = np.concatenate([[max(padded[0], padded[1])], local])
+    ks = np.arange(teeth_count + 1)
+    best_phase, best_score = 0, -1.0
+    for phase in range(int(np.ceil(pitch))):
+        pos = np.round(phase + ks * pitch).astype(np.int64)
+        score = local[pos[pos < n]].sum()
+        if score > best_score:
+            best_phase, best_score = phase, score
+
+    pos = np.round(best_phase + ks * pitch).astype(np.int64)
+    pos = pos[pos < n]
+    # 每个梳齿在 ±1 像素内取最强的位置
+    lo = np.maximum(pos - 1, 0)
+    window = np.stack([profile[np.minimum(lo + d, n - 1)] for d in range(3)], axis=1)
+    pos = lo + np.argmax(window, axis=1)
+    strength = profile[pos]
+
+    ref = np.percentile(strength, 90)
+    if ref <= 0:
+        return None
+    is_line = strength >= ref * 0.6
+
+    best = None
+    start = None
+    missing = 0
+    last = None
+    for i, hit in enumerate(np.append(is_line, False)):
+        if hit:
+            if start is None:
+                start = i
+            last = i
+            missing = 0
+        elif start is not None:
+            missing += 1
+            if missing > max_missing or i == len(is_line):
+                if best is None or last - start > best[1] - best[0]:
+                    best = (start, last)
+                start = None
+                missing = 0
+    if best is None or best[1] - best[0] < 2:
+        return None
+
+    first, last = best
+    # 两端与主体之间隔着漏线的多半是坐标轴文字或色卡，去掉
+    while last - first >= 2 and not is_line[first + 1]:
+        first += 2
+        while not is_line[first]:
+            first += 1
+    while last - first >= 2 and not is_line[last - 1]:
+        last -= 2
+        while not is_line[last]:
+            last -= 1
+    if last - first < 2:
+        return None
+    lines = pos[first:last + 1][is_line[first:last + 1]]
+    # 置信度：线与线之间的对比度 × 链上线的完整程度
+    between = np.ones(n, dtype=bool)
+    for d in (-1, 0, 1):
+        between[np.clip(pos[first:last + 1] + d, 0, n - 1)] = False
+    between[:pos[first]] = False
+    between[pos[last] + 1:] = False
+    background = float(np.median(profile[between])) if between.any() else 0.0
+    on_line = float(np.median(profile[lines]))
+    contrast = max(0.0, (on_line - background) / on_line) if on_line > 0 else 0.0
+    completeness = len(lines) / (last - first + 1)
+    return int(pos[first]), int(pos[last]), contrast * completeness, len(lines)
+
+
+def _periodic_span(profile):
+    """估计周期并找出网格线范围，返回 (起点, 终点, 置信度, 周期) 或 None"""
+    estimate = _estimate_pitch(profile)
+    if estimate is None:
+        return None
+    pitch, acf_peak = estimate
+    span = _comb_span(profile, pitch)
+    if span is None:
+        return None
+    start, end, confidence, _ = span
+    return start, end, confidence * min(1.0, acf_peak * 2), pitch
+
+
+def _refine_edge(img_array, pos, axis, radius, span):
+    """在原图分辨率下，在 pos 附近找直线最强 (并列时最暗) 的一行/列作为边界"""
+    lo = max(0, pos - radius)
+    if axis == 0:
+        hi = min(img_array.shape[0], pos + radius + 1)
+        window = img_array[lo:hi, span[0]:span[1]]
+    else:
+        hi = min(img_array.shape[1], pos + radius + 1)
+        window = img_array[span[0]:span[1], lo:hi]
+    if window.size == 0 or window.shape[axis] < 2:
+        return pos
+    window = _to_gray(window)
+    profile = _line_profile(window, axis)
+    means = window.mean(axis=1 - axis)
+    strong = profile >= profile.max() * 0.9
+    return lo + int(np.argmin(np.where(strong, means, np.inf)))
+
+
+def detect_region(img_array, max_side=800):
+    """根据直线投影自动检测格子区域
+
+    在缩小的灰度图上找出间距一致的水平线和垂直线，取最外侧的线作为格子边界，
+    再在原图分辨率下只对边界附近做精修。返回 RegionGuess，confidence 在 0~1 之间，
+    检测失败时退回典型布局，confidence 为 0。
+    """
+    height, width = img_array.shape[:2]
+    gray = _to_gray(img_array)
+
+    scale = min(1.0, max_side / max(width, height))
+    if scale < 1.0:
+        small = cv2.resize(gray, (max(1, int(width * scale)), max(1, int(height * scale))),
+                           interpolation=cv2.INTER_AREA)
+    else:
+        small = gray
+    sh, sw = small.shape[:2]
+
+    # 第一遍在整张图上找，第二遍只在第一遍找到的范围内投影，线的对比更明显
+    x_span, y_span = (0, sw), (0, sh)
+    found = None
+    for _ in range(2):
+        rows = _periodic_span(_line_profile(small[:, x_span[0]:x_span[1]], 0))
+        cols = _periodic_span(_line_profile(small[y_span[0]:y_span[1], :], 1))
+        if rows is None or cols is None:
+            break
+        found = (cols, rows)
+        x_span = (cols[0], cols[1] + 1)
+        y_span = (rows[0], rows[1] + 1)
+
+    if found is None:
+        return RegionGuess(*default_region(width, height), 0.0)
+
+    (sx1, sx2, x_conf, _), (sy1, sy2, y_conf, _) = found
+    x1, x2 = int(round(sx1 / scale)), int(round(sx2 / scale))
+    y1, y2 = int(round(sy1 / scale)), int(round(sy2 / scale))
+
+    # 只在边界附近用原图精修
+    refined = refine_region(gray, (x1, y1, x2, y2), int(np.ceil(2 / scale)) + 1)
+    if refined is None:
+        return RegionGuess(*default_region(width, height), 0.0)
+    return RegionGuess(*refined, round(min(x_conf, y_conf), 3))
+
+
+def refine_region(img_array, region, radius):
+    """把区域的四条边界分别移到 radius 像素内直线最强的位置，边界交叉时返回 None
+
+    只把边界附近的窄条转灰度，磁盘映射的超大图纸也不会整张读进内存
+    """
+    x1, y1, x2, y2 = region
+    x1r = _refine_edge(img_array, x1, 1, radius, (y1, y2))
+    x2r = _refine_edge(img_array, x2, 1, radius, (y1, y2))
+    y1r = _refine_edge(img_array, y1, 0, radius, (x1, x2))
+    y2r = _refine_edge(img_array, y2, 0, radius, (x1, x2))
+    if x2r <= x1r or y2r <= y1r:
+        return None
+    return x1r, y1r, x2r, y2r
+
+
+def _line_starts(edges, axis):
+    """每个位置是一条线的起点的比例：左 (上) 侧有边缘，且右 (下) 侧隔 1~2 个像素内也有边缘
+
+    edges 为相邻像素之间是否有边缘；只有一侧有边缘的是两种颜色格子的交界，不算线
+    """
+    n = edges.shape[axis] + 1
+    starts = np.zeros(n)
+    if n < 4:
+        return starts
+    take = (lambda a, b: edges[a:b]) if axis == 0 else (lambda a, b: edges[:, a:b])
+    hits = take(0, n - 3) & (take(1, n - 2) | take(2, n - 1))
+    starts[1:n - 2] = hits.sum(axis=1 - axis)
+    return starts
+
+
+def _region_profiles(img_array, region, threshold=12, chunk_rows=SNAP_CHUNK_ROWS):
+    """格子区域内每列是竖线起点、每行是横线起点的比例 (列方向, 行方向)
+
+    按行分块转灰度，不需要整个区域的灰度图
+    """
+    x1, y1, x2, y2 = region
+    cols = np.zeros(x2 - x1)
+    rows = np.zeros(y2 - y1)
+    previous = None
+    for top in range(y1, y2, chunk_rows):
+        gray = _to_gray(img_array[top:min(top + chunk_rows, y2), x1:x2]).astype(np.int16)
+        cols += _line_starts(np.abs(np.diff(gray, axis=1)) > threshold, 1)
+        # 接上上一块的最后三行，块之间的线也不漏 (每个位置要看前一行和后两行)
+        block = gray if previous is None else np.concatenate([previous, gray])
+        start = top - y1 - (0 if previous is None else len(previous))
+        starts = _line_starts(np.abs(np.diff(block, axis=0)) > threshold, 0)
+        rows[start + 1:start + len(block) - 2] = starts[1:len(block) - 2]
+        previous = block[-3:]
+    return cols / (y2 - y1), rows / (x2 - x1)
+
+
+def _snap_axis(profile, count):
+    """把均分的格子边界 (相对区域起点) 移到附近最明显的网格线上，同样明显时取离均分位置近的
+
+    两端不动；找到线的边界不到一半时 (没有画线的图纸) 返回 None
+    """
+    size = len(profile)
+    edges = cell_edges(0, size, count)
+    radius = int(size / count * SNAP_RADIUS)
+    if count < 2 or radius < 1:
+        return None
+    offsets = np.arange(-radius, radius + 1)
+    window = np.clip(edges[1:-1, None] + offsets, 1, size - 1)
+    strength = profile[window]
+    found = strength.max(axis=1) >= SNAP_MIN_STRENGTH
+    if found.mean() < 0.5:
+        return None
+    best = window[np.arange(len(window)), np.argmax(strength - np.abs(offsets) * 1e-6, axis=1)]
+    edges[1:-1] = np.where(found, best, edges[1:-1])
+    if not (np.diff(edges) > 0).all():
+        return None
+    return edges
+
+
+def snap_grid_edges(img_array, region, cols, rows):
+    """格子边界表：把均分的格子边界对齐到附近检测到的网格线上
+
+    均分时格子边长不是整数，边界会和实际的网格线差一两个像素，镜像后网格线错位。
+    返回 (x_edges, y_edges) 两个整数元组，长度分别为 cols+1、rows+1；
+    检测不到网格线的方向保持均分 (与 grid.cell_edges 相同)
+    """
+    x1, y1, x2, y2 = region
+    col_profile, row_profile = _region_profiles(img_array, region)
+    result = []
+    for start, end, count, profile in ((x1, x2, cols, col_profile), (y1, y2, rows, row_profile)):
+        edges = _snap_axis(profile, count)
+        edges = cell_edges(start, end, count) if edges is None else edges + start
+        result.append(tuple(int(v) for v in edges))
+    return tuple(result)
+
+
+def _pyramid_pitch(levels, axis, min_pitch):
+    """从最粗的一层往细找格子边长 (原图像素)，并返回该层的投影和层内边长
+
+    缩得太小时细线会糊掉，自相关可能锁定到每 5 格一条的粗线上，所以某层的估计
+    要和上一层 (更粗) 的估计一致 (正好两倍) 且不小于 min_pitch 才采用。
+    """
+    full = levels[0].shape[axis]
+    previous = None
+    result = None
+    for level in reversed(levels):
+        profile = _line_profile(level, axis)
+        estimate = _estimate_pitch(profile)
+        if estimate is None:
+            previous = None
+            continue
+        pitch = estimate[0]
+        result = (pitch * full / level.shape[axis], profile, pitch)
+        if previous is not None and pitch >= min_pitch and abs(pitch - 2 * previous) <= 0.1 * pitch:
+            break
+        previous = pitch
+    return result
+
+
+def detect_grid_size_periodic(img_array, region, max_side=600, min_pitch=8):
+    """根据投影的周期估计格子数量，检测失败时返回 None
+
+    先把格子区域用图像金字塔缩小到 max_side 以内，在一维投影上做自相关得到格子边长，
+    只有缩小后看不清格子时才用更清晰的一层。
+    """
+    x1, y1, x2, y2 = region
+    gray = _to_gray(img_array[y1:y2, x1:x2])
+    if gray.size == 0:
+        return None
+
+    levels = [gray]
+    while max(levels[-1].shape) > max_side and min(levels[-1].shape) > 32:
+        levels.append(cv2.pyrDown(levels[-1]))
+
+    found = []
+    for axis in (1, 0):
+        estimate = _pyramid_pitch(levels, axis, min_pitch)
+        if estimate is None:
+            return None
+        found.append(estimate)
+
+    (col_pitch, col_profile, col_level_pitch), (row_pitch, row_profile, row_level_pitch) = found
+    cols = max(1, min(MAX_GRID, int(round((x2 - x1) / col_pitch))))
+    rows = max(1, min(MAX_GRID, int(round((y2 - y1) / row_pitch))))
+
+    v_span = _comb_span(col_profile, col_level_pitch)
+    h_span = _comb_span(row_profile, row_level_pitch)
+    return GridGuess(cols, rows, v_span[3] if v_span else 0, h_span[3] if h_span else 0)
+
+
+def detect_grid_size(img_array, region, method=DEFAULT_GRID_METHOD):
+    """自动检测格子数量，method 见 GRID_METHODS，检测失败时返回 None"""
+    if method == 'hough':
+        return detect_grid_size_hough(img_array, region)
+    if method == 'periodic':
+        return detect_grid_size_periodic(img_array, region)
+    raise ValueError(f"未知的检测方法: {method}")
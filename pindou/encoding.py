@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+输出编码
+几种预设的输出格式，编码都是无损的 (JPEG 除外)：
+  png          PIL 默认压缩级别，兼容性最好
+  png-fast     压缩级别 1，体积稍大，编码快一倍左右
+  png-palette  颜色不超过 256 种时存成调色板 PNG (拼豆图纸通常只有几十种颜色)，
+               体积小很多；颜色太多时退回 png
+  webp         无损 WebP，用最快的压缩参数
+  jpeg         有损，质量 95
+"""
+
+import os
+from dataclasses import dataclass, field
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+
+# 调色板先从抽样的像素中统计，再检查所有像素都在其中 (不在时才全量统计)
+PALETTE_SAMPLE_STEP = 97
+PALETTE_COLORS = 256
+
+
+@dataclass(frozen=True)
+class OutputFormat:
+    """一种输出格式"""
+    label: str
+    extension: str
+    mime: str
+    pil_format: str
+    params: dict = field(default_factory=dict)
+    palette: bool = False  # 颜色足够少时存成调色板图
+
+
+OUTPUT_FORMATS = {
+    'png': OutputFormat("PNG", '.png', 'image/png', 'PNG'),
+    'png-fast': OutputFormat("PNG (快速压缩)", '.png', 'image/png', 'PNG', {'compress_level': 1}),
+    'png-palette': OutputFormat("PNG (调色板，体积小)", '.png', 'image/png', 'PNG', palette=True),
+    'webp': OutputFormat("WebP (无损)", '.webp', 'image/webp', 'WEBP', {'lossless': True, 'quality': 0, 'method': 0}),
+    'jpeg': OutputFormat("JPEG (有损)", '.jpg', 'image/jpeg', 'JPEG', {'quality': 95}),
+}
+
+DEFAULT_OUTPUT_FORMAT = 'png'
+
+# 保存对话框里按扩展名选格式 (.png 用调用方给的默认值)
+EXTENSION_FORMATS = {'.webp': 'webp', '.jpg': 'jpeg', '.jpeg': 'jpeg'}
+
+
+def output_format(name):
+    """按名称找到输出格式 (不区分大小写，也接受 'PNG'、'JPG' 等)，找不到时抛出 ValueError"""
+    key = name.lower()
+    key = EXTENSION_FORMATS.get('.' + key, key) if key in ('jpg', 'jpeg') else key
+    if key not in OUTPUT_FORMATS:
+        raise ValueError(f"不支持的输出格式: {name}")
+    return OUTPUT_FORMATS[key]
+
+
+def format_for_path(path, default=DEFAULT_OUTPUT_FORMAT):
+    """按文件扩展名选择输出格式，.png 和未知扩展名用 default"""
+    ext = os.path.splitext(path)[1].lower()
+    return EXTENSION_FORMATS.get(ext, default)
+
+
+def palette_image(array, max_colors=PALETTE_COLORS):
+    """颜色不超过 max_colors 种时返回逐像素不变的调色板 PIL 图片，否则返回 None"""
+    packed = (array[..., 0].astype(np.uint32) << 16 | array[..., 1].astype(np.uint32) << 8
+              | array[..., 2]).ravel()
+    colors = np.unique(packed[::PALETTE_SAMPLE_STEP])
+    if len(colors) > max_colors:
+        return None
+    index = np.minimum(np.searchsorted(colors, packed), len(colors) - 1)
+    if not np.array_equal(colors[index], packed):
+        colors = np.unique(packed)
+        if len(colors) > max_colors:
+            return None
+        index = np.searchsorted(colors, packed)
+    index = index.astype(np.uint8).reshape(array.shape[:2])
+    image = Image.fromarray(index, 'P')
+    image.putpalette(np.stack([colors >> 16, colors >> 8 & 255, colors & 255], axis=1).astype(np.uint8).tobytes())
+    return image
+
+
+def encode_image(array, fmt='PNG'):
+    """把结果数组编码成图片字节，fmt 为 OUTPUT_FORMATS 中的名称或 PIL 格式名"""
+    buf = BytesIO()
+    save_image(array, buf, fmt)
+    return buf.getvalue()
+
+
+def save_image(array, target, fmt='PNG'):
+    """把结果数组 (或 RGB PIL 图片) 按输出格式写入路径或文件对象"""
+    fmt = output_format(fmt)
+    array = np.asarray(array)
+    image = palette_image(array) if fmt.palette else None
+    if image is None:
+        if fmt.palette:
+            fmt = OUTPUT_FORMATS[DEFAULT_OUTPUT_FORMAT]
+        image = Image.fromarray(array)
+    image.save(target, format=fmt.pil_format, **fmt.params)
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+"""
+格子边界计算
+"""
+
+import numpy as np
+
+
+def cell_edges(start, end, count):
+    """计算格子边界，返回长度为 count+1 的整数数组
+
+    与逐格循环中的 int(x1 + col * cell_width) 完全一致
+    """
+    cell_size = (end - start) / count
+    return (start + np.arange(count + 1) * cell_size).astype(np.int64)
+
+
+def row_bands(edges, max_height):
+    """把格子行分成若干条，返回 (起始行, 结束行) 列表
+
+    每条高度不超过 max_height 像素，但至少包含一行格子
+    """
+    bands = []
+    count = len(edges) - 1
+    start = 0
+    while start < count:
+        end = start + 1
+        while end < count and edges[end + 1] - edges[start] <= max_height:
+            end += 1
+        bands.append((start, end))
+        start = end
+    return bands
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+增量处理
+保存上一次处理的中间结果，参数只变了一部分时只重算受影响的部分。
+每个中间结果按它依赖的参数做键:
+  解码后的数组      ← 图片对象
+  去水印后的格子    ← 图片 + 列边界 (x1, x2, 列数) + 这一行格子的上下边界，按格子行缓存
+  镜像映射          ← 每个方向的 (起点, 终点, 格子数) 分开缓存 (见 mirror.axis_map)
+  处理结果          ← 以上全部 + 处理选项
+因此切换去水印、只改行数或上下边界时，已经去过水印的格子行直接复用；
+参数完全不变时直接返回上一次的结果。
+"""
+
+import threading
+from collections import OrderedDict
+from dataclasses import astuple, replace
+
+import numpy as np
+
+from .pipeline import (
+    PREVIEW_SIDE, Job, ProcessOptions, detect, encode, load_image, mirror,
+    normalize_region, preview_factor, reduce_image, run_bands, run_stages, scale_region,
+)
+from .timing import StageTimer, dedup_context
+from .watermark import CellCache, remove_watermark_grid
+
+
+# 去水印格子行缓存的默认上限
+DEFAULT_CACHE_BYTES = 256 * 1024 * 1024
+
+
+class Reprocessor:
+    """对同一张图片反复处理，复用中间结果 (线程安全，同一时间只处理一个任务)"""
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.lock = threading.RLock()
+        self.source = None
+        self.array = None
+        self.rows = OrderedDict()  # (各列边界..., 上边界, 下边界) → 去水印后的一行格子
+        self.row_bytes = 0
+        self.last = None  # (参数, Job)
+        self.edges = {}  # (区域, 格子数, 是否对齐网格线) → 格子边界表
+        self.proxies = {}  # 缩小倍数 → (代理图, 代理图的 Reprocessor)
+
+    def reset(self, image):
+        """换了一张图片，丢弃所有中间结果"""
+        self.source = image
+        self.array = None
+        self.rows.clear()
+        self.row_bytes = 0
+        self.last = None
+        self.edges.clear()
+        self.proxies.clear()
+
+    def decode(self, job):
+        """阶段1：解码 (同一张图片只解码一次)"""
+        if self.array is None:
+            self.array = load_image(job.source)
+        job.array = self.array
+        return job
+
+    def dewatermark(self, job):
+        """阶段3：去水印，已经处理过的格子行直接复用"""
+        if not job.options.remove_watermark or job.options.mode == 'matrix':
+            return job
+        x_edges, y_edges = job.mirror_map.x_edges, job.mirror_map.y_edges
+        x1, y1, x2, y2 = job.mirror_map.bounds
+        column_key = tuple(int(v) for v in x_edges)
+
+        def key(row):
+            return column_key + (int(y_edges[row]), int(y_edges[row + 1]))
+
+        cleaned = np.empty((y2 - y1, x2 - x1, 3), dtype=np.uint8)
+        # 多线程时各条并发读写 self.rows，只在查找和存入时加锁，去水印本身不加锁
+        rows_lock = threading.Lock()
+        cache = CellCache()
+
+        def clean(start, end):
+            computed = 0
+            stats = {}
+            row = start
+            while row < end:
+                with rows_lock:
+                    cached = key(row) in self.rows
+                if cached:
+                    row += 1
+                    continue
+                # 连续缺失的几行一次算完
+                run_end = row + 1
+                with rows_lock:
+                    while run_end < end and key(run_end) not in self.rows:
+                        run_end += 1
+                block = remove_watermark_grid(job.array, x_edges, y_edges[row:run_end + 1], stats=stats, cache=cache)
+                with rows_lock:
+                    for r in range(row, run_end):
+                        part = block[y_edges[r] - y_edges[row]:y_edges[r + 1] - y_edges[row]]
+                        self.rows[key(r)] = part
+                        self.row_bytes += part.nbytes
+                computed += run_end - row
+                row = run_end
+            with rows_lock:
+                for r in range(start, end):
+                    cleaned[y_edges[r] - y1:y_edges[r + 1] - y1] = self.rows[key(r)]
+                    self.rows.move_to_end(key(r))
+            return computed, stats
+
+        results = run_bands(job, 'dewatermark', clean)
+        computed = sum(count for count, _ in results)
+        reused = len(y_edges) - 1 - computed
+
+        while self.row_bytes > self.max_bytes and len(self.rows) > 1:
+            _, part = self.rows.popitem(last=False)
+            self.row_bytes -= part.nbytes
+        job.cleaned = cleaned
+        job.timer.context.update(rows_reused=reused, rows_computed=computed,
+                                 **dedup_context(*(stats for _, stats in results)))
+        return job
+
+    def process(self, image, region, grid, options=None, progress=None, cancel=None):
+        """和 pipeline.process() 结果相同，但复用上一次的中间结果
+
+        image 需要是同一个对象才算同一张图片 (通常是界面里保存的 PIL 图片)
+        """
+        # 解码出的原图要反复使用，结果不能写回原图
+        options = replace(options or ProcessOptions(), in_place=False)
+        with self.lock:
+            if image is not self.source:
+                self.reset(image)
+            # 线程数不影响结果
+            params = (normalize_region(region), tuple(int(v) for v in grid), astuple(replace(options, threads=1)))
+            if self.last is not None and self.last[0] == params:
+                # 参数完全不变：返回上一次的结果，计时从零开始 (调用方可能继续往里加阶段)
+                job = self.last[1]
+                return replace(job, timer=StageTimer(**job.timer.context, cached=True))
+
+            edges_key = params[:2] + (options.snap_edges,)
+            job = Job(image, region=params[0], grid=params[1], options=options, timer=StageTimer(),
+                      progress=progress, cancel=cancel, edges=self.edges.get(edges_key))
+            run_stages(job, (self.decode, detect, self.dewatermark, mirror, encode))
+            job.progress = job.cancel = None
+            self.edges[edges_key] = job.edges
+            self.last = (params, job)
+            return job
+
+    def preview(self, image, region, grid, options=None, max_side=PREVIEW_SIDE, progress=None, cancel=None):
+        """在缩小的代理图上跑完整流程，用于调参时快速预览，代理图和它的中间结果也会复用
+
+        区域按同样的倍数缩小，格子数不变；返回的 Job 中 downscale 为缩小倍数，
+        结果只用来看效果，保存时应该用 process() 重新处理原图
+        """
+        with self.lock:
+            if image is not self.source:
+                self.reset(image)
+            region = normalize_region(region)
+            grid = tuple(int(v) for v in grid)
+            factor = preview_factor(image.size, region, grid, max_side)
+            if factor == 1:
+                job = self.process(image, region, grid, options, progress, cancel)
+            else:
+                if factor not in self.proxies:
+                    self.proxies[factor] = (reduce_image(image, factor), Reprocessor(self.max_bytes // 4))
+                proxy, reprocessor = self.proxies[factor]
+                job = reprocessor.process(proxy, scale_region(region, factor), grid, options, progress, cancel)
+            job.downscale = factor
+            return job
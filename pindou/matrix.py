@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+色块矩阵模式
+每个格子只采样一次，得到 rows × cols × 3 的颜色矩阵，镜像矩阵后再按格子边界
+重新绘制成纯色格子。核心变换只和格子数有关，矩阵本身也可以作为图案数据复用。
+"""
+
+import numpy as np
+
+
+# 每个格子每个方向最多采样的点数
+MAX_SAMPLES = 6
+# 采样时格子四边各留出的比例，避开网格线
+MARGIN = 0.15
+# 水印像素的量化键，比所有 15 位颜色键都大
+INVALID_KEY = 1 << 15
+
+
+def sample_count(edges, max_samples=MAX_SAMPLES, margin=MARGIN):
+    """每个格子在这个方向上的采样点数 (由最窄的格子决定)"""
+    sizes = np.maximum(np.diff(np.asarray(edges)), 1)
+    pad = np.where(sizes >= 3, np.maximum(1, np.round(sizes * margin)).astype(np.int64), 0)
+    return int(max(1, min(max_samples, np.maximum(sizes - 2 * pad, 1).min())))
+
+
+def _sample_positions(edges, k=None, max_samples=MAX_SAMPLES, margin=MARGIN):
+    """每个格子内部均匀分布的采样坐标，返回 (格子数, k) 的数组"""
+    edges = np.asarray(edges)
+    starts, ends = edges[:-1], edges[1:]
+    sizes = np.maximum(ends - starts, 1)
+    pad = np.where(sizes >= 3, np.maximum(1, np.round(sizes * margin)).astype(np.int64), 0)
+    inner = np.maximum(sizes - 2 * pad, 1)
+    if k is None:
+        k = sample_count(edges, max_samples, margin)
+    offsets = np.floor((np.arange(k) + 0.5)[None, :] * inner[:, None] / k).astype(np.int64)
+    positions = starts[:, None] + pad[:, None] + offsets
+    return np.minimum(positions, np.maximum(ends - 1, starts)[:, None])
+
+
+def sample_cells(img_array, x_edges, y_edges, y_samples=None):
+    """采样每个格子的颜色，返回 rows × cols × 3 的 uint8 矩阵
+
+    每个格子在内部取 k × k 个点 (避开网格线)，去掉灰色水印像素后，
+    取 8 级量化后出现最多的颜色，再对这一组像素取平均，文字和水印都不会影响结果。
+    灰色的格子 (所有采样点都像水印) 直接用全部采样点。
+    只采样部分格子行时，y_samples 传入整张图纸的 sample_count(y_edges)，保证结果一致。
+    """
+    xs = _sample_positions(x_edges)
+    ys = _sample_positions(y_edges, y_samples)
+    rows, ky = ys.shape
+    cols, kx = xs.shape
+
+    samples = img_array[ys.reshape(-1)][:, xs.reshape(-1)]
+    samples = samples.reshape(rows, ky, cols, kx, 3).transpose(0, 2, 1, 3, 4)
+    samples = samples.reshape(rows * cols, ky * kx, 3).astype(np.int32)
+
+    r, g, b = samples[..., 0], samples[..., 1], samples[..., 2]
+    brightness3 = r + g + b
+    diff = np.maximum(np.maximum(np.abs(r - g), np.abs(g - b)), np.abs(r - b))
+    valid = ~((diff < 20) & (brightness3 > 270) & (brightness3 < 630))
+    valid |= ~valid.any(axis=1, keepdims=True)
+
+    # 每个格子出现最多的量化颜色 (次数相同时取量化值小的)：每格的采样点只有几十个，
+    # 按格子逐行排序后数连续相同值的长度，不用对所有采样点做全局 unique
+    quantized = np.where(valid, (r >> 3) << 10 | (g >> 3) << 5 | (b >> 3), INVALID_KEY)
+    ordered = np.sort(quantized, axis=1)
+    index = np.arange(ordered.shape[1])
+    first = np.ones(ordered.shape, dtype=bool)
+    first[:, 1:] = ordered[:, 1:] != ordered[:, :-1]
+    last = np.ones(ordered.shape, dtype=bool)
+    last[:, :-1] = first[:, 1:]
+    run_start = np.maximum.accumulate(np.where(first, index, 0), axis=1)
+    run_end = np.minimum.accumulate(np.where(last, index, len(index))[:, ::-1], axis=1)[:, ::-1]
+    counts = np.where(ordered == INVALID_KEY, 0, run_end - run_start + 1)
+    winner = np.take_along_axis(ordered, counts.argmax(axis=1)[:, None], axis=1)
+
+    # 对属于主色的像素求平均
+    picked = quantized == winner
+    total = (samples * picked[..., None]).sum(axis=1)
+    count = picked.sum(axis=1)[:, None]
+    matrix = np.round(total / np.maximum(count, 1)).astype(np.uint8)
+    return matrix.reshape(rows, cols, 3)
+
+
+def grid_line_color(img_array, x_edges, y_edges):
+    """原图网格线的颜色 (竖线像素的中位数)"""
+    y1, y2 = y_edges[0], y_edges[-1]
+    xs = np.minimum(np.asarray(x_edges), img_array.shape[1] - 1)
+    pixels = img_array[y1:y2, xs].reshape(-1, 3)
+    if len(pixels) == 0:
+        return None
+    return np.median(pixels, axis=0).astype(np.uint8)
+
+
+def render_cells(matrix, x_edges, y_edges, out, grid_color=None, last_row=True):
+    """按格子边界把颜色矩阵画成纯色格子，写入 out 的格子区域
+
+    grid_color 不为 None 时在每条格子边界上画 1 像素的网格线，只画在格子区域内：
+    右边界和下边界的线画在区域的最后一列、最后一行。分条绘制时只有最后一条的 last_row 为真，
+    其他条的下边界是下一条的上边界，由下一条来画
+    """
+    widths = np.diff(x_edges)
+    heights = np.diff(y_edges)
+    x1, y1, x2, y2 = x_edges[0], y_edges[0], x_edges[-1], y_edges[-1]
+    out[y1:y2, x1:x2] = np.repeat(np.repeat(matrix, heights, axis=0), widths, axis=1)
+
+    if grid_color is not None:
+        xs = np.append(x_edges[:-1], x2 - 1)
+        ys = np.append(y_edges[:-1], y2 - 1) if last_row else np.asarray(y_edges[:-1])
+        out[y1:y2, xs] = grid_color
+        out[ys, x1:x2] = grid_color
+    return out
@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+"""
+镜像引擎
+预先算好格子区域内每个目标像素对应的源像素坐标，镜像时只做一次 gather，
+不再逐格切片、拷贝和缩放。映射按 (区域, 列数, 行数, 边界表, 变换) 缓存，同样布局的图纸直接复用。
+边界表对齐网格线后 (见 detect.snap_grid_edges)，对称的两格宽度相同时就是原样搬运，
+只有实际宽度不同的格子才按最近邻缩放。
+
+变换只重排格子，格子本身 (包括里面的文字标注) 保持正向：
+  flip-h      左右翻转 (默认，即镜像)
+  flip-v      上下翻转
+  rotate-180  旋转 180°
+  transpose   转置 (沿主对角线翻转)，只适用于行数和列数相同的格子
+几种变换可以用 + 或逗号连起来按顺序组合 (如 'transpose+flip-h' 为顺时针转 90°)，
+组合后化简为 是否转置 + 是否倒序行 + 是否倒序列，仍然只做一次 gather。
+"""
+
+import re
+from functools import lru_cache
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+from .grid import cell_edges
+
+
+TRANSFORMS = {
+    'flip-h': "左右翻转",
+    'flip-v': "上下翻转",
+    'rotate-180': "旋转 180°",
+    'transpose': "转置 (只适用于方形格子)",
+}
+DEFAULT_TRANSFORM = 'flip-h'
+
+# 各变换作用在 2×2 格子编号上的结果，8 种组合在 2×2 上互不相同，用来化简
+_CELL_OPS = {
+    'flip-h': lambda cells: cells[:, ::-1],
+    'flip-v': lambda cells: cells[::-1],
+    'rotate-180': lambda cells: cells[::-1, ::-1],
+    'transpose': lambda cells: cells.T,
+}
+
+
+def _nearest_offsets(src_size, dst_size):
+    """与 cv2.resize(..., interpolation=cv2.INTER_NEAREST) 相同的源坐标偏移"""
+    if src_size == dst_size:
+        return np.arange(dst_size)
+    ifx = 1.0 / (dst_size / src_size)
+    offsets = np.floor(np.arange(dst_size) * ifx).astype(np.int64)
+    return np.minimum(offsets, src_size - 1)
+
+
+def _axis_index(edges, order):
+    """目标格子 i 取源格子 order[i] 的内容，返回区域内每个目标像素的源坐标
+
+    源格子为空时该格子保持原样，对应坐标为 -1
+    """
+    origin = edges[0]
+    index = np.full(edges[-1] - origin, -1, dtype=np.int64)
+    for dst, src in enumerate(order):
+        dst_start, dst_end = edges[dst] - origin, edges[dst + 1] - origin
+        src_start, src_end = edges[src] - origin, edges[src + 1] - origin
+        if src_end <= src_start or dst_end <= dst_start:
+            continue
+        index[dst_start:dst_end] = src_start + _nearest_offsets(src_end - src_start, dst_end - dst_start)
+    return index
+
+
+def _transform_cells(transposed, reverse_rows, reverse_cols):
+    """化简后的变换作用在 2×2 格子编号上的结果 (先把源格子的行、列倒序，再转置)"""
+    cells = np.arange(4).reshape(2, 2)
+    cells = cells[::-1] if reverse_rows else cells
+    cells = cells[:, ::-1] if reverse_cols else cells
+    return cells.T if transposed else cells
+
+
+@lru_cache(maxsize=None)
+def parse_transform(transform=DEFAULT_TRANSFORM):
+    """把 'flip-h'、'transpose+flip-v' 这样的变换 (或变换名的元组) 化简为 (是否转置, 是否倒序行, 是否倒序列)
+
+    转置时目标第 r 行第 c 列的格子取源第 row_order[c] 行、第 col_order[r] 列，否则取
+    源第 row_order[r] 行、第 col_order[c] 列 (倒序时 order 为倒序)。变换名未知时抛出 ValueError
+    """
+    names = re.split(r'[+,\s]+', transform.strip()) if isinstance(transform, str) else transform
+    names = [name.strip().lower() for name in names if name.strip()]
+    if not names:
+        raise ValueError("没有指定变换")
+    cells = np.arange(4).reshape(2, 2)
+    for name in names:
+        if name not in _CELL_OPS:
+            raise ValueError(f"不支持的变换: {name}，可选 {', '.join(TRANSFORMS)}")
+        cells = _CELL_OPS[name](cells)
+    return next(key for key in np.ndindex(2, 2, 2)
+                if np.array_equal(_transform_cells(*key), cells))
+
+
+def _cross_index(edges, order):
+    """每一列依次是 _axis_index(edges, [src] * 格子数) (所有目标格子都取源格子 src)，src 取遍 order
+
+    返回 (像素数 × len(order)) 的表，和逐个调用 _axis_index 的结果相同
+    """
+    origin = edges[0]
+    sizes = np.diff(edges)
+    cell = np.repeat(np.arange(len(sizes)), sizes)
+    offset = np.arange(edges[-1] - origin) - (edges[cell] - origin)
+    src_sizes = sizes[order]
+    with np.errstate(divide='ignore'):
+        # 和 _nearest_offsets 相同的浮点运算，结果逐位一致
+        ifx = 1.0 / (sizes[cell][:, None] / src_sizes[None, :])
+    index = np.minimum(np.floor(offset[:, None] * ifx).astype(np.int64), src_sizes - 1)
+    index += edges[order] - origin
+    index[:, src_sizes <= 0] = -1
+    return index
+
+
+class MirrorMap:
+    """格子区域的镜像映射 (见 parse_transform，transposed 时格子行列互换)"""
+
+    def __init__(self, x_edges, y_edges, col_index, row_index, col_order, row_order, transposed=False):
+        self.x_edges = x_edges
+        self.y_edges = y_edges
+        self.col_order = col_order  # 目标第 i 列格子取源第 col_order[i] 列 (转置时为目标第 i 行)
+        self.row_order = row_order
+        self.col_index = col_index
+        self.row_index = row_index
+        self.transposed = transposed
+        self.valid_cols = col_index >= 0
+        self.valid_rows = row_index >= 0
+        self.all_valid = bool(self.valid_cols.all() and self.valid_rows.all())
+        self.identity_rows = not transposed and bool(np.array_equal(row_index, np.arange(len(row_index))))
+        for arr in (x_edges, y_edges, col_index, row_index, col_order, row_order,
+                    self.valid_cols, self.valid_rows):
+            arr.setflags(write=False)
+        if transposed:
+            # 转置时源坐标同时取决于目标像素所在的行和列：源行坐标按 (目标像素行, 目标格子列) 查表，
+            # 源列坐标按 (目标格子行, 目标像素列) 查表，gather 时再按格子编号展开
+            count = len(row_order)
+            self.y_source = _cross_index(y_edges, row_order)
+            self.x_source = _cross_index(x_edges, col_order).T
+            self.y_cell = np.repeat(np.arange(count), np.diff(y_edges))
+            self.x_cell = np.repeat(np.arange(count), np.diff(x_edges))
+            self.all_valid = bool((self.y_source >= 0).all() and (self.x_source >= 0).all())
+            for arr in (self.y_source, self.x_source, self.y_cell, self.x_cell):
+                arr.setflags(write=False)
+
+    @property
+    def bounds(self):
+        """格子区域 (x1, y1, x2, y2)"""
+        return int(self.x_edges[0]), int(self.y_edges[0]), int(self.x_edges[-1]), int(self.y_edges[-1])
+
+    def apply(self, region, out):
+        """把 region (格子区域内容) 镜像后写入 out (整张图) 的格子区域"""
+        return self.apply_band(region, self.bounds[1], out, 0, len(self.y_edges) - 1)
+
+    def source_rows(self, row_start, row_end):
+        """目标第 row_start ~ row_end-1 行格子用到的源格子行范围 [start, end)"""
+        src = self.row_order if self.transposed else self.row_order[row_start:row_end]
+        return int(src.min()), int(src.max()) + 1
+
+    def source_cols(self, row_start, row_end):
+        """目标第 row_start ~ row_end-1 行格子用到的源格子列范围 [start, end)"""
+        src = self.col_order[row_start:row_end] if self.transposed else self.col_order
+        return int(src.min()), int(src.max()) + 1
+
+    def permute_cells(self, matrix, row_start=0, row_end=None, src_row=0, src_col=0):
+        """按变换重排 rows × cols 的格子矩阵 (如色块模式的颜色)，返回目标第 row_start ~ row_end-1 行
+
+        matrix 为源格子矩阵中从第 src_row 行、第 src_col 列开始的部分，
+        需覆盖 source_rows() 和 source_cols() 给出的范围
+        """
+        if self.transposed:
+            return matrix[self.row_order - src_row][:, self.col_order[row_start:row_end] - src_col].swapaxes(0, 1)
+        return matrix[self.row_order[row_start:row_end] - src_row][:, self.col_order - src_col]
+
+    def apply_band(self, block, block_top, out, row_start, row_end, block_left=None):
+        """只处理目标第 row_start ~ row_end-1 行格子
+
+        block 为源格子区域中从图片第 block_top 行、第 block_left 列 (默认为格子区域左边界)
+        开始的一块，需覆盖 source_rows() 和 source_cols() 给出的源格子
+        """
+        x1, y1, x2, y2 = self.bounds
+        top, bottom = int(self.y_edges[row_start]) - y1, int(self.y_edges[row_end]) - y1
+        if self.transposed:
+            return self._apply_transposed(block, block_top, x1 if block_left is None else block_left,
+                                          out, top, bottom)
+        rows = self.row_index[top:bottom]
+        valid_rows = rows >= 0
+        src_rows = rows[valid_rows] + (y1 - block_top)
+        target = out[y1 + top:y1 + bottom, x1:x2]
+
+        if valid_rows.all() and self.valid_cols.all():
+            # 逐行 np.take 直接写进输出，比二维花式索引快几倍，也没有整条大小的临时数组
+            for y, src in enumerate(src_rows):
+                np.take(block[src], self.col_index, axis=0, out=target[y])
+            return out
+
+        cols = self.valid_cols
+        target[np.ix_(valid_rows, cols)] = block[np.ix_(src_rows, self.col_index[cols])]
+        return out
+
+    def _apply_transposed(self, block, block_top, block_left, out, top, bottom):
+        """转置时处理目标格子区域的第 top ~ bottom-1 行像素 (相对区域上边界)"""
+        x1, y1, x2, y2 = self.bounds
+        dy, dx = y1 - block_top, x1 - block_left
+        target = out[y1 + top:y1 + bottom, x1:x2]
+        pixels = _pixel_view(block) if self.all_valid else None
+        if pixels is not None:
+            # 每个目标像素行的源像素分散在不同的源行里，按一维像素下标逐行 np.take
+            pixels, step = pixels
+            for y in range(top, bottom):
+                index = (self.y_source[y][self.x_cell] + dy) * step + self.x_source[self.y_cell[y]] + dx
+                np.take(pixels, index, axis=0, out=target[y - top])
+            return out
+        rows = self.y_source[top:bottom][:, self.x_cell]
+        cols = self.x_source[self.y_cell[top:bottom]]
+        valid = (rows >= 0) & (cols >= 0)
+        target[valid] = block[rows[valid] + dy, cols[valid] + dx]
+        return out
+
+
+def _pixel_view(block):
+    """把 H × W × 3 的 block 看成一维像素数组 (行之间跳过的像素也算在内)，返回 (视图, 每行的像素跨度)
+
+    block 不是逐像素紧密存放 (如通道不连续、行跨度为负) 时返回 None
+    """
+    height, width, channels = block.shape
+    row_stride, pixel_stride, channel_stride = block.strides
+    if (height == 0 or channel_stride != block.itemsize or pixel_stride != channels * channel_stride
+            or row_stride <= 0 or row_stride % pixel_stride):
+        return None
+    step = row_stride // pixel_stride
+    return as_strided(block, shape=((height - 1) * step + width, channels),
+                      strides=(pixel_stride, channel_stride), writeable=False), step
+
+
+@lru_cache(maxsize=64)
+def axis_map(start, end, count, reverse, edges=None):
+    """一个方向上的 (格子边界, 格子顺序, 像素坐标映射)，reverse 为真时倒序
+
+    edges 为格子边界表 (长度 count+1 的整数元组)，默认均分。
+    两个方向分开缓存，只改行数或上下边界时列方向的映射直接复用
+    """
+    if edges is None:
+        edges = cell_edges(start, end, count)
+    else:
+        edges = np.array(edges, dtype=np.int64)
+        if len(edges) != count + 1 or edges[0] != start or edges[-1] != end or (np.diff(edges) <= 0).any():
+            raise ValueError("格子边界表和格子区域不一致")
+    order = np.arange(count - 1, -1, -1) if reverse else np.arange(count)
+    index = _axis_index(edges, order)
+    for arr in (edges, order, index):
+        arr.setflags(write=False)
+    return edges, order, index
+
+
+@lru_cache(maxsize=32)
+def build_mirror_map(x1, y1, x2, y2, cols, rows, x_edges=None, y_edges=None, transform=DEFAULT_TRANSFORM):
+    """格子重排的映射，默认水平镜像：第 col 列的格子移到第 cols-1-col 列，行不变
+
+    x_edges、y_edges 为格子边界表 (整数元组)，默认均分；transform 见 parse_transform
+    """
+    transposed, reverse_rows, reverse_cols = parse_transform(transform)
+    if transposed and cols != rows:
+        raise ValueError(f"转置只适用于行数和列数相同的格子 (现在是 {cols}列 × {rows}行)")
+    x_edges, col_order, col_index = axis_map(x1, x2, cols, reverse_cols, x_edges)
+    y_edges, row_order, row_index = axis_map(y1, y2, rows, reverse_rows, y_edges)
+    return MirrorMap(x_edges, y_edges, col_index, row_index, col_order, row_order, transposed)
+
+
+def mirror_grid(img_array, x1, y1, x2, y2, cols, rows, region=None, out=None, transform=DEFAULT_TRANSFORM):
+    """镜像格子区域
+
+    region 为 (可能已去水印的) 格子区域内容，默认直接取 img_array 的格子区域；
+    out 默认为 img_array 的副本
+    """
+    mirror_map = build_mirror_map(x1, y1, x2, y2, cols, rows, transform=transform)
+    bx1, by1, bx2, by2 = mirror_map.bounds
+    if region is None:
+        region = img_array[by1:by2, bx1:bx2]
+    if out is None:
+        out = img_array.copy()
+    return mirror_map.apply(region, out)
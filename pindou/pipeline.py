@@ -0,0 +1,445 @@
+# -*- coding: utf-8 -*-
+"""
+处理流水线：解码 → 检测 → 去水印 → 镜像 → 编码
+
+每个阶段都是独立的函数，读写同一个 Job 对象，界面层和批处理都通过
+process() / process_many() 调用，不依赖任何界面库。
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
+
+import numpy as np
+from PIL import Image
+
+from .decoding import decode_image
+from .detect import DEFAULT_GRID_METHOD, detect_grid_size, detect_region, snap_grid_edges
+from .encoding import encode_image
+from .grid import cell_edges, row_bands
+from .matrix import grid_line_color, render_cells, sample_cells, sample_count
+from .mirror import DEFAULT_TRANSFORM, build_mirror_map
+from .profiles import ProfileStore, layout_fingerprint
+from .timing import StageTimer, dedup_context, image_context, log_timing, profiled
+from .watermark import CellCache, remove_watermark_grid
+
+
+AUTO = 'auto'
+
+# 处理模式：pixels 逐像素搬运格子，matrix 每格采样一个颜色后重绘
+MODES = ('pixels', 'matrix')
+
+# 预览代理图的长边上限，以及代理图中格子边长的下限 (再小去水印和采样就不可靠了)
+PREVIEW_SIDE = 1200
+PREVIEW_MIN_CELL = 6
+
+# 需要报告进度或可取消时，去水印和镜像按整行格子分成约这么多条依次处理
+PROGRESS_BANDS = 20
+
+# 多线程处理时每个线程平均分到的条数，多分几条负载更均衡
+BANDS_PER_THREAD = 4
+
+# 去水印和镜像时每个像素的临时内存 (标签、亮度、颜色键、镜像前的副本等) 约为这么多字节
+WORK_BYTES_PER_PIXEL = 40
+# 写入输出缓冲区时 (见 Job.out 和 ProcessOptions.in_place) 每条临时内存的上限。
+# 这时不分配整图大小的数组，一次处理额外占用的内存不超过 BAND_BYTES × 线程数
+BAND_BYTES = 32 * 1024 * 1024
+
+
+class Cancelled(Exception):
+    """处理被取消"""
+
+
+@dataclass
+class ProcessOptions:
+    """处理选项"""
+    remove_watermark: bool = True
+    mode: str = 'pixels'  # 见 MODES
+    transform: str = DEFAULT_TRANSFORM  # 格子怎样重排，见 mirror.TRANSFORMS，可用 + 组合
+    grid_method: str = DEFAULT_GRID_METHOD  # 自动检测格子数的方法，见 GRID_METHODS
+    output_format: str = None  # 为 None 时不编码，见 encoding.OUTPUT_FORMATS，例如 'png'
+    threads: int = 1  # 去水印和镜像的线程数，0 为 CPU 核数
+    snap_edges: bool = True  # 格子边界对齐检测到的网格线，False 时按格子数均分
+    in_place: bool = False  # 结果直接写回解码出的原图数组 (只改格子区域)，不再分配整图的输出；数组只读时先复制
+    profiles: str = None  # 布局档案文件 (见 profiles.ProfileStore)，自动检测前先查档案；None 时不用
+
+
+@dataclass
+class Job:
+    """一次处理任务，在各阶段之间传递"""
+    source: object
+    region: object = None
+    grid: object = None
+    options: ProcessOptions = field(default_factory=ProcessOptions)
+    region_confidence: float = None  # 自动检测区域时的置信度
+    profile: object = None  # 套用的布局档案 (profiles.Profile)
+    fingerprint: str = None  # 区域和格子数都手动指定、又用布局档案时，这种布局的指纹 (可存入档案)
+    edges: tuple = None  # 格子边界表 (x_edges, y_edges)，为 None 时在检测阶段生成，可传给下一次处理复用
+    array: np.ndarray = None
+    mirror_map: object = None
+    cleaned: np.ndarray = None
+    matrix: np.ndarray = None  # 色块模式下镜像前的 rows × cols × 3 颜色矩阵
+    output: np.ndarray = None
+    out: np.ndarray = None  # 调用方提供的输出缓冲区 (与原图同尺寸)，可以就是原图数组；None 时新分配
+    encoded: bytes = None
+    timer: StageTimer = None  # 各阶段用时
+    progress: object = None  # 进度回调 progress(阶段名, 已完成行数, 总行数)
+    cancel: object = None  # 取消标志 (如 threading.Event)，is_set() 为真时抛出 Cancelled
+    downscale: int = 1  # 预览时代理图相对原图的缩小倍数
+
+    @property
+    def image(self):
+        """处理结果 (PIL 图片)"""
+        if self.output is None:
+            return None
+        return Image.fromarray(self.output)
+
+
+def load_image(source):
+    """把路径、字节、文件对象、PIL 图片或数组转成 RGB 数组 (见 decoding.decode_image)"""
+    return decode_image(source)
+
+
+def output_name(path, extension='.png'):
+    """镜像结果的默认文件名：<原文件名>_镜像.png"""
+    base_name = os.path.splitext(os.path.basename(path))[0]
+    return f"{base_name}_镜像{extension}"
+
+
+def normalize_region(region):
+    """校正坐标顺序，区域为空时抛出 ValueError"""
+    x1, y1, x2, y2 = (int(v) for v in region)
+    x1, x2 = min(x1, x2), max(x1, x2)
+    y1, y2 = min(y1, y2), max(y1, y2)
+    if x1 == x2 or y1 == y2:
+        raise ValueError("格子区域设置错误")
+    return x1, y1, x2, y2
+
+
+def decode(job):
+    """阶段1：解码
+
+    in_place 时结果要写回解码出的数组；PIL 解码 (OpenCV 不支持的格式、传入 PIL 图片) 得到的数组
+    和图片共享内存、只读，这时复制一份，相当于不写回原图
+    """
+    job.array = load_image(job.source)
+    if job.options.in_place and not job.array.flags.writeable:
+        job.array = job.array.copy()
+    return job
+
+
+def apply_profile(job):
+    """区域或格子数需要自动检测时先查布局档案，找到同样布局的图纸就直接套用"""
+    region_auto = job.region is None or job.region == AUTO
+    grid_auto = job.grid is None or job.grid == AUTO
+    if not job.options.profiles or not (region_auto or grid_auto):
+        return job
+    profile = ProfileStore(job.options.profiles).lookup(job.array)
+    if profile is None or not (region_auto or normalize_region(job.region) == profile.region):
+        return job
+    job.profile = profile
+    job.region = profile.region
+    if grid_auto:
+        job.grid = profile.grid
+    if job.timer is not None:
+        job.timer.context['profile'] = True
+    return job
+
+
+def is_manual(job):
+    """区域和格子数都是手动指定的 (不是 None 或 'auto')"""
+    return not (job.region is None or job.region == AUTO or job.grid is None or job.grid == AUTO)
+
+
+def detect(job):
+    """阶段2：确定格子区域和格子数量 (None 或 'auto' 时先查布局档案，再自动检测)"""
+    manual = is_manual(job)
+    apply_profile(job)
+    if job.region is None or job.region == AUTO:
+        guess = detect_region(job.array)
+        job.region = guess[:4]
+        job.region_confidence = guess.confidence
+    job.region = normalize_region(job.region)
+
+    if job.grid is None or job.grid == AUTO:
+        guess = detect_grid_size(job.array, job.region, job.options.grid_method)
+        if guess is None:
+            raise ValueError("无法自动检测格子数")
+        job.grid = (guess.cols, guess.rows)
+    cols, rows = (int(v) for v in job.grid)
+    if cols < 1 or rows < 1:
+        raise ValueError("格子数必须大于 0")
+    job.grid = (cols, rows)
+    if manual and job.options.profiles:
+        job.fingerprint = layout_fingerprint(job.array, job.region, job.grid)
+    job.mirror_map = build_mirror_map(*job.region, cols, rows, *grid_edges(job), job.options.transform)
+    return job
+
+
+def grid_edges(job):
+    """格子边界表 (x_edges, y_edges 两个整数元组)，和区域、格子数对不上时重新生成"""
+    (x1, y1, x2, y2), (cols, rows) = job.region, job.grid
+    if job.edges is not None:
+        x_edges, y_edges = (tuple(int(v) for v in edges) for edges in job.edges)
+        if (len(x_edges), x_edges[0], x_edges[-1], len(y_edges), y_edges[0], y_edges[-1]) == \
+                (cols + 1, x1, x2, rows + 1, y1, y2):
+            job.edges = (x_edges, y_edges)
+            return job.edges
+    if job.options.snap_edges:
+        job.edges = snap_grid_edges(job.array, job.region, cols, rows)
+    else:
+        job.edges = tuple(tuple(int(v) for v in cell_edges(start, end, count))
+                          for start, end, count in ((x1, x2, cols), (y1, y2, rows)))
+    return job.edges
+
+
+def check_cancel(job):
+    """取消标志已设置时抛出 Cancelled"""
+    if job.cancel is not None and job.cancel.is_set():
+        raise Cancelled()
+
+
+def progress_stages(options):
+    """会报告进度的阶段 (按先后顺序)"""
+    if options.remove_watermark and options.mode != 'matrix':
+        return ('dewatermark', 'mirror')
+    return ('mirror',)
+
+
+def progress_fraction(stages, stage, done, total):
+    """把某一阶段的进度换算成整体进度 (0~1)，各阶段按相同权重"""
+    index = stages.index(stage) if stage in stages else 0
+    return min(1.0, (index + done / max(1, total)) / max(1, len(stages)))
+
+
+def thread_count(threads):
+    """实际使用的线程数，0 或 None 为 CPU 核数"""
+    return threads if threads and threads > 0 else os.cpu_count() or 1
+
+
+def band_height(mirror_map, band_bytes):
+    """每条临时内存不超过 band_bytes 时的最大像素行数"""
+    x1, y1, x2, y2 = mirror_map.bounds
+    return max(1, band_bytes // max(1, (x2 - x1) * WORK_BYTES_PER_PIXEL))
+
+
+def writes_buffer(job):
+    """结果是否写入已有的数组 (调用方的缓冲区或原图本身)，这时按 BAND_BYTES 分条"""
+    return job.out is not None or job.options.in_place
+
+
+def run_bands(job, stage, work):
+    """按整行格子分条调用 work(起始行, 结束行)，返回各条的返回值 (按完成顺序)
+
+    单线程且不需要进度和取消时只有一条 (写入已有数组时每条不超过 BAND_BYTES)。
+    options.threads 不为 1 时各条在线程池中
+    并发处理 (NumPy/OpenCV 大部分运算会释放 GIL)，work 只能写输出中属于本条的行。
+    每条开始前检查取消；进度在调用线程中按已完成的行数报告，所以回调不必线程安全
+    """
+    y_edges = job.mirror_map.y_edges
+    threads = thread_count(job.options.threads)
+    count = threads * BANDS_PER_THREAD if threads > 1 else 1
+    if job.progress is not None or job.cancel is not None:
+        count = max(count, PROGRESS_BANDS)
+    total = len(y_edges) - 1
+    max_height = -(-(y_edges[-1] - y_edges[0]) // count)
+    if writes_buffer(job):
+        max_height = min(max_height, band_height(job.mirror_map, BAND_BYTES))
+    band_list = row_bands(y_edges, max_height)
+
+    if threads == 1 or len(band_list) == 1:
+        results = []
+        for start, end in band_list:
+            check_cancel(job)
+            results.append(work(start, end))
+            if job.progress is not None:
+                job.progress(stage, end, total)
+        return results
+
+    def run(start, end):
+        check_cancel(job)
+        return work(start, end)
+
+    results = []
+    done = 0
+    with ThreadPoolExecutor(max_workers=min(threads, len(band_list))) as pool:
+        futures = {pool.submit(run, start, end): (start, end) for start, end in band_list}
+        try:
+            for future in as_completed(futures):
+                results.append(future.result())
+                start, end = futures[future]
+                done += end - start
+                if job.progress is not None:
+                    job.progress(stage, done, total)
+        except BaseException:
+            # 取消、出错或回调抛出异常 (如 Streamlit 中止脚本)：还没开始的条不再处理
+            for future in futures:
+                future.cancel()
+            raise
+    return results
+
+
+def prepare_output(job):
+    """镜像结果要写入的整图数组 (格子区域之外与原图相同)
+
+    默认复制一份原图；有输出缓冲区时只复制格子区域之外的部分，in_place 时就是原图，不复制
+    """
+    if not writes_buffer(job):
+        return job.array.copy()
+    out = job.array if job.out is None else job.out
+    if job.output is out:  # 去水印阶段已经准备好了
+        return out
+    if out.shape != job.array.shape or out.dtype != np.uint8:
+        raise ValueError(f"输出缓冲区应为 {job.array.shape} 的 uint8 数组")
+    if out is not job.array:
+        x1, y1, x2, y2 = job.mirror_map.bounds
+        out[:y1] = job.array[:y1]
+        out[y2:] = job.array[y2:]
+        out[y1:y2, :x1] = job.array[y1:y2, :x1]
+        out[y1:y2, x2:] = job.array[y1:y2, x2:]
+    job.output = out
+    return out
+
+
+def dewatermark(job):
+    """阶段3：去水印 (色块模式采样时已经避开水印，跳过)
+
+    写入已有数组时去水印的结果直接写进输出的格子区域，镜像时再逐条原地重排。
+    各条共用一个 CellCache，相同的格子在整个区域里只算一次
+    """
+    if job.options.remove_watermark and job.options.mode != 'matrix':
+        x_edges, y_edges = job.mirror_map.x_edges, job.mirror_map.y_edges
+        x1, y1, x2, y2 = job.mirror_map.bounds
+        if writes_buffer(job):
+            job.cleaned = prepare_output(job)[y1:y2, x1:x2]
+        else:
+            job.cleaned = np.empty((y2 - y1, x2 - x1, 3), dtype=np.uint8)
+        cache = CellCache()
+
+        def clean(start, end):
+            stats = {}
+            job.cleaned[y_edges[start] - y1:y_edges[end] - y1] = \
+                remove_watermark_grid(job.array, x_edges, y_edges[start:end + 1], stats=stats, cache=cache)
+            return stats
+
+        stats = run_bands(job, 'dewatermark', clean)
+        if job.timer is not None:
+            job.timer.context.update(dedup_context(*stats))
+    return job
+
+
+def mirror(job):
+    """阶段4：镜像"""
+    if job.options.mode == 'matrix':
+        return mirror_cells(job)
+    mirror_map = job.mirror_map
+    x1, y1, x2, y2 = mirror_map.bounds
+    y_edges = mirror_map.y_edges
+    region = job.cleaned if job.cleaned is not None else job.array[y1:y2, x1:x2]
+    output = prepare_output(job)
+
+    if not np.may_share_memory(region, output):
+        run_bands(job, 'mirror', lambda start, end: mirror_map.apply_band(region, y1, output, start, end))
+    elif mirror_map.identity_rows:
+        # 源和输出是同一块内存，行不动：每条先复制自己这几行再重排，临时内存只有一条
+        def work(start, end):
+            top, bottom = int(y_edges[start]), int(y_edges[end])
+            mirror_map.apply_band(region[top - y1:bottom - y1].copy(), top, output, start, end)
+
+        run_bands(job, 'mirror', work)
+    else:
+        region = region.copy()  # 行也要移动时 (上下翻转、转置等) 各条会互相覆盖源，只能复制整个格子区域
+        run_bands(job, 'mirror', lambda start, end: mirror_map.apply_band(region, y1, output, start, end))
+    job.output = output
+    return job
+
+
+def mirror_cells(job):
+    """色块模式的镜像：采样颜色矩阵，按变换后的顺序重绘格子"""
+    mirror_map = job.mirror_map
+    x_edges, y_edges = mirror_map.x_edges, mirror_map.y_edges
+    y_samples = sample_count(y_edges)
+    grid_color = grid_line_color(job.array, x_edges, y_edges)
+    matrix = np.empty((len(y_edges) - 1, len(x_edges) - 1, 3), dtype=np.uint8)
+
+    def sample(start, end):
+        matrix[start:end] = sample_cells(job.array, x_edges, y_edges[start:end + 1], y_samples)
+
+    run_bands(job, 'mirror', sample)
+    output = prepare_output(job)  # 原地处理时要在采样完之后才能改写
+    mirrored = mirror_map.permute_cells(matrix)
+    # 分条重绘，临时内存不超过一条
+    rows = len(y_edges) - 1
+    for start, end in row_bands(y_edges, band_height(mirror_map, BAND_BYTES)):
+        render_cells(mirrored[start:end], x_edges, y_edges[start:end + 1], output, grid_color, end == rows)
+    job.matrix = matrix
+    job.output = output
+    return job
+
+
+def encode(job):
+    """阶段5：编码 (未指定输出格式时跳过)"""
+    if job.options.output_format:
+        job.encoded = encode_image(job.output, job.options.output_format)
+    return job
+
+
+STAGES = (decode, detect, dewatermark, mirror, encode)
+
+
+def process(image, region=None, grid=None, options=None, progress=None, cancel=None, out=None):
+    """处理一张图纸
+
+    image: 路径、字节、文件对象、PIL 图片或 RGB 数组
+    region: (x1, y1, x2, y2)，None 或 'auto' 时自动检测
+    grid: (cols, rows)，None 或 'auto' 时自动检测
+    progress: 进度回调 progress(阶段名, 已完成行数, 总行数)，在去水印和镜像的每条之后调用
+    cancel: 取消标志，is_set() 为真时在下一条开始前抛出 Cancelled
+    out: 结果写入这个与原图同尺寸的 uint8 数组 (可以反复使用，也可以就是作为 image 传入的数组)，
+         不再分配整图大小的数组。数组输入时 process(array, out=array) 或 options.in_place
+         没有任何整图复制，额外内存不超过 BAND_BYTES × 线程数 (行也移动的变换如 flip-v、
+         rotate-180、transpose 写回原图时还要复制一份格子区域)
+    """
+    job = Job(image, region=region, grid=grid, options=options or ProcessOptions(), timer=StageTimer(),
+              progress=progress, cancel=cancel, out=out)
+    return run_stages(job)
+
+
+def run_stages(job, stages=STAGES):
+    """依次运行各阶段 (按函数名计时)，记录计时日志"""
+    with profiled():
+        for stage in stages:
+            check_cancel(job)
+            with job.timer.stage(stage.__name__):
+                stage(job)
+    job.timer.context.update(image_context(job.array, job.grid), mode=job.options.mode)
+    log_timing(job.timer)
+    return job
+
+
+def process_many(items, options=None):
+    """依次处理多张图纸，items 中每项为图片或 (图片, 区域, 格子数) 元组"""
+    for item in items:
+        if isinstance(item, tuple):
+            yield process(*item, options=options)
+        else:
+            yield process(item, options=options)
+
+
+def preview_factor(size, region, grid, max_side=PREVIEW_SIDE, min_cell=PREVIEW_MIN_CELL):
+    """预览代理图的整数缩小倍数：长边缩到 max_side 以内，但格子不小于 min_cell 像素"""
+    x1, y1, x2, y2 = region
+    cols, rows = grid
+    wanted = -(-max(size) // max_side)
+    allowed = int(min((x2 - x1) / cols, (y2 - y1) / rows) // min_cell)
+    return max(1, min(wanted, allowed))
+
+
+def reduce_image(image, factor):
+    """按整数倍缩小 (RGB PIL 图片，方块平均)"""
+    return (image if image.mode == 'RGB' else image.convert('RGB')).reduce(factor)
+
+
+def scale_region(region, factor):
+    """原图上的格子区域换算到缩小 factor 倍的代理图上"""
+    return tuple(round(v / factor) for v in region)
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""
+预览金字塔
+每张图片只缩小一次，得到边长逐级减半的若干层；显示时取不小于目标尺寸的
+最小一层再缩放，缩放的像素量只和显示尺寸有关，和原图大小无关。
+"""
+
+from PIL import Image
+
+
+# 最小一层的长边不小于此值
+MIN_SIDE = 256
+
+
+def fit_scale(image_size, box_size, upscale=False):
+    """把 image_size 放进 box_size 的缩放比例 (默认不放大)"""
+    width, height = image_size
+    box_width, box_height = box_size
+    scale = min(box_width / width, box_height / height)
+    return scale if upscale else min(scale, 1.0)
+
+
+class PreviewPyramid:
+    """一张图片的预览金字塔，第 0 层为原图"""
+
+    def __init__(self, image, min_side=MIN_SIDE):
+        self.image = image
+        self.levels = [image]
+        while max(self.levels[-1].size) >= min_side * 2:
+            self.levels.append(self.levels[-1].reduce(2))
+
+    @property
+    def size(self):
+        return self.image.size
+
+    def level_for(self, width, height):
+        """不小于 (width, height) 的最小一层"""
+        for level in reversed(self.levels):
+            if level.width >= width and level.height >= height:
+                return level
+        return self.levels[0]
+
+    def render(self, width, height, resample=Image.Resampling.LANCZOS):
+        """缩放到 (width, height)"""
+        width, height = max(1, width), max(1, height)
+        level = self.level_for(width, height)
+        if level.size == (width, height):
+            return level
+        return level.resize((width, height), resample)
+
+    def fit(self, box_width, box_height):
+        """缩放到能放进显示区域的大小，返回 (图片, 相对原图的缩放比例)"""
+        scale = fit_scale(self.size, (box_width, box_height))
+        return self.render(int(self.size[0] * scale), int(self.size[1] * scale)), scale
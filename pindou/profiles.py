@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+布局档案
+同一个生成器导出的图纸布局完全相同 (图片尺寸、格子区域、格子数)。确认过的区域和
+格子数按 图片尺寸 + 坐标轴区域的指纹 存到磁盘上，下次载入同样布局的图纸直接套用，
+不用再检测。
+
+指纹是格子区域上方的列号和左侧的行号 (各取两格宽的一条) 的差分哈希 (dHash)，
+各 64 位。查找时用每条同尺寸档案自己的区域和格子数截取这两条，汉明距离之和
+不超过 MAX_DISTANCE 就算同一种布局。
+档案存为 JSON，默认在 ~/.pindou_mirror/profiles.json，可用环境变量 PINDOU_PROFILES 指定；
+MemoryProfileStore 只存在内存里 (Streamlit 页面每个会话一份)。
+"""
+
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import namedtuple
+
+import cv2
+import numpy as np
+
+
+PROFILES_ENV = 'PINDOU_PROFILES'
+DEFAULT_PROFILES_PATH = os.path.join(os.path.expanduser('~'), '.pindou_mirror', 'profiles.json')
+
+# 两条指纹共 128 位，相差不超过这么多位算同一种布局 (水印、压缩噪声会改变少量位)
+MAX_DISTANCE = 12
+# 最多保存的档案数，超出时丢掉最久没用过的
+MAX_PROFILES = 200
+# 坐标轴条带的宽度 (格子数)
+AXIS_CELLS = 2
+
+Profile = namedtuple('Profile', ['region', 'grid', 'distance'])
+
+
+def default_path():
+    """档案文件路径：环境变量 PINDOU_PROFILES 或 ~/.pindou_mirror/profiles.json"""
+    return os.environ.get(PROFILES_ENV) or DEFAULT_PROFILES_PATH
+
+
+def _dhash(strip, axis):
+    """条带的 64 位差分哈希：沿 axis 方向缩成 17 格、另一方向 4 格，比较相邻两格的亮度"""
+    if strip.size == 0:
+        return 0
+    gray = cv2.cvtColor(np.ascontiguousarray(strip), cv2.COLOR_RGB2GRAY) if strip.ndim == 3 else strip
+    size = (17, 4) if axis == 1 else (4, 17)
+    small = cv2.resize(gray, size, interpolation=cv2.INTER_AREA).astype(np.int16)
+    bits = np.diff(small, axis=axis) > 0
+    return int(np.packbits(bits.ravel()).view('>u8')[0])
+
+
+def layout_fingerprint(img_array, region, grid):
+    """格子区域上方列号和左侧行号两条的指纹，返回 32 位十六进制字符串"""
+    x1, y1, x2, y2 = (int(v) for v in region)
+    cols, rows = (int(v) for v in grid)
+    top = max(0, y1 - round((y2 - y1) / rows * AXIS_CELLS))
+    left = max(0, x1 - round((x2 - x1) / cols * AXIS_CELLS))
+    header = _dhash(img_array[top:y1, x1:x2], 1)
+    axis = _dhash(img_array[y1:y2, left:x1], 0)
+    return f'{header:016x}{axis:016x}'
+
+
+def _distance(a, b):
+    return bin(int(a, 16) ^ int(b, 16)).count('1')
+
+
+class ProfileStore:
+    """磁盘上的布局档案 (线程安全；多个进程同时写时后写的为准，不会写坏文件)"""
+
+    def __init__(self, path=None):
+        self.path = path or default_path()
+        self.lock = threading.Lock()
+        self._loaded = (None, [])  # (文件修改时间, 档案列表)
+
+    def load(self):
+        """读出全部档案，文件不存在或损坏时为空列表 (文件没变时不重新读)"""
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            return []
+        if self._loaded[0] != mtime:
+            try:
+                with open(self.path, encoding='utf-8') as f:
+                    entries = json.load(f).get('profiles', [])
+            except (OSError, ValueError, AttributeError):
+                entries = []
+            self._loaded = (mtime, entries)
+        return self._loaded[1]
+
+    def lookup(self, img_array):
+        """找同尺寸、指纹最接近的档案，返回 Profile，没有时返回 None"""
+        height, width = img_array.shape[:2]
+        best = None
+        for entry in self.load():
+            if entry.get('size') != [width, height]:
+                continue
+            try:
+                fingerprint = layout_fingerprint(img_array, entry['region'], entry['grid'])
+                distance = _distance(fingerprint, entry['fingerprint'])
+            except (KeyError, TypeError, ValueError, ZeroDivisionError, cv2.error):
+                continue
+            if distance <= MAX_DISTANCE and (best is None or distance < best.distance):
+                best = Profile(tuple(entry['region']), tuple(entry['grid']), distance)
+        return best
+
+    def remember(self, img_array, region, grid):
+        """保存确认过的区域和格子数"""
+        height, width = img_array.shape[:2]
+        region = tuple(int(v) for v in region)
+        grid = tuple(int(v) for v in grid)
+        self.add((width, height), region, grid, layout_fingerprint(img_array, region, grid))
+
+    def add(self, size, region, grid, fingerprint):
+        """保存一条档案 (指纹已经算好时用，如批处理的子进程返回的)，替换同一种布局的旧档案"""
+        entry = {'size': list(size), 'region': list(region), 'grid': list(grid),
+                 'fingerprint': fingerprint, 'used': time.time()}
+        with self.lock:
+            entries = [e for e in self.load()
+                       if not (e.get('size') == entry['size'] and e.get('region') == entry['region']
+                               and e.get('grid') == entry['grid'])]
+            entries.append(entry)
+            entries.sort(key=lambda e: e.get('used', 0))
+            self._save(entries[-MAX_PROFILES:])
+
+    def _save(self, entries):
+        """先写临时文件再替换，其他进程不会读到写了一半的文件"""
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump({'profiles': entries}, f, ensure_ascii=False, indent=1)
+            os.replace(tmp, self.path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        self._loaded = (None, [])
+
+
+class MemoryProfileStore(ProfileStore):
+    """只在内存里的布局档案，不读写文件"""
+
+    def __init__(self):
+        self.path = None
+        self.lock = threading.Lock()
+        self.entries = []
+
+    def load(self):
+        return self.entries
+
+    def _save(self, entries):
+        self.entries = entries
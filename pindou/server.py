@@ -0,0 +1,368 @@
+# -*- coding: utf-8 -*-
+"""
+本地 HTTP 镜像服务 (只用标准库)
+用法: python pindou_mirror.py serve --port 8765 --workers 4
+
+  GET  /health   服务状态 (JSON)
+  POST /mirror   请求体为一张图片，返回镜像后的图片
+  POST /batch    请求体为 ZIP (多张图片)，返回 ZIP：每张图片的结果和 results.json，
+                 哪张先处理完先写哪张；图片按处理进度逐张从 ZIP 中读出
+
+参数放在查询字符串里，和命令行相同，缺省都是 auto:
+  region=auto|x1,y1,x2,y2  grid=auto|52x47  watermark=1|0  mode=pixels|matrix
+  grid_method=periodic|hough  format=png|png-fast|png-palette|webp|jpeg  snap=1|0
+  transform=flip-h|flip-v|rotate-180|transpose (组合时用逗号连接，如 transpose,flip-h)
+
+/mirror 的响应头 X-Pindou-Region、X-Pindou-Grid、X-Pindou-Confidence、X-Pindou-Timings
+给出检测结果和各阶段用时 (套用了布局档案时还有 X-Pindou-Profile: 1)；/batch 的 results.json 还包含每张图纸的格子边界表。处理在进程池中进行，同时处理和排队的请求数有上限，
+超过时返回 503。
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from contextlib import contextmanager
+from dataclasses import replace
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from .cli import parse_grid, parse_region
+from .detect import DEFAULT_GRID_METHOD, GRID_METHODS
+from .encoding import DEFAULT_OUTPUT_FORMAT, OUTPUT_FORMATS, output_format
+from .mirror import DEFAULT_TRANSFORM, parse_transform
+from .pipeline import AUTO, MODES, ProcessOptions, output_name, process
+from .timing import PROFILE_ENV, TIMING_LOG_ENV
+
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+# 单个请求体 (以及 ZIP 中单张图片解压后) 的上限
+MAX_UPLOAD_BYTES = 256 * 1024 * 1024
+# 批处理的 ZIP 超过这个大小时暂存到临时文件，不全放在内存里
+SPOOL_BYTES = 16 * 1024 * 1024
+# 读请求体和写响应时每次的字节数
+CHUNK_BYTES = 64 * 1024
+# 每个工作进程最多排队的任务数，超过时返回 503
+QUEUE_PER_WORKER = 2
+# 批处理 ZIP 中当作图片的扩展名
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.gif', '.webp')
+
+
+class RequestError(Exception):
+    """请求有误，带 HTTP 状态码"""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def parse_options(query):
+    """查询字符串 → (区域, 格子数, ProcessOptions)，参数有误时抛出 RequestError"""
+    params = {key: values[-1] for key, values in parse_qs(query).items()}
+    try:
+        region = parse_region(params.get('region', AUTO))
+        grid = parse_grid(params.get('grid', AUTO))
+    except argparse.ArgumentTypeError as e:
+        raise RequestError(HTTPStatus.BAD_REQUEST, str(e))
+    mode = params.get('mode', 'pixels')
+    grid_method = params.get('grid_method', DEFAULT_GRID_METHOD)
+    fmt = params.get('format', DEFAULT_OUTPUT_FORMAT).lower()
+    transform = params.get('transform', DEFAULT_TRANSFORM)
+    try:
+        parse_transform(transform)
+    except ValueError as e:
+        raise RequestError(HTTPStatus.BAD_REQUEST, str(e))
+    if mode not in MODES:
+        raise RequestError(HTTPStatus.BAD_REQUEST, f"mode 应为 {'/'.join(MODES)}")
+    if grid_method not in GRID_METHODS:
+        raise RequestError(HTTPStatus.BAD_REQUEST, f"grid_method 应为 {'/'.join(GRID_METHODS)}")
+    if fmt not in OUTPUT_FORMATS:
+        raise RequestError(HTTPStatus.BAD_REQUEST, f"format 应为 {'/'.join(OUTPUT_FORMATS)}")
+    options = ProcessOptions(remove_watermark=params.get('watermark', '1') not in ('0', 'false', 'no'),
+                             mode=mode, transform=transform, grid_method=grid_method, output_format=fmt,
+                             snap_edges=params.get('snap', '1') not in ('0', 'false', 'no'), in_place=True)
+    return region, grid, options
+
+
+def mirror_bytes(data, region, grid, options):
+    """处理一张图片的字节 (在工作进程中运行)，返回编码结果和摘要"""
+    job = process(data, region, grid, options)
+    return {
+        'encoded': job.encoded,
+        'region': list(job.region),
+        'grid': list(job.grid),
+        'confidence': job.region_confidence,
+        'edges': [list(edges) for edges in job.edges],
+        'profile': job.profile is not None,
+        'timings': job.timer.record(),
+    }
+
+
+class MirrorHandler(BaseHTTPRequestHandler):
+    server_version = 'pindou-mirror/1.0'
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if urlsplit(self.path).path != '/health':
+            return self.send_json(HTTPStatus.NOT_FOUND, {'error': "not found"})
+        self.send_json(HTTPStatus.OK, {
+            'status': 'ok',
+            'workers': self.server.workers,
+            'pending': self.server.pending,
+            'formats': list(OUTPUT_FORMATS),
+        })
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        handlers = {'/mirror': self.handle_mirror, '/batch': self.handle_batch}
+        self.streaming = False
+        try:
+            if url.path not in handlers:
+                self.read_body()  # 读掉请求体，连接才能继续复用
+                raise RequestError(HTTPStatus.NOT_FOUND, "not found")
+            handlers[url.path](url.query)
+        except RequestError as e:
+            self.send_json(e.status, {'error': str(e)})
+        except Exception as e:
+            self.log_error("处理失败: %r", e)
+            self.close_connection = True
+            if not self.streaming:  # 响应已经开始发送时只能断开连接
+                self.send_json(HTTPStatus.INTERNAL_SERVER_ERROR, {'error': str(e)})
+
+    def read_body(self, out=None):
+        """分块读取请求体，超过上限时抛出 RequestError
+
+        out 为文件对象时写入 out 并返回 out，否则返回 bytes
+        """
+        if 'chunked' in self.headers.get('Transfer-Encoding', '').lower():
+            self.close_connection = True
+            raise RequestError(HTTPStatus.LENGTH_REQUIRED, "请求需要 Content-Length")
+        length = int(self.headers.get('Content-Length') or 0)
+        if length > MAX_UPLOAD_BYTES:
+            self.close_connection = True
+            raise RequestError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, f"请求体超过 {MAX_UPLOAD_BYTES} 字节")
+        chunks = []
+        remaining = length
+        while remaining > 0:
+            chunk = self.rfile.read(min(CHUNK_BYTES, remaining))
+            if not chunk:
+                self.close_connection = True
+                raise RequestError(HTTPStatus.BAD_REQUEST, "请求体不完整")
+            if out is None:
+                chunks.append(chunk)
+            else:
+                out.write(chunk)
+            remaining -= len(chunk)
+        return b''.join(chunks) if out is None else out
+
+    def handle_mirror(self, query):
+        data = self.read_body()
+        region, grid, options = parse_options(query)
+        options = replace(options, threads=self.server.threads, profiles=self.server.profiles)
+        if not data:
+            raise RequestError(HTTPStatus.BAD_REQUEST, "请求体为空，应为一张图片")
+        with self.server.slot():
+            future = self.server.pool.submit(mirror_bytes, data, region, grid, options)
+            try:
+                result = future.result()
+            except (ValueError, OSError) as e:  # 区域设置错误、无法检测格子数、图片无法解码等
+                raise RequestError(HTTPStatus.UNPROCESSABLE_ENTITY, str(e))
+
+        encoded = result['encoded']
+        self.send_response(HTTPStatus.OK)
+        self.send_header('Content-Type', output_format(options.output_format).mime)
+        self.send_header('Content-Length', str(len(encoded)))
+        self.send_header('X-Pindou-Region', ','.join(str(v) for v in result['region']))
+        self.send_header('X-Pindou-Grid', 'x'.join(str(v) for v in result['grid']))
+        if result['confidence'] is not None:
+            self.send_header('X-Pindou-Confidence', f"{result['confidence']:.3f}")
+        if result['profile']:
+            self.send_header('X-Pindou-Profile', '1')
+        self.send_header('X-Pindou-Timings', json.dumps(result['timings']['stages']))
+        self.end_headers()
+        for start in range(0, len(encoded), CHUNK_BYTES):
+            self.wfile.write(encoded[start:start + CHUNK_BYTES])
+
+    def handle_batch(self, query):
+        with tempfile.SpooledTemporaryFile(SPOOL_BYTES) as body:
+            self.read_body(body)
+            region, grid, options = parse_options(query)
+            options = replace(options, threads=self.server.threads, profiles=self.server.profiles)
+            try:
+                archive = zipfile.ZipFile(body)
+            except zipfile.BadZipFile:
+                raise RequestError(HTTPStatus.BAD_REQUEST, "请求体应为 ZIP 文件")
+            with archive:
+                self.mirror_archive(archive, region, grid, options)
+
+    def mirror_archive(self, archive, region, grid, options):
+        """处理 ZIP 中的图片并以 ZIP 流式返回
+
+        同时在进程池中的图片不超过进程数，处理完一张才从 ZIP 中读出下一张，
+        内存中只有正在处理的几张图片
+        """
+        members = [info for info in archive.infolist()
+                   if not info.is_dir() and info.filename.lower().endswith(IMAGE_EXTENSIONS)]
+        if not members:
+            raise RequestError(HTTPStatus.BAD_REQUEST, "ZIP 中没有图片")
+
+        extension = output_format(options.output_format).extension
+        members.reverse()
+        futures = {}
+        summary = []
+
+        def submit(count):
+            """从 ZIP 中读出并提交 count 张图片 (读不出的记入 summary)"""
+            while count > 0 and members:
+                info = members.pop()
+                try:
+                    if info.file_size > MAX_UPLOAD_BYTES:
+                        raise ValueError(f"解压后超过 {MAX_UPLOAD_BYTES} 字节")
+                    data = archive.read(info)
+                except Exception as e:  # 超过上限、CRC 错误、不支持的压缩方式等
+                    summary.append({'input': info.filename, 'error': str(e)})
+                    continue
+                futures[self.server.pool.submit(mirror_bytes, data, region, grid, options)] = info.filename
+                count -= 1
+
+        in_flight = min(len(members), self.server.workers)
+        with self.server.slot(in_flight):
+            submit(in_flight)
+            # 结果用分块传输边处理边发送，哪张先处理完先写哪张
+            self.streaming = True
+            self.send_response(HTTPStatus.OK)
+            self.send_header('Content-Type', 'application/zip')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            with zipfile.ZipFile(_ChunkedWriter(self.wfile), 'w', zipfile.ZIP_STORED) as out:
+                while futures:
+                    done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        name = futures.pop(future)
+                        try:
+                            result = future.result()
+                        except Exception as e:
+                            summary.append({'input': name, 'error': str(e)})
+                            continue
+                        output = os.path.join(os.path.dirname(name), output_name(name, extension))
+                        out.writestr(output, result.pop('encoded'))
+                        summary.append({'input': name, 'output': output, **result})
+                    submit(len(done))
+                out.writestr('results.json', json.dumps(summary, ensure_ascii=False, indent=1))
+            self.wfile.write(b'0\r\n\r\n')
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        if status == HTTPStatus.SERVICE_UNAVAILABLE:
+            self.send_header('Retry-After', '1')
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class _ChunkedWriter:
+    """把写入的数据按 HTTP 分块传输编码写出 (不可 seek，zipfile 会改用数据描述符)"""
+
+    def __init__(self, wfile):
+        self.wfile = wfile
+        self.written = 0
+
+    def write(self, data):
+        if data:
+            self.wfile.write(b'%x\r\n' % len(data))
+            self.wfile.write(data)
+            self.wfile.write(b'\r\n')
+            self.written += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.written
+
+    def flush(self):
+        self.wfile.flush()
+
+
+class MirrorServer(ThreadingHTTPServer):
+    """带进程池的 HTTP 服务，同时处理和排队的图片数不超过 max_pending"""
+    daemon_threads = True
+
+    def __init__(self, address, workers=None, max_pending=None, threads=1, profiles=None):
+        super().__init__(address, MirrorHandler)
+        self.workers = max(1, workers or os.cpu_count() or 1)
+        self.threads = threads
+        self.profiles = profiles  # 布局档案文件，只查不写
+        self.max_pending = max_pending or self.workers * QUEUE_PER_WORKER
+        self.pool = ProcessPoolExecutor(max_workers=self.workers)
+        self.pending = 0
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def slot(self, count=1):
+        """占用 count 个名额，名额不够时抛出 503 的 RequestError (空闲时多张的批处理也接受)"""
+        with self.lock:
+            if self.pending and self.pending + count > self.max_pending:
+                raise RequestError(HTTPStatus.SERVICE_UNAVAILABLE, "服务繁忙，请稍后重试")
+            self.pending += count
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.pending -= count
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(cancel_futures=True)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='pindou_mirror serve', description="本地 HTTP 镜像服务")
+    parser.add_argument('--host', default=DEFAULT_HOST, help="监听地址，默认只监听本机 %(default)s")
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help="端口，默认 %(default)s")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help="工作进程数，默认为 CPU 核数")
+    parser.add_argument('--threads', type=int, default=1,
+                        help="每张图片去水印和镜像的线程数，0 为 CPU 核数，默认 %(default)s (已经按进程并行)")
+    parser.add_argument('--profiles', default=None, metavar='PATH',
+                        help="区域或格子数为 auto 时先查这个布局档案文件 (命令行批处理保存的)，默认不查")
+    parser.add_argument('--max-pending', type=int, default=None,
+                        help=f"同时处理和排队的图片数上限，默认为进程数 × {QUEUE_PER_WORKER}")
+    parser.add_argument('--timing-log', default=None,
+                        help="把每张图纸各阶段的用时追加写入此文件 (JSON lines)")
+    parser.add_argument('--profile', default=None, metavar='DIR',
+                        help="用 cProfile 剖析每张图纸，.prof 文件存到此目录")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    # 工作进程继承环境变量
+    if args.timing_log:
+        os.environ[TIMING_LOG_ENV] = os.path.abspath(args.timing_log)
+    if args.profile:
+        os.environ[PROFILE_ENV] = os.path.abspath(args.profile)
+
+    server = MirrorServer((args.host, args.port), args.workers, args.max_pending, args.threads, args.profiles)
+    print(f"镜像服务已启动: http://{args.host}:{server.server_address[1]}  "
+          f"{server.workers} 个进程，最多 {server.max_pending} 张排队", file=sys.stderr)
+    started = time.perf_counter()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"已停止，运行 {time.perf_counter() - started:.0f}s", file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""
+Streamlit 缓存
+按上传内容的哈希和参数缓存解码、区域检测、格子检测和镜像结果，
+页面每次重跑时输入没变就直接取缓存；参数只变了一部分时，每张图片的
+Reprocessor 复用已经去过水印的格子行。布局档案默认每个会话各一份 (见 _profiles)。
+只由 Streamlit 页面导入。
+JPEG 上传时只做 DCT 缩小解码，显示、区域检测和预览都用这张小图，
+原图在检测格子数、处理或查到同尺寸的布局档案时才整图解码。
+"""
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+import streamlit as st
+from PIL import Image
+
+from .decoding import decode_image, decode_reduced, draft_factor, image_header
+from .detect import DEFAULT_GRID_METHOD, detect_grid_size, detect_region
+from .encoding import OUTPUT_FORMATS, encode_image
+from .incremental import Reprocessor
+from .mirror import DEFAULT_TRANSFORM
+from .pipeline import PREVIEW_SIDE, ProcessOptions, progress_fraction, progress_stages, scale_region
+from .profiles import PROFILES_ENV, MemoryProfileStore, ProfileStore
+from .timing import STAGE_LABELS
+
+
+# 缓存条目上限，超出后按最近最少使用淘汰
+MAX_IMAGES = 4
+MAX_RESULTS = 8
+MAX_DETECTIONS = 64
+
+# 上传的图片：内容哈希、显示用图片、它比原图缩小的倍数、原图尺寸 (宽, 高)
+Upload = namedtuple('Upload', ['key', 'view', 'factor', 'size'])
+
+
+def upload_key(uploaded_file):
+    """上传文件内容的哈希，同一个上传文件在会话内只计算一次"""
+    memo = st.session_state.setdefault('_upload_keys', {})
+    file_id = getattr(uploaded_file, 'file_id', None) or (uploaded_file.name, uploaded_file.size)
+    if file_id not in memo:
+        memo.clear()
+        memo[file_id] = hashlib.blake2b(uploaded_file.getvalue(), digest_size=16).hexdigest()
+    return memo[file_id]
+
+
+@st.cache_resource(max_entries=MAX_IMAGES, show_spinner=False)
+def _decode(key, _data):
+    """整图解码上传的图片 (缓存对象在会话间共享，不要修改)"""
+    return Image.fromarray(decode_image(_data))
+
+
+@st.cache_resource(max_entries=MAX_IMAGES, show_spinner=False)
+def _decode_view(key, _data):
+    """显示用的图片，返回 (PIL 图片, 缩小倍数, 原图尺寸)
+
+    JPEG 按 DCT 缩放解出长边不小于 PREVIEW_SIDE 的最小尺寸，不做整图解码；
+    其他格式没有快速的缩小解码，直接用整图解码的原图
+    """
+    fmt, size = image_header(_data)
+    factor = draft_factor(max(size) // PREVIEW_SIDE) if fmt == 'JPEG' else 1
+    if factor == 1:
+        return _decode(key, _data), 1, size
+    return decode_reduced(_data, factor), factor, size
+
+
+def load_upload(uploaded_file):
+    """返回 Upload，原图用 full_image() 取"""
+    key = upload_key(uploaded_file)
+    return Upload(key, *_decode_view(key, uploaded_file.getvalue()))
+
+
+def full_image(uploaded_file):
+    """整图解码的 RGB 原图，检测格子数和处理时才用"""
+    return _decode(upload_key(uploaded_file), uploaded_file.getvalue())
+
+
+def scale_up(region, factor, size):
+    """显示用图片上的区域换算回原图，不超出原图"""
+    width, height = size
+    x1, y1, x2, y2 = region
+    return min(x1 * factor, width), min(y1 * factor, height), min(x2 * factor, width), min(y2 * factor, height)
+
+
+@st.cache_resource(max_entries=2 * MAX_IMAGES, show_spinner=False)
+def _reprocessor(key, factor=1):
+    """每张图片 (原图和缩小的显示用图片各) 一个 Reprocessor，在会话间共享 (内部有锁)"""
+    return Reprocessor()
+
+
+@st.cache_resource(show_spinner=False)
+def _shared_profiles():
+    """磁盘上的布局档案，所有会话共用"""
+    return ProfileStore()
+
+
+def _profiles():
+    """布局档案：设置了环境变量 PINDOU_PROFILES 时用这个文件，所有会话共用 (自己在本机用时)；
+    否则每个会话各一份，只在内存里，不会被其他访问者看到或覆盖"""
+    if os.environ.get(PROFILES_ENV):
+        return _shared_profiles()
+    return st.session_state.setdefault('_profiles', MemoryProfileStore())
+
+
+def lookup_profile(size, uploaded_file):
+    """查布局档案，返回 ((x1, y1, x2, y2), (列数, 行数))，没有同样布局的图纸时返回 None
+
+    档案里没有同尺寸的图纸时不解码原图
+    """
+    profiles = _profiles()
+    if not any(entry.get('size') == list(size) for entry in profiles.load()):
+        return None
+    profile = profiles.lookup(np.asarray(full_image(uploaded_file)))
+    return None if profile is None else (profile.region, profile.grid)
+
+
+def remember_profile(image, region, grid):
+    """把用户确认过的区域和格子数存入布局档案"""
+    try:
+        _profiles().remember(np.asarray(image), region, grid)
+    except OSError:
+        pass  # 档案写不了不影响处理
+
+
+@st.cache_data(max_entries=MAX_DETECTIONS, show_spinner=False)
+def cached_detect_region(key, _view, factor=1, size=None):
+    """在显示用图片上自动检测格子区域，返回原图上的 ((x1, y1, x2, y2), 置信度)
+
+    缩小的图片上检测，边界误差在 factor 像素以内
+    """
+    guess = detect_region(np.asarray(_view))
+    region = tuple(guess[:4]) if factor == 1 else scale_up(guess[:4], factor, size)
+    return region, guess.confidence
+
+
+@st.cache_data(max_entries=MAX_DETECTIONS, show_spinner=False)
+def cached_detect_grid(key, region, _image, method=DEFAULT_GRID_METHOD):
+    """自动检测格子数，检测不到时返回 None"""
+    guess = detect_grid_size(np.asarray(_image), region, method)
+    return None if guess is None else (guess.cols, guess.rows)
+
+
+@st.cache_resource(show_spinner=False)
+def _results():
+    """镜像结果 (最近用过的 MAX_RESULTS 个) 和它的锁，在会话间共享
+
+    不直接用 st.cache_resource 缓存 cached_process：处理时会更新页面上的进度条，
+    缓存命中时 Streamlit 要回放这些更新，进度条是在函数外创建的，回放会出错
+    """
+    return OrderedDict(), threading.Lock()
+
+
+def cached_process(key, region, grid, remove_watermark, image, mode='pixels', progress=None,
+                   transform=DEFAULT_TRANSFORM):
+    """返回 (镜像结果 PIL 图片, 各阶段用时记录)，缓存对象在会话间共享，不要修改
+
+    progress 为进度回调，见 process_with_progress
+    """
+    results, lock = _results()
+    params = (key, tuple(region), tuple(grid), remove_watermark, mode, transform)
+    with lock:
+        if params in results:
+            results.move_to_end(params)
+            return results[params]
+    options = ProcessOptions(remove_watermark=remove_watermark, mode=mode, transform=transform, threads=0)
+    job = _reprocessor(key, 1).process(image, region, grid, options, progress=progress)
+    result = job.image, job.timer.record()
+    with lock:
+        results[params] = result
+        while len(results) > MAX_RESULTS:
+            results.popitem(last=False)
+    return result
+
+
+def process_with_progress(key, region, grid, remove_watermark, image, mode='pixels', transform=DEFAULT_TRANSFORM):
+    """带进度条的 cached_process
+
+    处理按整行格子分条进行，每条之后更新进度条。页面重跑或会话断开 (刷新页面)
+    时 Streamlit 会在下一次更新进度条时中止脚本，处理也随之停下；已经去过水印的
+    格子行保存在这张图片的 Reprocessor 里 (会话间共享)，再次处理时从中断处继续
+    """
+    stages = progress_stages(ProcessOptions(remove_watermark=remove_watermark, mode=mode))
+    bar = st.progress(0.0, text="正在处理...")
+
+    def progress(stage, done, total):
+        fraction = progress_fraction(stages, stage, done, total)
+        bar.progress(fraction, text=f"正在{STAGE_LABELS.get(stage, stage)}... {fraction:.0%}")
+
+    try:
+        return cached_process(key, region, grid, remove_watermark, image, mode=mode, progress=progress,
+                              transform=transform)
+    finally:
+        bar.empty()
+
+
+@st.cache_resource(max_entries=MAX_RESULTS, show_spinner=False)
+def cached_preview(key, region, grid, remove_watermark, _view, factor=1, mode='pixels', transform=DEFAULT_TRANSFORM):
+    """在显示用图片 (缩小 factor 倍) 上做镜像预览，返回 (PIL 图片, 各阶段用时记录, 相对原图的缩小倍数)
+
+    region 为原图上的区域
+    """
+    options = ProcessOptions(remove_watermark=remove_watermark, mode=mode, transform=transform, threads=0)
+    region = scale_region(region, factor) if factor > 1 else region
+    job = _reprocessor(key, factor).preview(_view, region, grid, options)
+    return job.image, job.timer.record(), job.downscale * factor
+
+
+@st.cache_resource(max_entries=MAX_RESULTS, show_spinner=False)
+def cached_encode(key, params, fmt, _image):
+    """编码下载用的结果图片，同一结果和格式只编码一次，缓存对象在会话间共享"""
+    return encode_image(np.asarray(_image), fmt)
+
+
+def download_button(label, image_key, params, image, fmt, file_stem, **kwargs):
+    """下载按钮：点击时才在后台编码 (并缓存)，页面重跑时不再每次编码
+
+    data 传入函数需要 Streamlit 1.52 及以上 (见 requirements.txt)
+    """
+    output = OUTPUT_FORMATS[fmt]
+    return st.download_button(
+        label=label,
+        data=lambda: cached_encode(image_key, params, fmt, image),
+        file_name=file_stem + output.extension,
+        mime=output.mime,
+        **kwargs,
+    )
+
+
+def show_timings(record, page_timer=None):
+    """在折叠面板里显示各阶段用时，page_timer 为页面上显示、编码等额外阶段"""
+    stages = dict(record['stages'])
+    if page_timer is not None:
+        stages.update(page_timer.stages)
+    with st.expander("⏱️ 各阶段用时"):
+        st.caption(f"{record['width']}×{record['height']} 像素 · {record['cols']}列 × {record['rows']}行 "
+                   f"({record['cells']} 格) · 结果来自缓存时显示的是首次计算的用时")
+        st.table({
+            "阶段": [STAGE_LABELS.get(name, name) for name in stages],
+            "用时 (ms)": [f"{seconds * 1000:.1f}" for seconds in stages.values()],
+        })
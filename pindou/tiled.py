@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+"""
+分块处理超大图纸
+原图和结果都放在磁盘上的内存映射文件里，按整行格子分成若干横条，
+每次只对一条做去水印和镜像，最后逐行流式编码成 PNG。
+
+内存上限：.npy 原图直接映射；8 位、非隔行的 PNG 按条解码写入映射文件
+(见 decoding.decode_strips)。自动检测在边长不超过 DETECT_SIDE 的灰度代理图上做，
+只在区域边界附近读原图精修。这些情况下常驻内存约为 band_bytes 加上代理图，与图片大小无关。
+JPEG 等其他格式 PIL 仍要整张解码一次 (随后立即释放)，内存峰值和整张图一样大。
+"""
+
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import traceback
+import zlib
+
+import cv2
+import numpy as np
+
+from .decoding import decode_strips
+from .detect import RegionGuess, default_region, detect_grid_size, detect_region, refine_region
+from .encoding import output_format
+from .grid import row_bands
+from .matrix import grid_line_color, render_cells, sample_cells, sample_count
+from .mirror import build_mirror_map
+from .pipeline import (
+    AUTO, Job, ProcessOptions, apply_profile, band_height, grid_edges, is_manual, normalize_region,
+)
+from .profiles import layout_fingerprint
+from .timing import StageTimer, dedup_context, image_context, log_timing, profiled
+from .watermark import CellCache, remove_watermark_grid
+
+
+# 每条默认占用的内存
+DEFAULT_BAND_BYTES = 64 * 1024 * 1024
+# 解码和复制非格子区域时每次处理的像素行数
+COPY_ROWS = 256
+# 流式写出支持的输出格式 (见 encoding.OUTPUT_FORMATS)
+TILED_FORMATS = ('png', 'png-fast')
+# 自动检测用的灰度代理图的最大边长
+DETECT_SIDE = 4096
+
+
+def open_source(source, workdir):
+    """把原图放进只读的内存映射数组 (H × W × 3 uint8)
+
+    source 可以是数组、.npy 路径或 PIL 能打开的路径/文件对象，图片按条解码写入映射文件
+    """
+    if isinstance(source, np.ndarray):
+        return source
+    if isinstance(source, str) and source.lower().endswith('.npy'):
+        return np.load(source, mmap_mode='r')
+
+    (width, height), strips = decode_strips(source, COPY_ROWS)
+    array = np.lib.format.open_memmap(os.path.join(workdir, 'source.npy'), mode='w+',
+                                      dtype=np.uint8, shape=(height, width, 3))
+    top = 0
+    for strip in strips:
+        array[top:top + len(strip)] = strip
+        top += len(strip)
+    array.flush()
+    return np.load(os.path.join(workdir, 'source.npy'), mmap_mode='r')
+
+
+def detection_proxy(array):
+    """缩小整数倍、边长不超过 DETECT_SIDE 的灰度代理图，按行分段缩小，返回 (代理图, 倍数)
+
+    图片本来就不大时直接返回原图，倍数为 1
+    """
+    height, width = array.shape[:2]
+    factor = -(-max(height, width) // DETECT_SIDE)
+    if factor == 1:
+        return array, 1
+    proxy = np.empty((height // factor, width // factor), dtype=np.uint8)
+    step = max(1, COPY_ROWS // factor) * factor
+    for top in range(0, len(proxy) * factor, step):
+        rows = array[top:min(top + step, len(proxy) * factor), :proxy.shape[1] * factor]
+        gray = cv2.cvtColor(np.ascontiguousarray(rows), cv2.COLOR_RGB2GRAY)
+        proxy[top // factor:top // factor + len(rows) // factor] = cv2.resize(
+            gray, (proxy.shape[1], len(rows) // factor), interpolation=cv2.INTER_AREA)
+    return proxy, factor
+
+
+def _detect_region(array, proxy, factor):
+    """在代理图上检测区域，放大回原图坐标后在边界附近精修"""
+    guess = detect_region(proxy)
+    if factor == 1:
+        return guess
+    height, width = array.shape[:2]
+    if not guess.confidence:
+        # 检测失败，退回按原图尺寸估计的典型布局
+        return RegionGuess(*default_region(width, height), 0.0)
+    region = (min(guess.x1 * factor, width), min(guess.y1 * factor, height),
+              min(guess.x2 * factor, width), min(guess.y2 * factor, height))
+    return RegionGuess(*(refine_region(array, region, 2 * factor + 1) or region), guess.confidence)
+
+
+def _copy_rows(src, dst, top, bottom):
+    """分段复制若干整行"""
+    for start in range(top, bottom, COPY_ROWS):
+        end = min(bottom, start + COPY_ROWS)
+        dst[start:end] = src[start:end]
+
+
+def _bands(mirror_map, band_bytes):
+    """把格子行分成若干条，每条像素数 (含临时内存) 不超过 band_bytes，至少一行格子"""
+    return row_bands(mirror_map.y_edges, band_height(mirror_map, band_bytes))
+
+
+def _write_png(path, array, rows_per_chunk=COPY_ROWS, level=6):
+    """逐行把 H × W × 3 数组写成 PNG，不在内存中生成整张图的编码"""
+    height, width = array.shape[:2]
+
+    def chunk(f, tag, data):
+        f.write(struct.pack('>I', len(data)))
+        f.write(tag)
+        f.write(data)
+        f.write(struct.pack('>I', zlib.crc32(data, zlib.crc32(tag)) & 0xffffffff))
+
+    compressor = zlib.compressobj(level)
+    with open(path, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        chunk(f, b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+        for top in range(0, height, rows_per_chunk):
+            rows = np.asarray(array[top:top + rows_per_chunk])
+            # 每行前加过滤类型 0
+            raw = np.zeros((len(rows), width * 3 + 1), dtype=np.uint8)
+            raw[:, 1:] = rows.reshape(len(rows), -1)
+            data = compressor.compress(raw.tobytes())
+            if data:
+                chunk(f, b'IDAT', data)
+        chunk(f, b'IDAT', compressor.flush())
+        chunk(f, b'IEND', b'')
+
+
+def _run_tiled(job, output_path, workdir, band_bytes):
+    """process_tiled 的各阶段"""
+    options = job.options
+    timer = job.timer
+    with timer.stage('decode'):
+        array = job.array = open_source(job.source, workdir)
+
+    with timer.stage('detect'):
+        manual = is_manual(job)
+        apply_profile(job)
+        proxy, factor = array, 1
+        if not is_manual(job):
+            proxy, factor = detection_proxy(array)
+        if job.region is None or job.region == AUTO:
+            guess = _detect_region(array, proxy, factor)
+            job.region = guess[:4]
+            job.region_confidence = guess.confidence
+        job.region = normalize_region(job.region)
+        if job.grid is None or job.grid == AUTO:
+            x1, y1, x2, y2 = (v // factor for v in job.region)
+            guess = detect_grid_size(proxy, (x1, y1, max(x2, x1 + 1), max(y2, y1 + 1)), options.grid_method)
+            if guess is None:
+                raise ValueError("无法自动检测格子数")
+            job.grid = (guess.cols, guess.rows)
+        cols, rows = (int(v) for v in job.grid)
+        if cols < 1 or rows < 1:
+            raise ValueError("格子数必须大于 0")
+        job.grid = (cols, rows)
+        if manual and options.profiles:
+            # 原图的内存映射在返回前就释放了，指纹要趁现在算
+            job.fingerprint = layout_fingerprint(array, job.region, job.grid)
+        mirror_map = job.mirror_map = build_mirror_map(*job.region, cols, rows, *grid_edges(job), options.transform)
+
+    with timer.stage('mirror'):
+        out = job.output = np.lib.format.open_memmap(os.path.join(workdir, 'output.npy'), mode='w+',
+                                                     dtype=np.uint8, shape=array.shape)
+        _copy_rows(array, out, 0, array.shape[0])
+
+    x_edges, y_edges = mirror_map.x_edges, mirror_map.y_edges
+    y1 = mirror_map.bounds[1]
+    matrix_mode = options.mode == 'matrix'
+    if matrix_mode:
+        grid_color = grid_line_color(array, x_edges, y_edges)
+        y_samples = sample_count(y_edges)
+    stats = {}
+    cache = CellCache()  # 各条共用，相同的格子只算一次
+
+    for row_start, row_end in _bands(mirror_map, band_bytes):
+        # 源格子：不转置时是若干整行，转置时是若干整列
+        src_start, src_end = mirror_map.source_rows(row_start, row_end)
+        col_start, col_end = mirror_map.source_cols(row_start, row_end)
+        band_edges = y_edges[src_start:src_end + 1]
+        band_x_edges = x_edges[col_start:col_end + 1]
+        if matrix_mode:
+            # 色块模式：只对本条采样，按目标顺序重绘
+            with timer.stage('mirror'):
+                matrix = sample_cells(array, band_x_edges, band_edges, y_samples)
+                matrix = mirror_map.permute_cells(matrix, row_start, row_end, src_start, col_start)
+                render_cells(matrix, x_edges, y_edges[row_start:row_end + 1], out, grid_color,
+                             row_end == len(y_edges) - 1)
+            continue
+        with timer.stage('dewatermark'):
+            if options.remove_watermark:
+                block = remove_watermark_grid(array, band_x_edges, band_edges, stats=stats, cache=cache)
+            else:
+                block = array[band_edges[0]:band_edges[-1], band_x_edges[0]:band_x_edges[-1]]
+        with timer.stage('mirror'):
+            mirror_map.apply_band(block, int(band_edges[0]), out, row_start, row_end, int(band_x_edges[0]))
+
+    if stats:
+        timer.context.update(dedup_context(stats))
+    with timer.stage('encode'):
+        out.flush()
+        level = output_format(options.output_format or 'png').params.get('compress_level', 6)
+        _write_png(output_path, out, level=level)
+
+
+def process_tiled(source, output_path, region=None, grid=None, options=None,
+                  workdir=None, band_bytes=DEFAULT_BAND_BYTES):
+    """分块处理一张图纸并直接写出 PNG，结果与 process() 逐像素一致
+
+    options.output_format 只能是 TILED_FORMATS 之一 (或 None，按 png 处理)。
+    返回 Job，encoded 为 None。指定了 workdir 时 array 和 output 为其中的内存映射数组，
+    由调用方在用完后删除；否则临时目录在返回前删除，array 和 output 为 None
+    """
+    options = options or ProcessOptions()
+    if options.output_format and options.output_format.lower() not in TILED_FORMATS:
+        raise ValueError(f"分块处理只支持 {', '.join(TILED_FORMATS)} 格式")
+    own_workdir = workdir is None
+    workdir = workdir or tempfile.mkdtemp(prefix='pindou_')
+    job = Job(source, region=region, grid=grid, options=options, timer=StageTimer())
+    try:
+        with profiled('tiled'):
+            _run_tiled(job, output_path, workdir, band_bytes)
+        job.timer.context.update(image_context(job.array, job.grid), mode=options.mode, tiled=True)
+        log_timing(job.timer)
+        return job
+    finally:
+        if own_workdir:
+            # Windows 上映射着的文件删不掉：先释放 Job 里的内存映射，出错时还要清掉
+            # 异常回溯中各帧引用的数组
+            job.array = job.output = job.cleaned = None
+            if sys.exc_info()[2] is not None:
+                traceback.clear_frames(sys.exc_info()[2])
+            shutil.rmtree(workdir, ignore_errors=True)
@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+"""
+去水印引擎
+对整个格子区域一次性向量化计算，结果与逐格逐像素的版本完全一致：
+- 背景候选：亮度 >= 60，且不是灰色水印 (色差 < 15 且 100 < 亮度 < 200)
+- 背景色：候选像素按 8 级量化后出现最多的颜色 (并列取最先出现的)，
+  再取离它最近的候选像素 (并列取最先出现的)
+- 水印像素：色差 < 20 且 90 < 亮度 < 210，替换为背景色
+
+每个格子的结果只取决于格子本身的像素，所以先把尺寸和内容都相同的格子
+合并，每种格子只算一次再填回去 (图纸里大片同色或空白的格子很多)。
+合并按每个格子的 64 位哈希排序 (numpy 里算，不占 GIL)，再逐像素核对，哈希碰撞时退回按内容排序。
+分条处理时各条共用一个 CellCache，前面的条算过的格子后面的条直接取用，
+去重的命中率和整个区域一次处理时相近。
+"""
+
+import threading
+
+import numpy as np
+
+
+# CellCache 默认最多保存这么多字节的格子 (原格子和去水印结果)
+CELL_CACHE_BYTES = 4 * 1024 * 1024
+# CellCache 里同一种尺寸的格子攒到这么多段时合并成一段
+CACHE_SEGMENTS = 8
+
+
+def _cell_labels(x_edges, y_edges):
+    """每个像素所属格子编号，不在任何格子内的像素编号为 rows*cols"""
+    x_edges = np.asarray(x_edges) - x_edges[0]
+    y_edges = np.asarray(y_edges) - y_edges[0]
+    cols = len(x_edges) - 1
+    rows = len(y_edges) - 1
+    n_cells = rows * cols
+
+    col_label = np.searchsorted(x_edges, np.arange(x_edges[-1]), side='right') - 1
+    row_label = np.searchsorted(y_edges, np.arange(y_edges[-1]), side='right') - 1
+
+    labels = row_label[:, None].astype(np.int32) * cols + col_label[None, :].astype(np.int32)
+    labels[(row_label < 0) | (row_label >= rows), :] = n_cells
+    labels[:, (col_label < 0) | (col_label >= cols)] = n_cells
+    return labels.ravel(), n_cells
+
+
+def _first_per_cell(cell, *keys):
+    """按 (cell, *keys) 排序后，返回每个格子排第一的元素下标"""
+    order = np.lexsort(tuple(reversed(keys)) + (cell,))
+    sorted_cell = cell[order]
+    head = np.empty(len(order), dtype=bool)
+    head[:1] = True
+    head[1:] = sorted_cell[1:] != sorted_cell[:-1]
+    return order[head]
+
+
+def _axis_groups(edges):
+    """按格子边长分组，返回 {边长: 该边长的格子起点 (相对 edges[0])}"""
+    edges = np.asarray(edges)
+    sizes = np.diff(edges)
+    starts = edges[:-1] - edges[0]
+    return {int(size): starts[sizes == size] for size in np.unique(sizes) if size > 0}
+
+
+def _cell_hashes(flat):
+    """每行 (一个格子的全部像素) 的 64 位哈希：每 8 字节一组乘以固定的随机奇数再求和
+
+    不同的格子可能哈希相同，用到的地方都要核对内容
+    """
+    pad = -flat.shape[1] % 8
+    if pad:
+        flat = np.pad(flat, ((0, 0), (0, pad)))
+    words = flat.view(np.uint64)
+    weights = np.random.default_rng(words.shape[1]).integers(1, 2 ** 63, words.shape[1], dtype=np.uint64)
+    return (words * (weights | np.uint64(1))).sum(axis=1, dtype=np.uint64)
+
+
+def _dedup(flat):
+    """按内容去重，返回 (每种内容第一次出现的下标, 每行对应的去重下标, 每种内容的哈希)"""
+    hashes = _cell_hashes(flat)
+    _, first, inverse = np.unique(hashes, return_index=True, return_inverse=True)
+    inverse = inverse.ravel()
+    if not np.array_equal(flat, flat[first[inverse]]):
+        # 哈希碰撞：按内容排序
+        keys = flat.view(np.dtype((np.void, flat.shape[1]))).ravel()
+        _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        inverse = inverse.ravel()
+    return first, inverse, hashes[first]
+
+
+def _unique_cells(region, x_edges, y_edges):
+    """把尺寸相同的格子按内容去重
+
+    返回 [(行像素下标, 列像素下标, 去重后的格子, 每个格子对应的去重下标, 去重后的哈希), ...]，
+    每种格子尺寸一项；行像素下标 nr × h，列像素下标 nc × w，去重后的格子 u × h × w × 3
+    """
+    groups = []
+    for h, tops in _axis_groups(y_edges).items():
+        for w, lefts in _axis_groups(x_edges).items():
+            rows = tops[:, None] + np.arange(h)
+            cols = lefts[:, None] + np.arange(w)
+            # 先取出这些行、列 (nr·h × nc·w × 3)，再排成 nr × nc × h × w × 3，每个格子的像素连续存放
+            block = region.take(rows.ravel(), axis=0).take(cols.ravel(), axis=1)
+            cells = block.reshape(len(tops), h, len(lefts), w, 3).transpose(0, 2, 1, 3, 4)
+            flat = np.ascontiguousarray(cells).reshape(len(tops) * len(lefts), -1)
+            first, inverse, hashes = _dedup(flat)
+            groups.append((rows, cols, flat[first].reshape(-1, h, w, 3), inverse, hashes))
+    return groups
+
+
+class CellCache:
+    """分条去水印时各条共用的结果，按格子尺寸、哈希和内容查找 (线程安全)
+
+    每次存入的一批格子按哈希排好序作为一段，查找时在各段里二分再逐像素核对原格子。
+    排序、查找、核对和合并都在锁外做，锁里只取段列表和追加新段。
+    超过 max_bytes 后不再存入新的格子；几条同时遇到同一种新格子时可能各算一次
+    """
+
+    def __init__(self, max_bytes=CELL_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.segments = {}  # (h, w) → [(排好序的哈希, 原格子, 去水印结果), ...]
+        self.lock = threading.Lock()
+
+    def lookup(self, hashes, cells):
+        """已经算过的格子，返回 (在 cells 中的下标, 对应的去水印结果)"""
+        with self.lock:
+            segments = list(self.segments.get(cells.shape[1:3], ()))
+        index = np.arange(len(cells))
+        hit_index, hit_cells = [], []
+        for keys, originals, cleaned in segments:
+            if not len(index):
+                break
+            pos = np.minimum(np.searchsorted(keys, hashes[index]), len(keys) - 1)
+            hit = keys[pos] == hashes[index]
+            hit[hit] = (originals[pos[hit]] == cells[index[hit]]).all(axis=(1, 2, 3))
+            hit_index.append(index[hit])
+            hit_cells.append(cleaned[pos[hit]])
+            index = index[~hit]
+        if not hit_index:
+            return index[:0], cells[:0]
+        return np.concatenate(hit_index), np.concatenate(hit_cells)
+
+    def store(self, hashes, cells, cleaned):
+        if not len(cells):
+            return
+        size = cells.shape[1:3]
+        per_cell = cells[0].nbytes + cleaned[0].nbytes
+        with self.lock:
+            count = min(len(cells), (self.max_bytes - self.nbytes) // per_cell)
+            if count <= 0:
+                return
+            self.nbytes += count * per_cell
+        order = np.argsort(hashes[:count], kind='stable')
+        segment = (hashes[:count][order], cells[:count][order], cleaned[:count][order])
+        with self.lock:
+            segments = self.segments.setdefault(size, [])
+            segments.append(segment)
+            if len(segments) < CACHE_SEGMENTS:
+                return
+            merging = list(segments)
+        merged = tuple(np.concatenate(parts) for parts in zip(*merging))
+        order = np.argsort(merged[0], kind='stable')
+        merged = tuple(part[order] for part in merged)
+        with self.lock:
+            segments = self.segments[size]
+            # 合并期间别的线程追加的段留在后面；别的线程先合并完了就放弃这次合并
+            if len(segments) >= len(merging) and all(a is b for a, b in zip(segments, merging)):
+                self.segments[size] = [merged] + segments[len(merging):]
+
+
+def remove_watermark_grid(img_array, x_edges, y_edges, dedup=True, stats=None, cache=None):
+    """对整个格子区域去水印
+
+    x_edges / y_edges 为格子边界 (图片坐标)，每个格子单独估计背景色。
+    dedup 为真时相同的格子只算一次，传入 cache (CellCache) 时还会复用其他条算过的格子；
+    传入 stats 字典时累加 cells (格子数) 和 unique_cells (实际计算的格子数)。
+    返回去水印后的区域 img_array[y_edges[0]:y_edges[-1], x_edges[0]:x_edges[-1]] 副本
+    """
+    region = img_array[y_edges[0]:y_edges[-1], x_edges[0]:x_edges[-1]]
+    n_cells = (len(x_edges) - 1) * (len(y_edges) - 1)
+    if not dedup or region.size == 0:
+        if stats is not None:
+            stats['cells'] = stats.get('cells', 0) + n_cells
+            stats['unique_cells'] = stats.get('unique_cells', 0) + n_cells
+        return _remove_watermark(region, x_edges, y_edges)
+
+    result = np.empty_like(region)
+    computed = 0
+    for rows, cols, unique, inverse, hashes in _unique_cells(region, x_edges, y_edges):
+        h, w = unique.shape[1:3]
+        if cache is None:
+            cleaned = _clean_cells(unique)
+            computed += len(unique)
+        else:
+            cleaned = np.empty_like(unique)
+            hits, found = cache.lookup(hashes, unique)
+            cleaned[hits] = found
+            missing = np.ones(len(unique), dtype=bool)
+            missing[hits] = False
+            if missing.any():
+                cleaned[missing] = _clean_cells(unique[missing])
+                cache.store(hashes[missing], unique[missing], cleaned[missing])
+            computed += int(missing.sum())
+        block = cleaned[inverse].reshape(len(rows), len(cols), h, w, 3).transpose(0, 2, 1, 3, 4)
+        _put_block(result, rows.ravel(), cols.ravel(), block.reshape(len(rows) * h, len(cols) * w, 3))
+    if stats is not None:
+        stats['cells'] = stats.get('cells', 0) + n_cells
+        stats['unique_cells'] = stats.get('unique_cells', 0) + computed
+    return result
+
+
+def _put_block(result, rows, cols, block):
+    """result[np.ix_(rows, cols)] = block，连续的行或列用切片 (格子一样大时通常都是连续的)"""
+    if rows[-1] - rows[0] + 1 == len(rows):
+        result[rows[0]:rows[-1] + 1][:, cols] = block
+    elif cols[-1] - cols[0] + 1 == len(cols):
+        result[:, cols[0]:cols[-1] + 1][rows] = block
+    else:
+        result[np.ix_(rows, cols)] = block
+
+
+def _clean_cells(cells):
+    """对同样尺寸的一组格子 (u × h × w × 3) 去水印：排成一行一起处理"""
+    u, h, w = cells.shape[:3]
+    strip = cells.transpose(1, 0, 2, 3).reshape(h, u * w, 3)
+    cleaned = _remove_watermark(strip, np.arange(u + 1) * w, [0, h])
+    return cleaned.reshape(h, u, w, 3).transpose(1, 0, 2, 3)
+
+
+def _remove_watermark(region, x_edges, y_edges):
+    """remove_watermark_grid 的实际计算，region 为格子区域 (从 x_edges[0], y_edges[0] 开始)"""
+    result = region.copy()
+    if region.size == 0:
+        return result
+
+    labels, n_cells = _cell_labels(x_edges, y_edges)
+
+    pixels = region.reshape(-1, 3).astype(np.int16)
+    r, g, b = pixels[:, 0], pixels[:, 1], pixels[:, 2]
+    brightness3 = r + g + b  # 亮度 × 3，全部用整数比较
+    diff = np.maximum(np.maximum(np.abs(r - g), np.abs(g - b)), np.abs(r - b))
+
+    # 找背景色候选
+    is_candidate = (brightness3 >= 180) & ~((diff < 15) & (brightness3 > 300) & (brightness3 < 600))
+    is_candidate &= labels < n_cells
+    cand_idx = np.flatnonzero(is_candidate)
+    if len(cand_idx) == 0:
+        return result
+
+    cand = pixels[cand_idx]
+    cand_cell = labels[cand_idx].astype(np.int64)
+
+    # 每个格子出现最多的量化颜色 (并列时取最先出现的)
+    quantized = (cand[:, 0] >> 3).astype(np.int64) << 10 | (cand[:, 1] >> 3) << 5 | (cand[:, 2] >> 3)
+    keys, first, counts = np.unique(cand_cell << 15 | quantized, return_index=True, return_counts=True)
+    key_cell = keys >> 15
+    best = _first_per_cell(key_cell, -counts, first)
+
+    dominant = np.zeros((n_cells, 3), dtype=np.int32)
+    q = keys[best] & 0x7fff
+    dominant[key_cell[best]] = np.stack([(q >> 10) << 3, ((q >> 5) & 31) << 3, (q & 31) << 3], axis=1)
+
+    # 离主色最近的候选像素作为背景色 (并列时取最先出现的)
+    dist = ((cand.astype(np.int32) - dominant[cand_cell]) ** 2).sum(axis=1)
+    nearest = _first_per_cell(cand_cell, dist, np.arange(len(cand_idx)))
+
+    bg_colors = np.zeros((n_cells + 1, 3), dtype=region.dtype)
+    has_bg = np.zeros(n_cells + 1, dtype=bool)
+    bg_colors[cand_cell[nearest]] = cand[nearest]
+    has_bg[cand_cell[nearest]] = True
+
+    # 替换水印像素
+    is_watermark = (diff < 20) & (brightness3 > 270) & (brightness3 < 630)
+    is_watermark &= has_bg[labels]
+    flat = result.reshape(-1, 3)
+    flat[is_watermark] = bg_colors[labels[is_watermark]]
+    return result
+
+
+def remove_watermark_from_cell(cell_array):
+    """从单个格子中去除水印"""
+    h, w = cell_array.shape[:2]
+    return remove_watermark_grid(cell_array, [0, w], [0, h], dedup=False)
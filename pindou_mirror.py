@@ -5,15 +5,136 @@
 功能：将拼豆图纸水平镜像，保持文字正常，去除水印
 - 支持自动检测格子数量
 - 适配各种尺寸的图纸
+- 命令行批量处理: python pindou_mirror.py 图纸/*.png --workers 8
+- 状态栏显示各阶段用时，设置 PINDOU_TIMING_LOG / PINDOU_PROFILE 可记录日志和剖析
 """
 
 import tkinter as tk
 from tkinter import filedialog, messagebox, ttk
-from PIL import Image, ImageTk, ImageDraw
+from PIL import Image, ImageTk
 import numpy as np
-import cv2
+import multiprocessing
 import os
-from collections import Counter
+import queue
+import sys
+import threading
+import traceback
+
+from pindou import (
+    DEFAULT_GRID_METHOD, DEFAULT_TRANSFORM, LOW_CONFIDENCE, TRANSFORMS, Cancelled, ProcessOptions, Reprocessor,
+    detect_grid_size, detect_region, output_name,
+)
+from pindou.cli import main as batch_main
+from pindou.decoding import decode_image, decode_reduced, draft_factor, image_header
+from pindou.encoding import format_for_path, save_image
+from pindou.pipeline import progress_fraction, progress_stages
+from pindou.preview import PreviewPyramid, fit_scale
+from pindou.profiles import ProfileStore
+from pindou.server import main as serve_main
+from pindou.timing import StageTimer, image_context, log_timing
+
+# 格子数检测方法的显示名称
+GRID_METHOD_LABELS = {
+    'periodic': "周期 (快)",
+    'hough': "霍夫直线",
+}
+
+STAGE_NAMES = {
+    'dewatermark': "去水印",
+    'mirror': "镜像",
+}
+
+# 后台任务结果的轮询间隔 (毫秒)
+POLL_INTERVAL = 50
+
+# 窗口大小停止变化这么久之后才重绘 (毫秒)
+RESIZE_DELAY = 100
+
+# 参数停止变化这么久之后才刷新预览 (毫秒)
+PREVIEW_DELAY = 300
+
+
+class CanvasView:
+    """画布上显示的一张图片
+
+    每张图片只建一次预览金字塔，按画布大小取最接近的一层缩放；
+    显示尺寸不变时复用同一个 PhotoImage，选区框是画布上的矩形，不重绘图片
+    """
+
+    def __init__(self, canvas):
+        self.canvas = canvas
+        self.pyramid = None
+        self.photo = None
+        self.image_item = None
+        self.selection_item = None
+        self.rendered = None  # 当前 PhotoImage 显示的 (金字塔, 尺寸)
+        self.scale = 1.0
+        self.offset = (0, 0)
+    
+    def clear(self):
+        self.canvas.delete("all")
+        self.pyramid = None
+        self.photo = None
+        self.image_item = None
+        self.selection_item = None
+        self.rendered = None
+    
+    def canvas_size(self):
+        width = self.canvas.winfo_width()
+        height = self.canvas.winfo_height()
+        if width <= 1 or height <= 1:
+            return 650, 750
+        return width, height
+    
+    def show(self, image):
+        if self.pyramid is None or self.pyramid.image is not image:
+            self.pyramid = PreviewPyramid(image)
+        self.redraw()
+    
+    def redraw(self):
+        if self.pyramid is None:
+            return
+        canvas_width, canvas_height = self.canvas_size()
+        img_width, img_height = self.pyramid.size
+        scale = fit_scale((img_width, img_height), (canvas_width, canvas_height))
+        size = (max(1, int(img_width * scale)), max(1, int(img_height * scale)))
+        
+        if self.rendered != (self.pyramid, size):
+            preview = self.pyramid.render(*size)
+            if self.photo is not None and (self.photo.width(), self.photo.height()) == size:
+                self.photo.paste(preview)
+            else:
+                self.photo = ImageTk.PhotoImage(preview)
+            self.rendered = (self.pyramid, size)
+        
+        self.scale = scale
+        self.offset = ((canvas_width - size[0]) // 2, (canvas_height - size[1]) // 2)
+        if self.image_item is None:
+            self.image_item = self.canvas.create_image(canvas_width // 2, canvas_height // 2,
+                                                       anchor=tk.CENTER, image=self.photo)
+        else:
+            self.canvas.coords(self.image_item, canvas_width // 2, canvas_height // 2)
+            self.canvas.itemconfigure(self.image_item, image=self.photo)
+    
+    def to_image(self, x, y):
+        """画布坐标转成原图坐标"""
+        return int((x - self.offset[0]) / self.scale), int((y - self.offset[1]) / self.scale)
+    
+    def set_selection(self, box):
+        """在原图坐标 box = (x1, y1, x2, y2) 处画红框，None 时隐藏"""
+        if box is None:
+            if self.selection_item is not None:
+                self.canvas.itemconfigure(self.selection_item, state=tk.HIDDEN)
+            return
+        x1, y1, x2, y2 = box
+        coords = (self.offset[0] + x1 * self.scale - 1, self.offset[1] + y1 * self.scale - 1,
+                  self.offset[0] + x2 * self.scale + 1, self.offset[1] + y2 * self.scale + 1)
+        if self.selection_item is None:
+            self.selection_item = self.canvas.create_rectangle(*coords, outline='red', width=3)
+        else:
+            self.canvas.coords(self.selection_item, *coords)
+            self.canvas.itemconfigure(self.selection_item, state=tk.NORMAL)
+            self.canvas.tag_raise(self.selection_item)
 
 
 class PindouMirrorApp:
@@ -26,8 +147,11 @@ class PindouMirrorApp:
         # 图片变量
         self.original_image = None
         self.processed_image = None
+        self.reprocessor = Reprocessor()  # 复用上一次处理的中间结果，换图片时自动清空
+        self.profiles = ProfileStore()  # 确认过的图纸布局，载入同样布局的图纸时直接套用
         self.image_path = None
         self.display_scale = 1.0
+        self.resize_job = None
         
         # 网格参数
         self.grid_cols = tk.IntVar(value=52)
@@ -45,7 +169,39 @@ class PindouMirrorApp:
         # 去水印选项
         self.remove_watermark = tk.BooleanVar(value=True)
         
+        # 色块重绘模式
+        self.matrix_mode = tk.BooleanVar(value=False)
+        
+        # 格子怎样重排 (左右翻转、上下翻转等)
+        self.transform = tk.StringVar(value=TRANSFORMS[DEFAULT_TRANSFORM])
+        
+        # 格子数检测方法
+        self.grid_method = tk.StringVar(value=GRID_METHOD_LABELS[DEFAULT_GRID_METHOD])
+        
+        # 快速预览：调参时在缩小的图上处理，保存时才处理原图
+        self.live_preview = tk.BooleanVar(value=True)
+        self.processed_params = None  # processed_image 对应的 (区域, 格子数, 选项)
+        self.processed_full = False  # processed_image 是否为原图分辨率
+        self.preview_job = None
+        
+        # 后台任务：工作线程只往队列里放消息，由主线程用 after 轮询取出
+        self.task_queue = queue.Queue()
+        self.task_id = 0
+        self.task_kind = None
+        self.task_cancel = None
+        self.task_stages = ()
+        self.task_done = None
+        self.polling = False
+        
         self.setup_ui()
+        
+        # 格子区域或格子数变化时取消正在进行的任务
+        for var in (self.cell_x1, self.cell_y1, self.cell_x2, self.cell_y2):
+            var.trace_add('write', lambda *args: self.cancel_task(('region', 'detect', 'process'), "参数已修改，已取消"))
+            var.trace_add('write', lambda *args: self.schedule_preview())
+        for var in (self.grid_cols, self.grid_rows, self.remove_watermark, self.matrix_mode, self.transform):
+            var.trace_add('write', lambda *args: self.cancel_task(('process',), "参数已修改，已取消"))
+            var.trace_add('write', lambda *args: self.schedule_preview())
     
     def setup_ui(self):
         main_frame = tk.Frame(self.root, bg='#2b2b2b')
@@ -76,6 +232,8 @@ class PindouMirrorApp:
         # 自动检测格子数按钮
         tk.Button(row1, text="🔍 自动检测格子数", command=self.auto_detect_grid_size,
                   bg='#9b59b6', fg='white', **btn_style).pack(side=tk.LEFT, padx=3)
+        ttk.Combobox(row1, textvariable=self.grid_method, values=list(GRID_METHOD_LABELS.values()),
+                     state='readonly', width=10, font=('Microsoft YaHei', 9)).pack(side=tk.LEFT, padx=3)
         
         ttk.Separator(row1, orient=tk.VERTICAL).pack(side=tk.LEFT, fill=tk.Y, padx=8, pady=5)
         
@@ -122,6 +280,14 @@ class PindouMirrorApp:
         tk.Checkbutton(row2, text="去除水印", variable=self.remove_watermark,
                        bg='#3c3c3c', fg='white', selectcolor='#2b2b2b',
                        font=('Microsoft YaHei', 9), activebackground='#3c3c3c').pack(side=tk.RIGHT, padx=10)
+        tk.Checkbutton(row2, text="快速预览", variable=self.live_preview,
+                       bg='#3c3c3c', fg='white', selectcolor='#2b2b2b',
+                       font=('Microsoft YaHei', 9), activebackground='#3c3c3c').pack(side=tk.RIGHT, padx=(10, 0))
+        tk.Checkbutton(row2, text="色块重绘", variable=self.matrix_mode,
+                       bg='#3c3c3c', fg='white', selectcolor='#2b2b2b',
+                       font=('Microsoft YaHei', 9), activebackground='#3c3c3c').pack(side=tk.RIGHT, padx=(10, 0))
+        ttk.Combobox(row2, textvariable=self.transform, values=list(TRANSFORMS.values()),
+                     state='readonly', width=16, font=('Microsoft YaHei', 9)).pack(side=tk.RIGHT, padx=(10, 0))
         
         # 图片显示区域
         image_frame = tk.Frame(main_frame, bg='#2b2b2b')
@@ -142,13 +308,107 @@ class PindouMirrorApp:
         self.right_canvas = tk.Canvas(right_frame, bg='#1e1e1e', highlightthickness=0)
         self.right_canvas.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
         
+        self.views = {self.left_canvas: CanvasView(self.left_canvas),
+                      self.right_canvas: CanvasView(self.right_canvas)}
+        
+        status_frame = tk.Frame(self.root, bg='#1e1e1e')
+        status_frame.pack(fill=tk.X, side=tk.BOTTOM)
+        
+        self.cancel_button = tk.Button(status_frame, text="✖ 取消", command=self.cancel_task, state=tk.DISABLED,
+                                       bg='#555', fg='white', font=('Microsoft YaHei', 8), relief=tk.FLAT,
+                                       padx=6, pady=1, cursor='hand2')
+        self.cancel_button.pack(side=tk.RIGHT, padx=(5, 10))
+        self.progress = ttk.Progressbar(status_frame, mode='determinate', maximum=100, length=200)
+        self.progress.pack(side=tk.RIGHT, padx=5)
+        
         self.status_var = tk.StringVar(value="步骤: 1.上传图片 → 2.设置格子区域 → 3.自动检测或手动设置格子数 → 4.镜像处理")
-        status_bar = tk.Label(self.root, textvariable=self.status_var, bg='#1e1e1e', fg='#aaaaaa',
+        status_bar = tk.Label(status_frame, textvariable=self.status_var, bg='#1e1e1e', fg='#aaaaaa',
                               font=('Microsoft YaHei', 9), anchor=tk.W, padx=10, pady=5)
-        status_bar.pack(fill=tk.X, side=tk.BOTTOM)
+        status_bar.pack(fill=tk.X, side=tk.LEFT, expand=True)
         
         self.root.bind('<Configure>', self.on_resize)
     
+    def run_task(self, kind, work, on_done, message, stages=()):
+        """在工作线程中运行 work(cancel, progress)，完成后在主线程调用 on_done(结果)
+
+        同时只有一个任务，新任务会取消旧任务；旧任务的结果到达后直接丢弃。
+        stages 为会报告进度的阶段，用来换算进度条的百分比
+        """
+        self.cancel_task()
+        self.task_id += 1
+        task_id = self.task_id
+        cancel = threading.Event()
+        self.task_kind = kind
+        self.task_cancel = cancel
+        
+        def progress(stage, done, total):
+            self.task_queue.put((task_id, 'progress', (stage, done, total)))
+        
+        def target():
+            try:
+                result = work(cancel, progress)
+            except Cancelled:
+                self.task_queue.put((task_id, 'cancelled', None))
+            except Exception as e:
+                traceback.print_exc()
+                self.task_queue.put((task_id, 'error', e))
+            else:
+                self.task_queue.put((task_id, 'done', result))
+        
+        self.task_done = on_done
+        self.task_stages = stages
+        self.progress.configure(value=0)
+        self.cancel_button.configure(state=tk.NORMAL)
+        self.status_var.set(message)
+        threading.Thread(target=target, daemon=True).start()
+        if not self.polling:
+            self.polling = True
+            self.root.after(POLL_INTERVAL, self.poll_task)
+    
+    def cancel_task(self, kinds=None, message="已取消"):
+        """取消正在进行的任务 (kinds 不为 None 时只取消这些类型的任务)"""
+        if self.task_cancel is None or (kinds is not None and self.task_kind not in kinds):
+            return
+        self.task_cancel.set()
+        self.finish_task()
+        self.status_var.set(message)
+    
+    def finish_task(self):
+        self.task_id += 1  # 之后到达的旧消息全部作废
+        self.task_kind = None
+        self.task_cancel = None
+        self.progress.configure(value=0)
+        self.cancel_button.configure(state=tk.DISABLED)
+    
+    def poll_task(self):
+        """主线程中取出工作线程的消息"""
+        while True:
+            try:
+                task_id, kind, payload = self.task_queue.get_nowait()
+            except queue.Empty:
+                break
+            if task_id != self.task_id:
+                continue
+            if kind == 'progress':
+                stage, done, total = payload
+                percent = 100 * progress_fraction(self.task_stages, stage, done, total)
+                self.progress.configure(value=percent)
+                self.status_var.set(f"正在{STAGE_NAMES.get(stage, stage)}... {percent:.0f}%")
+                continue
+            on_done = self.task_done
+            self.finish_task()
+            if kind == 'done':
+                on_done(payload)
+            elif kind == 'error':
+                messagebox.showerror("错误", f"处理失败: {str(payload)}")
+                self.status_var.set(f"失败: {str(payload)}")
+            else:
+                self.status_var.set("已取消")
+        if self.task_cancel is not None:
+            self.root.after(POLL_INTERVAL, self.poll_task)
+        else:
+            self.polling = False
+    
     def set_grid_size(self, cols, rows):
         """设置预设的格子数量"""
         self.grid_cols.set(cols)
@@ -172,20 +432,8 @@ class PindouMirrorApp:
         if mode == "none":
             return
         
-        canvas_width = self.left_canvas.winfo_width()
-        canvas_height = self.left_canvas.winfo_height()
-        
         img_width, img_height = self.original_image.size
-        scale = min(canvas_width / img_width, canvas_height / img_height, 1.0)
-        
-        display_width = int(img_width * scale)
-        display_height = int(img_height * scale)
-        
-        offset_x = (canvas_width - display_width) // 2
-        offset_y = (canvas_height - display_height) // 2
-        
-        img_x = int((event.x - offset_x) / scale)
-        img_y = int((event.y - offset_y) / scale)
+        img_x, img_y = self.views[self.left_canvas].to_image(event.x, event.y)
         
         img_x = max(0, min(img_x, img_width - 1))
         img_y = max(0, min(img_y, img_height - 1))
@@ -210,33 +458,87 @@ class PindouMirrorApp:
         file_path = filedialog.askopenfilename(title="选择拼豆图纸", filetypes=file_types)
         
         if file_path:
+            self.cancel_task()
+            timer = StageTimer()
             try:
-                self.image_path = file_path
-                self.original_image = Image.open(file_path).convert('RGB')
-                self.processed_image = None
-                self.display_image(self.original_image, self.left_canvas)
-                self.right_canvas.delete("all")
-                
-                self.auto_detect_region()
-                
-                self.status_var.set(f"已加载: {os.path.basename(file_path)} - 请设置格子区域并检测格子数")
+                # 原图在后台解码；JPEG 先按显示区域缩小解码 (DCT 缩放，不做整图解码) 马上显示
+                fmt, size = image_header(file_path)
+                quick = None
+                if fmt == 'JPEG':
+                    with timer.stage('decode_preview'):
+                        self.left_canvas.update_idletasks()
+                        width, height = self.left_canvas.winfo_width(), self.left_canvas.winfo_height()
+                        factor = int(1 / fit_scale(size, (width, height))) if width > 1 and height > 1 else 1
+                        quick = decode_reduced(file_path, draft_factor(factor))
             except Exception as e:
                 messagebox.showerror("错误", f"无法加载图片: {str(e)}")
+                return
+            
+            self.image_path = file_path
+            self.original_image = None
+            self.processed_image = None
+            self.processed_params = None
+            self.processed_full = False
+            if quick is not None:
+                with timer.stage('display'):
+                    self.display_image(quick, self.left_canvas)
+            else:
+                self.views[self.left_canvas].clear()
+            self.views[self.right_canvas].clear()
+            
+            def work(cancel, progress):
+                with timer.stage('decode'):
+                    array = decode_image(file_path)
+                with timer.stage('profile'):
+                    profile = self.profiles.lookup(array)
+                return Image.fromarray(array), profile
+            
+            def done(result):
+                image, profile = result
+                self.original_image = image
+                with timer.stage('display'):
+                    self.display_image(image, self.left_canvas)
+                if profile is not None:
+                    # 以前确认过同样布局的图纸，直接套用，不再检测
+                    self.cell_x1.set(profile.region[0])
+                    self.cell_y1.set(profile.region[1])
+                    self.cell_x2.set(profile.region[2])
+                    self.cell_y2.set(profile.region[3])
+                    self.grid_cols.set(profile.grid[0])
+                    self.grid_rows.set(profile.grid[1])
+                    self.display_image_with_selection()
+                    timer.context.update(image_context(np.asarray(image)), profile=True)
+                    log_timing(timer)
+                    self.status_var.set(f"已加载: {os.path.basename(file_path)} - 已套用保存的布局 {profile.grid[0]}列 × {profile.grid[1]}行，可直接处理  ({timer.summary()})")
+                else:
+                    self.auto_detect_region(timer)
+            
+            self.run_task('load', work, done, f"正在加载: {os.path.basename(file_path)}...")
     
-    def auto_detect_region(self):
-        """自动检测格子区域"""
-        if self.original_image is None:
-            return
-        
-        width, height = self.original_image.size
-        
-        # 基于典型布局估计
-        self.cell_x1.set(int(width * 0.025))
-        self.cell_y1.set(int(height * 0.035))
-        self.cell_x2.set(int(width * 0.975))
-        self.cell_y2.set(int(height * 0.83))
+    def auto_detect_region(self, timer):
+        """在工作线程中自动检测格子区域，完成后设置区域并在状态栏显示置信度"""
+        image = self.original_image
+        file_name = os.path.basename(self.image_path)
+        
+        def work(cancel, progress):
+            with timer.stage('detect_region'):
+                return detect_region(np.asarray(image))
+        
+        def done(guess):
+            self.cell_x1.set(guess.x1)
+            self.cell_y1.set(guess.y1)
+            self.cell_x2.set(guess.x2)
+            self.cell_y2.set(guess.y2)
+            self.display_image_with_selection()
+            timer.context.update(image_context(np.asarray(image)), profile=False)
+            log_timing(timer)
+            
+            if guess.confidence < LOW_CONFIDENCE:
+                self.status_var.set(f"已加载: {file_name} - 未能可靠识别格子区域，请手动设置并检测格子数  ({timer.summary()})")
+            else:
+                self.status_var.set(f"已加载: {file_name} - 已自动识别格子区域 (置信度 {guess.confidence:.0%})，请确认并检测格子数  ({timer.summary()})")
         
-        self.display_image_with_selection()
+        self.run_task('region', work, done, f"正在识别格子区域: {file_name}...")
     
     def auto_detect_grid_size(self):
         """自动检测格子数量"""
@@ -253,249 +555,121 @@ class PindouMirrorApp:
             messagebox.showwarning("警告", "请先设置正确的格子区域！")
             return
         
-        try:
-            self.status_var.set("正在检测格子数量...")
-            self.root.update()
-            
-            # 提取格子区域
-            img_array = np.array(self.original_image)
-            region = img_array[y1:y2, x1:x2]
-            
-            gray = cv2.cvtColor(region, cv2.COLOR_RGB2GRAY)
-            
-            # 边缘检测
-            edges = cv2.Canny(gray, 30, 100)
-            
-            # 检测直线
-            lines = cv2.HoughLinesP(edges, 1, np.pi/180, threshold=30, minLineLength=20, maxLineGap=5)
-            
-            if lines is None:
+        method = next(k for k, v in GRID_METHOD_LABELS.items() if v == self.grid_method.get())
+        image = self.original_image
+        
+        def work(cancel, progress):
+            timer = StageTimer(method=method)
+            with timer.stage('detect_grid'):
+                guess = detect_grid_size(np.asarray(image), (x1, y1, x2, y2), method)
+            return guess, timer
+        
+        def done(result):
+            guess, timer = result
+            if guess is None:
                 self.status_var.set("无法自动检测，请手动设置格子数")
                 return
             
-            h_lines = []  # 水平线的y坐标
-            v_lines = []  # 垂直线的x坐标
-            
-            for line in lines:
-                x1_l, y1_l, x2_l, y2_l = line[0]
-                
-                # 判断是水平线还是垂直线
-                if abs(y2_l - y1_l) < 3:  # 水平线
-                    h_lines.append((y1_l + y2_l) // 2)
-                elif abs(x2_l - x1_l) < 3:  # 垂直线
-                    v_lines.append((x1_l + x2_l) // 2)
-            
-            # 聚类去重（合并相近的线）
-            def cluster_lines(lines, threshold=5):
-                if not lines:
-                    return []
-                lines = sorted(lines)
-                clusters = [[lines[0]]]
-                for line in lines[1:]:
-                    if line - clusters[-1][-1] < threshold:
-                        clusters[-1].append(line)
-                    else:
-                        clusters.append([line])
-                return [sum(c) // len(c) for c in clusters]
-            
-            h_unique = cluster_lines(h_lines, threshold=8)
-            v_unique = cluster_lines(v_lines, threshold=8)
-            
-            # 估计格子数
-            region_height = y2 - y1
-            region_width = x2 - x1
-            
-            # 方法1：根据检测到的线条数量
-            detected_rows = max(1, len(h_unique) - 1)
-            detected_cols = max(1, len(v_unique) - 1)
-            
-            # 方法2：根据线条间距估计
-            if len(h_unique) >= 3:
-                h_gaps = [h_unique[i+1] - h_unique[i] for i in range(len(h_unique)-1)]
-                avg_h_gap = sum(h_gaps) / len(h_gaps)
-                estimated_rows = round(region_height / avg_h_gap) if avg_h_gap > 5 else detected_rows
-            else:
-                estimated_rows = detected_rows
-            
-            if len(v_unique) >= 3:
-                v_gaps = [v_unique[i+1] - v_unique[i] for i in range(len(v_unique)-1)]
-                avg_v_gap = sum(v_gaps) / len(v_gaps)
-                estimated_cols = round(region_width / avg_v_gap) if avg_v_gap > 5 else detected_cols
-            else:
-                estimated_cols = detected_cols
-            
-            # 选择更合理的值
-            final_cols = estimated_cols if 5 < estimated_cols < 200 else detected_cols
-            final_rows = estimated_rows if 5 < estimated_rows < 200 else detected_rows
-            
-            # 确保在合理范围内
-            final_cols = max(5, min(200, final_cols))
-            final_rows = max(5, min(200, final_rows))
-            
-            self.grid_cols.set(final_cols)
-            self.grid_rows.set(final_rows)
+            self.grid_cols.set(guess.cols)
+            self.grid_rows.set(guess.rows)
             
-            self.status_var.set(f"✓ 检测到格子数: {final_cols}列 × {final_rows}行 (检测到 {len(v_unique)} 条垂直线, {len(h_unique)} 条水平线)")
-            
-        except Exception as e:
-            import traceback
-            traceback.print_exc()
-            self.status_var.set(f"检测失败: {str(e)}")
+            timer.context.update(image_context(np.asarray(image), (guess.cols, guess.rows)))
+            log_timing(timer)
+            self.status_var.set(f"✓ 检测到格子数: {guess.cols}列 × {guess.rows}行 (检测到 {guess.v_lines} 条垂直线, {guess.h_lines} 条水平线)  ({timer.summary()})")
+        
+        self.run_task('detect', work, done, "正在检测格子数量...")
     
-    def remove_watermark_from_cell(self, cell_array):
-        """从格子中去除水印"""
-        h, w = cell_array.shape[:2]
-        result = cell_array.copy()
-        
-        pixels = cell_array.reshape(-1, 3)
-        
-        # 找背景色
-        bg_candidates = []
-        for pixel in pixels:
-            r, g, b = int(pixel[0]), int(pixel[1]), int(pixel[2])
-            brightness = (r + g + b) / 3
-            
-            if brightness < 60:
-                continue
-            
-            diff = max(abs(r - g), abs(g - b), abs(r - b))
-            if diff < 15 and 100 < brightness < 200:
-                continue
-            
-            bg_candidates.append((r, g, b))
-        
-        if not bg_candidates:
-            return result
-        
-        color_counts = Counter([(c[0]//8*8, c[1]//8*8, c[2]//8*8) for c in bg_candidates])
-        if not color_counts:
-            return result
-        
-        dominant_quantized = color_counts.most_common(1)[0][0]
-        
-        bg_color = None
-        best_dist = float('inf')
-        for c in bg_candidates:
-            dist = sum((a - b) ** 2 for a, b in zip(c, dominant_quantized))
-            if dist < best_dist:
-                best_dist = dist
-                bg_color = c
-        
-        if bg_color is None:
-            bg_color = (255, 255, 255)
-        
-        # 替换水印像素
-        for y in range(h):
-            for x in range(w):
-                r, g, b = int(result[y, x, 0]), int(result[y, x, 1]), int(result[y, x, 2])
-                brightness = (r + g + b) / 3
-                diff = max(abs(r - g), abs(g - b), abs(r - b))
-                
-                if diff < 20 and 90 < brightness < 210:
-                    result[y, x] = bg_color
-        
-        return result
+    def current_params(self, quiet=False):
+        """当前的 (格子区域, 格子数, 处理选项)，参数无效时返回 None"""
+        try:
+            x1 = self.cell_x1.get()
+            y1 = self.cell_y1.get()
+            x2 = self.cell_x2.get()
+            y2 = self.cell_y2.get()
+            cols = self.grid_cols.get()
+            rows = self.grid_rows.get()
+        except tk.TclError:  # 输入框正在编辑，内容不是数字
+            return None
+        
+        if x1 >= x2 or y1 >= y2:
+            if not quiet:
+                messagebox.showwarning("警告", "请正确设置格子区域！")
+            return None
+        if cols < 1 or rows < 1:
+            return None
+        
+        transform = next(k for k, v in TRANSFORMS.items() if v == self.transform.get())
+        if transform == 'transpose' and cols != rows:
+            if not quiet:
+                messagebox.showwarning("警告", "转置只适用于行数和列数相同的格子！")
+            return None
+        options = ProcessOptions(remove_watermark=self.remove_watermark.get(),
+                                 mode='matrix' if self.matrix_mode.get() else 'pixels',
+                                 transform=transform, threads=0)
+        return (x1, y1, x2, y2), (cols, rows), options
     
-    def process_image(self):
-        """处理图片：镜像格子区域"""
+    def process_image(self, quiet=False):
+        """处理图片：镜像格子区域 (快速预览时只处理缩小的图)"""
         if self.original_image is None:
-            messagebox.showwarning("警告", "请先上传图片！")
+            if not quiet:
+                messagebox.showwarning("警告", "请先上传图片！")
             return
         
-        x1 = self.cell_x1.get()
-        y1 = self.cell_y1.get()
-        x2 = self.cell_x2.get()
-        y2 = self.cell_y2.get()
-        
-        if x1 >= x2 or y1 >= y2:
-            messagebox.showwarning("警告", "请正确设置格子区域！")
+        params = self.current_params(quiet)
+        if params is None:
             return
+        region, (cols, rows), options = params
+        image = self.original_image
+        stages = progress_stages(options)
+        preview = self.live_preview.get()
+        
+        def work(cancel, progress):
+            run = self.reprocessor.preview if preview else self.reprocessor.process
+            job = run(image, region, (cols, rows), options, progress=progress, cancel=cancel)
+            return job, job.image
+        
+        def done(result):
+            job, self.processed_image = result
+            self.processed_params = params
+            self.processed_full = job.downscale == 1
+            with job.timer.stage('display'):
+                self.display_image(self.processed_image, self.right_canvas)
+            if self.processed_full:
+                self.status_var.set(f"✓ 处理完成！{cols}列 × {rows}行  ({job.timer.summary()})")
+            else:
+                self.status_var.set(f"✓ 预览 (1/{job.downscale} 分辨率)，保存时处理原图  {cols}列 × {rows}行  ({job.timer.summary()})")
         
-        try:
-            self.status_var.set("正在处理...")
-            self.root.update()
-            
-            cols = self.grid_cols.get()
-            rows = self.grid_rows.get()
-            
-            img_array = np.array(self.original_image)
-            new_img_array = img_array.copy()
-            
-            grid_width = x2 - x1
-            grid_height = y2 - y1
-            cell_width = grid_width / cols
-            cell_height = grid_height / rows
-            
-            for row in range(rows):
-                for col in range(cols):
-                    src_left = int(x1 + col * cell_width)
-                    src_right = int(x1 + (col + 1) * cell_width)
-                    src_top = int(y1 + row * cell_height)
-                    src_bottom = int(y1 + (row + 1) * cell_height)
-                    
-                    dst_col = cols - 1 - col
-                    dst_left = int(x1 + dst_col * cell_width)
-                    dst_right = int(x1 + (dst_col + 1) * cell_width)
-                    dst_top = src_top
-                    dst_bottom = src_bottom
-                    
-                    cell = img_array[src_top:src_bottom, src_left:src_right].copy()
-                    
-                    if cell.size == 0:
-                        continue
-                    
-                    if self.remove_watermark.get():
-                        cell = self.remove_watermark_from_cell(cell)
-                    
-                    target_h = dst_bottom - dst_top
-                    target_w = dst_right - dst_left
-                    
-                    if cell.shape[0] != target_h or cell.shape[1] != target_w:
-                        cell = cv2.resize(cell, (target_w, target_h), interpolation=cv2.INTER_NEAREST)
-                    
-                    new_img_array[dst_top:dst_bottom, dst_left:dst_right] = cell
-            
-            self.processed_image = Image.fromarray(new_img_array)
-            self.display_image(self.processed_image, self.right_canvas)
-            self.status_var.set(f"✓ 处理完成！{cols}列 × {rows}行")
-            
-        except Exception as e:
-            import traceback
-            traceback.print_exc()
-            messagebox.showerror("错误", f"处理失败: {str(e)}")
+        self.run_task('process', work, done, "正在生成预览..." if preview else "正在处理...", stages)
+    
+    def schedule_preview(self):
+        """参数变化后自动刷新预览 (已经处理过一次且开启了快速预览时)"""
+        if not self.live_preview.get() or self.processed_image is None:
+            return
+        if self.preview_job is not None:
+            self.root.after_cancel(self.preview_job)
+        self.preview_job = self.root.after(PREVIEW_DELAY, self.refresh_preview)
+    
+    def refresh_preview(self):
+        self.preview_job = None
+        if self.task_kind not in (None, 'process'):
+            return
+        if self.current_params(quiet=True) != self.processed_params:
+            self.process_image(quiet=True)
     
     def display_image(self, image, canvas):
         if image is None:
             return
         
-        canvas.update()
-        canvas_width = canvas.winfo_width()
-        canvas_height = canvas.winfo_height()
-        
-        if canvas_width <= 1 or canvas_height <= 1:
-            canvas_width = 650
-            canvas_height = 750
-        
-        img_width, img_height = image.size
-        scale = min(canvas_width / img_width, canvas_height / img_height, 1.0)
-        self.display_scale = scale
-        
-        new_width = int(img_width * scale)
-        new_height = int(img_height * scale)
-        
-        resized = image.resize((new_width, new_height), Image.Resampling.LANCZOS)
-        photo = ImageTk.PhotoImage(resized)
-        
-        canvas.delete("all")
-        canvas.create_image(canvas_width // 2, canvas_height // 2, anchor=tk.CENTER, image=photo)
-        canvas.image = photo
+        canvas.update_idletasks()
+        view = self.views[canvas]
+        view.show(image)
+        self.display_scale = view.scale
     
     def display_image_with_selection(self):
         if self.original_image is None:
             return
         
-        img_copy = self.original_image.copy()
-        draw = ImageDraw.Draw(img_copy)
+        self.display_image(self.original_image, self.left_canvas)
         
         x1 = self.cell_x1.get()
         y1 = self.cell_y1.get()
@@ -503,10 +677,9 @@ class PindouMirrorApp:
         y2 = self.cell_y2.get()
         
         if x1 > 0 and y1 > 0 and x2 > x1 and y2 > y1:
-            for i in range(3):
-                draw.rectangle([x1-i, y1-i, x2+i, y2+i], outline='red')
-        
-        self.display_image(img_copy, self.left_canvas)
+            self.views[self.left_canvas].set_selection((x1, y1, x2, y2))
+        else:
+            self.views[self.left_canvas].set_selection(None)
     
     def save_image(self):
         if self.processed_image is None:
@@ -515,8 +688,7 @@ class PindouMirrorApp:
         
         if self.image_path:
             dir_name = os.path.dirname(self.image_path)
-            base_name = os.path.splitext(os.path.basename(self.image_path))[0]
-            default_name = f"{base_name}_镜像.png"
+            default_name = output_name(self.image_path)
         else:
             dir_name = ""
             default_name = "镜像图片.png"
@@ -526,26 +698,75 @@ class PindouMirrorApp:
             initialdir=dir_name,
             initialfile=default_name,
             defaultextension=".png",
-            filetypes=[('PNG图片', '*.png'), ('JPEG图片', '*.jpg'), ('所有文件', '*.*')]
+            filetypes=[('PNG图片', '*.png'), ('WebP图片 (无损)', '*.webp'), ('JPEG图片', '*.jpg'), ('所有文件', '*.*')]
         )
         
-        if file_path:
+        if not file_path:
+            return
+        
+        # PNG 颜色不超过 256 种时存成调色板图，否则存成普通 PNG，都是无损的
+        fmt = format_for_path(file_path, 'png-palette')
+        full = self.processed_full
+        image = self.processed_image if full else self.original_image
+        original = self.original_image
+        region, grid, options = self.processed_params
+        stages = progress_stages(options)
+        
+        def work(cancel, progress):
+            if full:
+                result = image
+            else:
+                # 当前显示的是预览，按预览时的参数处理原图后再保存
+                job = self.reprocessor.process(image, region, grid, options, progress=progress, cancel=cancel)
+                result = job.image
+            # 编码也在后台线程里做，界面不卡
+            timer = StageTimer(format=fmt)
+            with timer.stage('encode'):
+                save_image(result, file_path, fmt)
+            # 保存即确认了区域和格子数，记入布局档案，同样布局的图纸下次直接套用
             try:
-                self.processed_image.save(file_path, quality=95)
-                self.status_var.set(f"✓ 已保存: {file_path}")
-                messagebox.showinfo("成功", f"图片已保存到:\n{file_path}")
-            except Exception as e:
-                messagebox.showerror("错误", f"保存失败: {str(e)}")
+                self.profiles.remember(np.asarray(original), region, grid)
+            except OSError:
+                pass  # 档案写不了不影响保存
+            return result, timer
+        
+        def done(result):
+            image, timer = result
+            if not full:
+                self.processed_image = image
+                self.processed_full = True
+                self.display_image(self.processed_image, self.right_canvas)
+            self.status_var.set(f"✓ 已保存: {file_path}  ({timer.summary()})")
+            messagebox.showinfo("成功", f"图片已保存到:\n{file_path}")
+        
+        self.run_task('save', work, done, "正在保存..." if full else "正在处理原图...", () if full else stages)
     
     def on_resize(self, event):
+        # 拖动窗口边缘时会连续触发，只在停下来之后重绘一次
         if event.widget == self.root:
-            if self.original_image:
-                self.root.after(100, self.display_image_with_selection)
-            if self.processed_image:
-                self.root.after(100, lambda: self.display_image(self.processed_image, self.right_canvas))
+            if self.resize_job is not None:
+                self.root.after_cancel(self.resize_job)
+            self.resize_job = self.root.after(RESIZE_DELAY, self.redraw_views)
+    
+    def redraw_views(self):
+        self.resize_job = None
+        if self.original_image:
+            self.display_image_with_selection()
+        if self.processed_image:
+            self.display_image(self.processed_image, self.right_canvas)
 
 
 def main():
+    # 打包成单文件 exe 后，批处理和 HTTP 服务的进程池启动子进程时会重新运行这个 exe，
+    # freeze_support 让子进程直接进入工作循环，而不是再走一遍下面的参数分派
+    multiprocessing.freeze_support()
+    # 带参数运行时走命令行批处理，例如: python pindou_mirror.py 图纸/*.png --grid 52x47
+    # serve 启动本地 HTTP 服务，例如: python pindou_mirror.py serve --port 8765
+    if len(sys.argv) > 1 and sys.argv[1] == 'serve':
+        sys.exit(serve_main(sys.argv[2:]))
+    if len(sys.argv) > 1:
+        sys.exit(batch_main(sys.argv[1:]))
+    
     root = tk.Tk()
     app = PindouMirrorApp(root)
     root.mainloop()
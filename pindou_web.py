@@ -6,11 +6,14 @@
 """
 
 import streamlit as st
-import numpy as np
-import cv2
-from PIL import Image
-from io import BytesIO
-from collections import Counter
+
+from pindou import LOW_CONFIDENCE, TRANSFORMS
+from pindou.encoding import OUTPUT_FORMATS
+from pindou.st_cache import (
+    cached_detect_region, cached_preview, download_button, full_image, load_upload, lookup_profile,
+    process_with_progress, remember_profile, show_timings,
+)
+from pindou.timing import StageTimer
 
 st.set_page_config(
     page_title="拼豆图纸镜像工具",
@@ -45,101 +48,6 @@ st.markdown("""
 st.markdown('<h1 class="main-title">🎨 拼豆图纸镜像工具</h1>', unsafe_allow_html=True)
 
 
-def remove_watermark_from_cell(cell_array):
-    """去除水印"""
-    h, w = cell_array.shape[:2]
-    result = cell_array.copy()
-    
-    pixels = cell_array.reshape(-1, 3)
-    
-    bg_candidates = []
-    for pixel in pixels:
-        r, g, b = int(pixel[0]), int(pixel[1]), int(pixel[2])
-        brightness = (r + g + b) / 3
-        
-        if brightness < 60:
-            continue
-        
-        diff = max(abs(r - g), abs(g - b), abs(r - b))
-        if diff < 15 and 100 < brightness < 200:
-            continue
-        
-        bg_candidates.append((r, g, b))
-    
-    if not bg_candidates:
-        return result
-    
-    color_counts = Counter([(c[0]//8*8, c[1]//8*8, c[2]//8*8) for c in bg_candidates])
-    if not color_counts:
-        return result
-    
-    dominant_quantized = color_counts.most_common(1)[0][0]
-    
-    bg_color = None
-    best_dist = float('inf')
-    for c in bg_candidates:
-        dist = sum((a - b) ** 2 for a, b in zip(c, dominant_quantized))
-        if dist < best_dist:
-            best_dist = dist
-            bg_color = c
-    
-    if bg_color is None:
-        bg_color = (255, 255, 255)
-    
-    for y in range(h):
-        for x in range(w):
-            r, g, b = int(result[y, x, 0]), int(result[y, x, 1]), int(result[y, x, 2])
-            brightness = (r + g + b) / 3
-            diff = max(abs(r - g), abs(g - b), abs(r - b))
-            
-            if diff < 20 and 90 < brightness < 210:
-                result[y, x] = bg_color
-    
-    return result
-
-
-def process_image(image, x1, y1, x2, y2, cols, rows, remove_watermark):
-    """处理图片"""
-    img_array = np.array(image)
-    new_img_array = img_array.copy()
-    
-    grid_width = x2 - x1
-    grid_height = y2 - y1
-    cell_width = grid_width / cols
-    cell_height = grid_height / rows
-    
-    for row in range(rows):
-        for col in range(cols):
-            src_left = int(x1 + col * cell_width)
-            src_right = int(x1 + (col + 1) * cell_width)
-            src_top = int(y1 + row * cell_height)
-            src_bottom = int(y1 + (row + 1) * cell_height)
-            
-            dst_col = cols - 1 - col
-            dst_left = int(x1 + dst_col * cell_width)
-            dst_right = int(x1 + (dst_col + 1) * cell_width)
-            dst_top = src_top
-            dst_bottom = src_bottom
-            
-            cell = img_array[src_top:src_bottom, src_left:src_right].copy()
-            
-            if cell.size == 0:
-                continue
-            
-            if remove_watermark:
-                cell = remove_watermark_from_cell(cell)
-            
-            target_h = dst_bottom - dst_top
-            target_w = dst_right - dst_left
-            
-            if cell.shape[0] != target_h or cell.shape[1] != target_w:
-                cell = cv2.resize(cell, (target_w, target_h), interpolation=cv2.INTER_NEAREST)
-            
-            new_img_array[dst_top:dst_bottom, dst_left:dst_right] = cell
-    
-    return Image.fromarray(new_img_array)
-
-
 # 侧边栏设置
 with st.sidebar:
     st.header("⚙️ 设置")
@@ -147,14 +55,27 @@ with st.sidebar:
     # 上传图片
     uploaded_file = st.file_uploader("📁 上传拼豆图纸", type=['png', 'jpg', 'jpeg', 'bmp', 'webp'])
     
+    # 以前确认过同样布局的图纸时套用保存的区域和格子数
+    profile = None
+    if uploaded_file is not None:
+        # JPEG 只缩小解码出显示用的图片 (view)，原图在处理时才解码
+        upload = load_upload(uploaded_file)
+        image_key, view, factor = upload.key, upload.view, upload.factor
+        profile = lookup_profile(upload.size, uploaded_file)
+    
     st.divider()
     
     # 格子数量
     st.subheader("📐 格子数量")
     
-    preset = st.selectbox("常用预设", ["自定义", "20×20", "29×29", "50×50", "52×47", "100×100"])
+    presets = ["自定义", "20×20", "29×29", "50×50", "52×47", "100×100"]
+    if profile is not None:
+        presets.insert(0, "保存的布局")
+    preset = st.selectbox("常用预设", presets)
     
-    if preset == "20×20":
+    if preset == "保存的布局":
+        default_cols, default_rows = profile[1]
+    elif preset == "20×20":
         default_cols, default_rows = 20, 20
     elif preset == "29×29":
         default_cols, default_rows = 29, 29
@@ -180,13 +101,16 @@ with st.sidebar:
     st.caption("设置格子区域的边界，不包括坐标轴")
     
     if uploaded_file is not None:
-        image = Image.open(uploaded_file).convert('RGB')
-        width, height = image.size
+        width, height = upload.size
         
-        default_x1 = int(width * 0.025)
-        default_y1 = int(height * 0.035)
-        default_x2 = int(width * 0.975)
-        default_y2 = int(height * 0.83)
+        if profile is not None:
+            default_x1, default_y1, default_x2, default_y2 = profile[0]
+            st.caption("已套用保存的布局")
+        else:
+            detected_region, region_confidence = cached_detect_region(image_key, view, factor, upload.size)
+            default_x1, default_y1, default_x2, default_y2 = detected_region
+        if profile is None and region_confidence < LOW_CONFIDENCE:
+            st.warning("⚠️ 没能可靠地识别格子区域，请手动调整")
     else:
         default_x1, default_y1, default_x2, default_y2 = 0, 0, 100, 100
         width, height = 100, 100
@@ -203,45 +127,68 @@ with st.sidebar:
     
     # 去水印选项
     remove_watermark = st.checkbox("🧹 去除水印", value=True)
+    matrix_mode = st.checkbox("🟦 色块重绘", value=False, help="每格取一个颜色重新绘制，不保留格子里的文字 (采样时避开水印，比逐像素去水印快，但比不去水印慢)")
+    # 转置只适用于方形格子，行列数不同时不提供
+    transform = st.selectbox("🔃 格子排列", [name for name in TRANSFORMS if name != 'transpose' or cols == rows],
+                             format_func=TRANSFORMS.get, help="格子怎样重排，格子里的文字保持正向")
 
 
 # 主内容区
 if uploaded_file is not None:
-    image = Image.open(uploaded_file).convert('RGB')
-    
+    # 显示用的图片已在侧边栏解码 (带缓存)，这里直接复用
     col1, col2 = st.columns(2)
     
     with col1:
         st.subheader("📷 原图")
-        st.image(image, use_container_width=True)
+        st.image(view, use_container_width=True)
     
     with col2:
         st.subheader("🔄 镜像后")
         
+        mode = 'matrix' if matrix_mode else 'pixels'
+        params = ((x1, y1, x2, y2), (cols, rows), remove_watermark, mode, transform)
+        
         if st.button("🚀 开始镜像处理", type="primary", use_container_width=True):
             if x1 >= x2 or y1 >= y2:
                 st.error("❌ 格子区域设置错误！请确保左边界<右边界，上边界<下边界")
             else:
-                with st.spinner("处理中..."):
-                    result = process_image(image, x1, y1, x2, y2, cols, rows, remove_watermark)
-                    st.session_state['result'] = result
+                st.session_state['pending_params'] = params
+                remember_profile(full_image(uploaded_file), (x1, y1, x2, y2), (cols, rows))
+        
+        # 处理中途页面重跑会中断处理，参数没变时下一次自动接着处理，已经完成的部分不会重算
+        if st.session_state.get('pending_params') == params and st.session_state.get('result_params') != params:
+            if st.button("⏹ 取消处理", use_container_width=True):
+                st.session_state.pop('pending_params')
+                st.info("已取消")
+            else:
+                result, timings = process_with_progress(image_key, (x1, y1, x2, y2), (cols, rows), remove_watermark,
+                                                        full_image(uploaded_file), mode=mode, transform=transform)
+                st.session_state['result'] = result
+                st.session_state['timings'] = timings
+                st.session_state['result_params'] = params
+                st.session_state.pop('pending_params')
                 st.success(f"✅ 处理完成！{cols}列 × {rows}行")
         
-        if 'result' in st.session_state:
-            st.image(st.session_state['result'], use_container_width=True)
-            
-            # 下载按钮
-            buf = BytesIO()
-            st.session_state['result'].save(buf, format='PNG')
-            buf.seek(0)
+        if st.session_state.get('result_params') == params:
+            page_timer = StageTimer()
+            with page_timer.stage('display'):
+                st.image(st.session_state['result'], use_container_width=True)
             
-            st.download_button(
-                label="💾 下载镜像图片",
-                data=buf,
-                file_name="镜像图纸.png",
-                mime="image/png",
-                use_container_width=True
-            )
+            # 下载按钮：点击时才编码，同一结果和格式只编码一次
+            fmt = st.selectbox("下载格式", list(OUTPUT_FORMATS), index=list(OUTPUT_FORMATS).index('png-palette'),
+                               format_func=lambda name: OUTPUT_FORMATS[name].label)
+            download_button("💾 下载镜像图片", image_key, params, st.session_state['result'], fmt, "镜像图纸",
+                            use_container_width=True)
+            show_timings(st.session_state['timings'], page_timer)
+        elif x1 < x2 and y1 < y2:
+            # 快速预览：参数一变就在缩小的图上重新处理，原图只在点击处理后才处理
+            preview, preview_timings, downscale = cached_preview(image_key, (x1, y1, x2, y2), (cols, rows),
+                                                                 remove_watermark, view, factor, mode=mode,
+                                                                 transform=transform)
+            st.image(preview, caption=f"快速预览 (1/{downscale} 分辨率)" if downscale > 1 else "快速预览",
+                     use_container_width=True)
+            st.caption("确认无误后点击「开始镜像处理」处理原图并下载")
+            show_timings(preview_timings)
 else:
     st.info("👆 请在左侧上传拼豆图纸图片")
     
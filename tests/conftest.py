@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+"""测试共用的合成图纸 (见 pindou.bench.make_sheet)"""
+
+import pytest
+
+from pindou.bench import make_sheet
+
+
+@pytest.fixture(scope='session')
+def sheet():
+    """20×20 格、每格 16 像素、带水印的图纸，返回 (RGB 数组, 真实格子区域, 格子数)"""
+    img, region = make_sheet(20, 20, 16, seed=1)
+    img.setflags(write=False)
+    return img, region, (20, 20)
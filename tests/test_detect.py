@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+"""格子数检测：两种方法在 bench 的图纸上都给出界面能接受的格子数，投影周期数得准"""
+
+import pytest
+
+from pindou import GRID_METHODS, MAX_GRID, detect_grid_size
+from pindou.bench import DEFAULT_CASES, make_sheet
+
+
+@pytest.mark.parametrize('method', GRID_METHODS)
+@pytest.mark.parametrize('cols,rows,cell', DEFAULT_CASES)
+def test_bench_sheets(cols, rows, cell, method):
+    img, region = make_sheet(cols, rows, cell, seed=1)
+    guess = detect_grid_size(img, region, method)
+    assert guess is not None
+    assert 1 <= guess.cols <= MAX_GRID and 1 <= guess.rows <= MAX_GRID
+    if method == 'periodic':
+        assert (guess.cols, guess.rows) == (cols, rows)
+
+
+@pytest.mark.parametrize('method', GRID_METHODS)
+def test_grid_count_clamped(method):
+    """格子比 MAX_GRID 多时给出上限，界面上的输入框不会因默认值越界报错"""
+    img, region = make_sheet(MAX_GRID + 20, 20, 6, seed=1)
+    guess = detect_grid_size(img, region, method)
+    assert guess is not None
+    assert 1 <= guess.cols <= MAX_GRID and 1 <= guess.rows <= MAX_GRID
+    if method == 'periodic':
+        assert (guess.cols, guess.rows) == (MAX_GRID, 20)
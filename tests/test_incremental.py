@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""Reprocessor：复用中间结果时的结果和 process() 相同"""
+
+import numpy as np
+from PIL import Image
+
+from pindou import ProcessOptions, Reprocessor, process
+
+
+def test_same_params_return_cached(sheet):
+    img, region, grid = sheet
+    reprocessor = Reprocessor()
+    image = Image.fromarray(img)
+    first = reprocessor.process(image, region, grid)
+    again = reprocessor.process(image, region, grid, ProcessOptions(threads=4))
+    assert again.timer.context['cached']
+    assert again.output is first.output
+    assert np.array_equal(first.output, process(img, region, grid).output)
+
+
+def test_rows_reused_across_options(sheet):
+    """只换变换、去水印开关或输出格式时，去过水印的格子行全部复用"""
+    img, region, grid = sheet
+    reprocessor = Reprocessor()
+    image = Image.fromarray(img)
+    first = reprocessor.process(image, region, grid)
+    assert first.timer.context['rows_computed'] == grid[1]
+    for options in (ProcessOptions(transform='flip-v'), ProcessOptions(remove_watermark=False),
+                    ProcessOptions(), ProcessOptions(output_format='png-palette')):
+        job = reprocessor.process(image, region, grid, options)
+        assert np.array_equal(job.output, process(img, region, grid, options).output)
+        if options.remove_watermark:
+            assert job.timer.context['rows_computed'] == 0
+            assert job.timer.context['rows_reused'] == grid[1]
+
+
+def test_partial_reuse_after_row_change(sheet):
+    """下边界少一行：列边界和上面各行的上下边界都没变，这些行复用"""
+    img, region, grid = sheet
+    x1, y1, x2, y2 = region
+    reprocessor = Reprocessor()
+    image = Image.fromarray(img)
+    options = ProcessOptions(snap_edges=False)
+    reprocessor.process(image, region, grid, options)
+    smaller = (x1, y1, x2, y2 - (y2 - y1) // grid[1])
+    job = reprocessor.process(image, smaller, (grid[0], grid[1] - 1), options)
+    assert job.timer.context['rows_computed'] == 0
+    assert np.array_equal(job.output, process(img, smaller, (grid[0], grid[1] - 1), options).output)
+
+
+def test_new_image_resets(sheet):
+    img, region, grid = sheet
+    reprocessor = Reprocessor()
+    reprocessor.process(Image.fromarray(img), region, grid)
+    other = np.ascontiguousarray(img[:, ::-1])
+    job = reprocessor.process(Image.fromarray(other), region, grid)
+    assert job.timer.context['rows_computed'] == grid[1]
+    assert np.array_equal(job.output, process(other, region, grid).output)
+
+
+def test_preview_downscales(sheet):
+    img, region, grid = sheet
+    reprocessor = Reprocessor()
+    image = Image.fromarray(img)
+    job = reprocessor.preview(image, region, grid, max_side=200)
+    assert job.downscale > 1
+    assert job.image.size == image.reduce(job.downscale).size
+    # 代理图和它的中间结果也复用
+    assert reprocessor.preview(image, region, grid, max_side=200).timer.context['cached']
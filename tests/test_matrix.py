@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""色块模式：采样、重绘和分条处理"""
+
+import os
+
+import numpy as np
+from PIL import Image
+
+from pindou import ProcessOptions, build_mirror_map, process, process_tiled, render_cells, sample_cells
+from pindou.bench import make_sheet
+
+
+def test_sample_cells_colors():
+    """没有水印时每格采到的就是填充色 (空格子为白色)"""
+    img, region = make_sheet(12, 10, 20, seed=2, watermark=False)
+    mirror_map = build_mirror_map(*region, 12, 10)
+    matrix = sample_cells(img, mirror_map.x_edges, mirror_map.y_edges)
+    x1, y1 = region[:2]
+    # 格子中间可能压着文字，比较每格左上角内侧的一点
+    corners = img[y1 + 20 * np.arange(10) + 4][:, x1 + 20 * np.arange(12) + 4]
+    assert matrix.shape == (10, 12, 3)
+    assert np.array_equal(matrix, corners)
+
+
+def test_matrix_mode_mirrors_colors(sheet):
+    """色块模式下输出的格子颜色是采样矩阵左右翻转后的结果"""
+    img, region, grid = sheet
+    job = process(img, region, grid, ProcessOptions(mode='matrix'))
+    mirror_map = build_mirror_map(*region, *grid)
+    x_edges, y_edges = mirror_map.x_edges, mirror_map.y_edges
+    matrix = sample_cells(img, x_edges, y_edges)
+    centers = job.output[(y_edges[:-1] + y_edges[1:]) // 2][:, (x_edges[:-1] + x_edges[1:]) // 2]
+    assert np.array_equal(centers, matrix[:, ::-1])
+
+
+def test_render_cells_stays_inside_region():
+    out = np.zeros((30, 30, 3), np.uint8)
+    matrix = np.full((2, 2, 3), 200, np.uint8)
+    render_cells(matrix, np.array([5, 10, 20]), np.array([5, 15, 25]), out, np.array([1, 2, 3], np.uint8))
+    assert not out[:, 20:].any() and not out[25:].any()
+    assert (out[5:25, 19] == (1, 2, 3)).all() and (out[24, 5:20] == (1, 2, 3)).all()
+
+
+def test_matrix_bands_match_tiled(sheet, tmp_path):
+    """分条重绘和整张一次处理结果相同 (网格线只在最后一条画到区域最后一行)"""
+    img, region, grid = sheet
+    options = ProcessOptions(mode='matrix')
+    expected = process(img, region, grid, options).output
+    banded = process(img, region, grid, ProcessOptions(mode='matrix', threads=3), progress=lambda *args: None)
+    assert np.array_equal(banded.output, expected)
+    path = os.path.join(tmp_path, 'out.png')
+    process_tiled(img, path, region, grid, options, band_bytes=50_000)
+    with Image.open(path) as result:
+        assert np.array_equal(np.asarray(result.convert('RGB')), expected)
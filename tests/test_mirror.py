@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""格子变换：每种变换和逐格搬运的实现 (pindou.bench) 一致，组合变换按顺序生效"""
+
+import numpy as np
+import pytest
+
+from pindou import TRANSFORMS, ProcessOptions, process
+from pindou.bench import REFERENCE_TRANSFORMS, make_sheet, reference_process, reference_transform
+from pindou.mirror import parse_transform
+
+
+@pytest.fixture(scope='module')
+def cleaned(sheet):
+    """去过水印、还没搬动格子的区域和格子边界"""
+    img, region, grid = sheet
+    job = process(img, region, grid)
+    x1, y1, x2, y2 = job.mirror_map.bounds
+    return job.cleaned, job.mirror_map.x_edges, job.mirror_map.y_edges, (x1, y1, x2, y2)
+
+
+@pytest.mark.parametrize('transform', list(TRANSFORMS))
+def test_transform_matches_reference(sheet, cleaned, transform):
+    img, region, grid = sheet
+    job = process(img, region, grid, ProcessOptions(transform=transform))
+    if transform == 'flip-h':
+        assert np.array_equal(job.output, reference_process(img, region, grid))
+        return
+    area, x_edges, y_edges, (x1, y1, x2, y2) = cleaned
+    assert np.array_equal(job.output[y1:y2, x1:x2], reference_transform(area, x_edges, y_edges, transform))
+    # 格子区域之外不变
+    outside = np.ones(img.shape[:2], bool)
+    outside[y1:y2, x1:x2] = False
+    assert np.array_equal(job.output[outside], img[outside])
+
+
+@pytest.mark.parametrize('transform', ['flip-v', 'rotate-180'])
+def test_transform_uneven_cells(transform):
+    """行列数不同、格子边界不全在整数像素上"""
+    img, region = make_sheet(11, 7, 13, seed=4)
+    job = process(img, region, (11, 7), ProcessOptions(remove_watermark=False, transform=transform))
+    x1, y1, x2, y2 = job.mirror_map.bounds
+    expected = reference_transform(img[y1:y2, x1:x2], job.mirror_map.x_edges, job.mirror_map.y_edges, transform)
+    assert np.array_equal(job.output[y1:y2, x1:x2], expected)
+
+
+def test_flip_h_uneven_cells():
+    img, region = make_sheet(11, 7, 13, seed=4)
+    job = process(img, region, (11, 7), ProcessOptions(remove_watermark=False))
+    assert np.array_equal(job.output, reference_process(img, region, (11, 7), False))
+
+
+@pytest.mark.parametrize('combined, expected', [
+    ('flip-h,flip-v', parse_transform('rotate-180')),
+    ('flip-v+flip-h', parse_transform('rotate-180')),
+    ('rotate-180,rotate-180', (False, False, False)),
+    ('transpose,transpose', (False, False, False)),
+])
+def test_combined_transforms(combined, expected):
+    assert parse_transform(combined) == expected
+
+
+@pytest.mark.parametrize('transform', ['transpose,flip-h', 'flip-h,transpose', 'transpose,rotate-180'])
+def test_combined_with_transpose(sheet, cleaned, transform):
+    """含转置的组合按书写顺序逐个生效"""
+    img, region, grid = sheet
+    job = process(img, region, grid, ProcessOptions(transform=transform))
+    area, x_edges, y_edges, (x1, y1, x2, y2) = cleaned
+    ops = dict(REFERENCE_TRANSFORMS, **{'flip-h': lambda cells: cells[:, ::-1]})
+    cells = np.arange(grid[0] * grid[1]).reshape(grid[1], grid[0])
+    for name in transform.split(','):
+        cells = ops[name](cells)
+    # 20×20、每格 16 像素，格子大小都一样，直接按格子编号拼出期望结果
+    size = x_edges[1] - x_edges[0]
+    blocks = area.reshape(grid[1], size, grid[0], size, 3)
+    expected = blocks[cells // grid[0], :, cells % grid[0]].transpose(0, 2, 1, 3, 4).reshape(area.shape)
+    assert np.array_equal(job.output[y1:y2, x1:x2], expected)
+
+
+def test_unknown_transform(sheet):
+    img, region, grid = sheet
+    with pytest.raises(ValueError):
+        process(img, region, grid, ProcessOptions(transform='flip-x'))
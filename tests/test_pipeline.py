@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""处理流水线：写入已有数组 (in_place、out=) 的结果和默认处理相同"""
+
+from io import BytesIO
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from pindou import ProcessOptions, process
+
+
+@pytest.fixture(scope='module')
+def expected(sheet):
+    img, region, grid = sheet
+    return process(img, region, grid).output
+
+
+def test_in_place_writes_source_array(sheet, expected):
+    img, region, grid = sheet
+    array = img.copy()
+    job = process(array, region, grid, ProcessOptions(in_place=True))
+    assert job.output is array
+    assert np.array_equal(array, expected)
+
+
+def test_out_buffer_is_reused(sheet, expected):
+    img, region, grid = sheet
+    out = np.zeros_like(img)
+    job = process(img, region, grid, out=out)
+    assert job.output is out
+    assert np.array_equal(out, expected)
+    # 同一个缓冲区处理另一张图，格子区域之外也要整个覆盖
+    process(img, region, grid, out=out)
+    assert np.array_equal(out, expected)
+
+
+def test_out_buffer_wrong_shape(sheet):
+    img, region, grid = sheet
+    with pytest.raises(ValueError):
+        process(img, region, grid, out=np.zeros((10, 10, 3), np.uint8))
+
+
+@pytest.mark.parametrize('source', ['tga', 'pil', 'read-only'])
+def test_in_place_read_only_decode(sheet, expected, source):
+    """PIL 解码出的数组只读 (OpenCV 不支持的格式、PIL 图片输入)，in_place 时不能直接写回"""
+    img, region, grid = sheet
+    if source == 'tga':
+        buf = BytesIO()
+        Image.fromarray(img).save(buf, 'TGA')
+        image = buf.getvalue()
+    elif source == 'pil':
+        image = Image.fromarray(img)
+    else:
+        image = img
+    job = process(image, region, grid, ProcessOptions(in_place=True, output_format='png'))
+    assert np.array_equal(job.output, expected)
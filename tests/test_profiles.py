@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""布局档案：同样布局的图纸能查到，不同布局、不同尺寸查不到；命令行按参数保存和套用"""
+
+import json
+import os
+from io import BytesIO
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from pindou import profiles
+from pindou.bench import make_sheet
+from pindou.cli import main
+from pindou.profiles import MAX_DISTANCE, MemoryProfileStore, ProfileStore, layout_fingerprint
+
+
+def _flip_bits(fingerprint, count):
+    """把指纹的低 count 位取反"""
+    return f'{int(fingerprint, 16) ^ ((1 << count) - 1):032x}'
+
+
+def test_remember_then_lookup(sheet, tmp_path):
+    img, region, grid = sheet
+    store = ProfileStore(os.path.join(tmp_path, 'profiles.json'))
+    assert store.lookup(img) is None
+    store.remember(img, region, grid)
+    profile = ProfileStore(store.path).lookup(img)
+    assert (profile.region, profile.grid, profile.distance) == (region, grid, 0)
+
+
+def test_lookup_after_jpeg(sheet):
+    """同一张图纸再压成 JPEG，压缩噪声只改变少量指纹位"""
+    img, region, grid = sheet
+    store = MemoryProfileStore()
+    store.remember(img, region, grid)
+    buf = BytesIO()
+    Image.fromarray(img).save(buf, 'JPEG', quality=75)
+    profile = store.lookup(np.asarray(Image.open(buf).convert('RGB')))
+    assert profile is not None and profile.region == region and profile.grid == grid
+
+
+def test_different_layout_rejected(sheet):
+    """尺寸和区域都一样、格子数不同 (40×40、每格 8 像素) 的图纸不套用"""
+    img, region, grid = sheet
+    other, other_region = make_sheet(40, 40, 8, seed=1)
+    assert other.shape == img.shape and other_region == region
+    store = MemoryProfileStore()
+    store.remember(img, region, grid)
+    assert store.lookup(other) is None
+
+
+def test_different_size_rejected(sheet):
+    img, region, grid = sheet
+    store = MemoryProfileStore()
+    store.remember(img, region, grid)
+    assert store.lookup(np.ascontiguousarray(img[:-1])) is None
+
+
+def test_distance_threshold(sheet):
+    img, region, grid = sheet
+    height, width = img.shape[:2]
+    fingerprint = layout_fingerprint(img, region, grid)
+    store = MemoryProfileStore()
+    store.add((width, height), region, grid, _flip_bits(fingerprint, MAX_DISTANCE))
+    assert store.lookup(img).distance == MAX_DISTANCE
+    store.add((width, height), region, grid, _flip_bits(fingerprint, MAX_DISTANCE + 1))
+    assert store.lookup(img) is None
+
+
+def test_oldest_profiles_evicted(tmp_path, monkeypatch):
+    monkeypatch.setattr(profiles, 'MAX_PROFILES', 3)
+    store = ProfileStore(os.path.join(tmp_path, 'profiles.json'))
+    for i in range(5):
+        store.add((100, 100), (0, 0, 10 + i, 10), (1, 1), '0' * 32)
+    assert [entry['region'][2] for entry in store.load()] == [12, 13, 14]
+    # 同一种布局再存一次只替换旧档案，不会挤掉别的
+    store.add((100, 100), (0, 0, 13, 10), (1, 1), '0' * 32)
+    assert [entry['region'][2] for entry in store.load()] == [12, 14, 13]
+
+
+def test_corrupt_file_recovered(sheet, tmp_path):
+    img, region, grid = sheet
+    path = os.path.join(tmp_path, 'profiles.json')
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('{"profiles": [')
+    store = ProfileStore(path)
+    assert store.load() == [] and store.lookup(img) is None
+    store.remember(img, region, grid)
+    with open(path, encoding='utf-8') as f:
+        assert len(json.load(f)['profiles']) == 1
+    assert store.lookup(img).region == region
+
+
+@pytest.fixture
+def sheet_file(sheet, tmp_path):
+    img, region, grid = sheet
+    path = os.path.join(tmp_path, 'sheet.png')
+    Image.fromarray(img).save(path)
+    return path, region, grid
+
+
+def _cli(sheet_file, *args):
+    path = sheet_file[0]
+    out_dir = os.path.join(os.path.dirname(path), 'out')
+    return main([path, '--workers', '1', '--output-dir', out_dir, *args])
+
+
+@pytest.mark.parametrize('tiled', [False, True])
+def test_cli_saves_and_applies_profile(sheet_file, tmp_path, monkeypatch, capsys, tiled):
+    """默认档案路径 (PINDOU_PROFILES)：手动指定区域和格子数时保存，之后 auto 直接套用"""
+    _, (x1, y1, x2, y2), (cols, rows) = sheet_file
+    profiles_path = os.path.join(tmp_path, 'profiles.json')
+    monkeypatch.setenv(profiles.PROFILES_ENV, profiles_path)
+    extra = ['--tiled'] if tiled else []
+    assert _cli(sheet_file, '--region', f'{x1},{y1},{x2},{y2}', '--grid', f'{cols}x{rows}', *extra) == 0
+    assert len(ProfileStore(profiles_path).load()) == 1
+    capsys.readouterr()
+    assert _cli(sheet_file, *extra) == 0
+    assert '套用布局档案' in capsys.readouterr().out
+
+
+def test_cli_no_profiles(sheet_file, tmp_path, monkeypatch, capsys):
+    _, (x1, y1, x2, y2), (cols, rows) = sheet_file
+    profiles_path = os.path.join(tmp_path, 'profiles.json')
+    monkeypatch.setenv(profiles.PROFILES_ENV, profiles_path)
+    args = ('--region', f'{x1},{y1},{x2},{y2}', '--grid', f'{cols}x{rows}', '--no-profiles')
+    assert _cli(sheet_file, *args) == 0
+    assert _cli(sheet_file, '--tiled', *args) == 0
+    assert not os.path.exists(profiles_path)
+    assert '布局' not in capsys.readouterr().out
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""分块处理：结果与 process() 逐像素一致，临时的内存映射文件用完就释放，PNG 按条解码"""
+
+import gc
+import os
+import tempfile
+from io import BytesIO
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from pindou import ProcessOptions, process, process_tiled, tiled
+from pindou.bench import make_sheet
+from pindou.decoding import decode_strips
+
+
+def _open_maps(directory):
+    """还在引用 directory 里文件的内存映射数组"""
+    gc.collect()
+    return [obj for obj in gc.get_objects()
+            if isinstance(obj, np.memmap) and str(obj.filename or '').startswith(str(directory))]
+
+
+@pytest.mark.parametrize('options', [ProcessOptions(), ProcessOptions(remove_watermark=False),
+                                     ProcessOptions(transform='transpose'), ProcessOptions(mode='matrix')])
+def test_tiled_matches_process(sheet, tmp_path, options):
+    img, region, grid = sheet
+    expected = process(img, region, grid, options).output
+    path = os.path.join(tmp_path, 'out.png')
+    process_tiled(img, path, region, grid, options, band_bytes=50_000)
+    with Image.open(path) as result:
+        assert np.array_equal(np.asarray(result.convert('RGB')), expected)
+
+
+@pytest.mark.parametrize('grid', [(20, 20), (20, 19)])
+def test_tiled_releases_temp_files(sheet, tmp_path, monkeypatch, grid):
+    """临时目录删除前释放内存映射 (Windows 上映射着的文件删不掉)，出错时也一样"""
+    img, region, _ = sheet
+    source = os.path.join(tmp_path, 'sheet.png')
+    Image.fromarray(img).save(source)
+    workdirs = []
+    real_mkdtemp = tempfile.mkdtemp
+
+    def mkdtemp(**kwargs):
+        workdirs.append(real_mkdtemp(dir=tmp_path, **kwargs))
+        return workdirs[-1]
+
+    monkeypatch.setattr(tempfile, 'mkdtemp', mkdtemp)
+    # 转置要求行列数相同，(20, 19) 时在原图已经映射之后出错
+    options = ProcessOptions(transform='transpose')
+    if grid == (20, 20):
+        job = process_tiled(source, os.path.join(tmp_path, 'out.png'), region, grid, options)
+        assert job.array is None and job.output is None
+    else:
+        with pytest.raises(ValueError):
+            process_tiled(source, os.path.join(tmp_path, 'out.png'), region, grid, options)
+    assert not _open_maps(workdirs[0])
+    assert not os.path.exists(workdirs[0])
+
+
+def test_tiled_keeps_caller_workdir(sheet, tmp_path):
+    img, region, grid = sheet
+    job = process_tiled(img, os.path.join(tmp_path, 'out.png'), region, grid, workdir=str(tmp_path))
+    assert isinstance(job.output, np.memmap)
+    assert np.array_equal(job.output, process(img, region, grid).output)
+
+
+@pytest.mark.parametrize('mode, params', [('RGB', {}), ('RGB', {'optimize': True}), ('RGBA', {}), ('L', {}),
+                                          ('LA', {}), ('P', {'transparency': 3}), ('RGB', {'interlace': 1})])
+def test_png_strips_match_pil(sheet, mode, params):
+    """PNG 按条解码 (隔行的整张解码) 和 PIL 一次解码逐像素一致，各条的第一行也能还原过滤"""
+    img = sheet[0]
+    image = Image.fromarray(img)
+    image = image.quantize(64) if mode == 'P' else image.convert(mode)
+    buf = BytesIO()
+    image.save(buf, 'PNG', **params)
+    expected = np.asarray(Image.open(BytesIO(buf.getvalue())).convert('RGB'))
+    size, strips = decode_strips(BytesIO(buf.getvalue()), 7)
+    assert size == image.size
+    assert np.array_equal(np.concatenate(list(strips)), expected)
+
+
+def test_tiled_detects_on_proxy(tmp_path, monkeypatch):
+    """超过 DETECT_SIDE 的图纸在缩小的灰度代理图上自动检测，区域和格子数与整张检测相同"""
+    monkeypatch.setattr(tiled, 'DETECT_SIDE', 500)
+    img, _ = make_sheet(52, 47, 16, seed=1)
+    source = os.path.join(tmp_path, 'sheet.png')
+    Image.fromarray(img).save(source)
+    assert tiled.detection_proxy(img)[1] > 1
+    expected = process(img)
+    job = process_tiled(source, os.path.join(tmp_path, 'out.png'))
+    assert (job.region, job.grid) == (expected.region, expected.grid)
+    with Image.open(os.path.join(tmp_path, 'out.png')) as result:
+        assert np.array_equal(np.asarray(result.convert('RGB')), expected.output)
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""向量化去水印：和原始的逐格、逐像素实现 (pindou.bench) 逐像素一致"""
+
+import numpy as np
+import pytest
+
+from pindou import ProcessOptions, build_mirror_map, process, watermark
+from pindou.bench import _reference_cell, make_sheet, reference_process
+from pindou.grid import cell_edges, row_bands
+from pindou.watermark import CellCache, remove_watermark_grid
+
+
+def _check_cells(img, x_edges, y_edges, cleaned):
+    for row in range(len(y_edges) - 1):
+        for col in range(len(x_edges) - 1):
+            top, bottom = y_edges[row] - y_edges[0], y_edges[row + 1] - y_edges[0]
+            left, right = x_edges[col] - x_edges[0], x_edges[col + 1] - x_edges[0]
+            cell = img[y_edges[row]:y_edges[row + 1], x_edges[col]:x_edges[col + 1]]
+            assert np.array_equal(cleaned[top:bottom, left:right], _reference_cell(cell)), (row, col)
+
+
+@pytest.mark.parametrize('dedup', [True, False])
+def test_grid_matches_reference_cells(dedup):
+    # 每格 13 像素，格子边界不全落在整数倍上
+    img, region = make_sheet(9, 7, 13, seed=3)
+    x1, y1, x2, y2 = region
+    x_edges, y_edges = cell_edges(x1, x2, 9), cell_edges(y1, y2, 7)
+    stats = {}
+    cleaned = remove_watermark_grid(img, x_edges, y_edges, dedup=dedup, stats=stats)
+    _check_cells(img, x_edges, y_edges, cleaned)
+    assert stats['cells'] == 63
+    assert stats['unique_cells'] <= 63 if dedup else stats['unique_cells'] == 63
+
+
+def test_sheet_matches_reference_cells(sheet):
+    img, (x1, y1, x2, y2), (cols, rows) = sheet
+    x_edges, y_edges = cell_edges(x1, x2, cols), cell_edges(y1, y2, rows)
+    _check_cells(img, x_edges, y_edges, remove_watermark_grid(img, x_edges, y_edges))
+
+
+def test_mixed_cell_sizes():
+    """边长不一的格子按尺寸分组去重，同一组的行、列不连续，分条共用 CellCache 时也一样"""
+    img, (x1, y1, _, _) = make_sheet(9, 7, 13, seed=3)
+    rng = np.random.default_rng(0)
+    x_edges = x1 + np.concatenate([[0], np.cumsum(rng.integers(11, 15, 9))])
+    y_edges = y1 + np.concatenate([[0], np.cumsum(rng.integers(11, 15, 7))])
+    cleaned = remove_watermark_grid(img, x_edges, y_edges)
+    _check_cells(img, x_edges, y_edges, cleaned)
+    cache = CellCache()
+    parts = [remove_watermark_grid(img, x_edges, y_edges[start:start + 3], cache=cache) for start in range(0, 7, 2)]
+    assert np.array_equal(np.concatenate(parts), cleaned)
+
+@pytest.mark.parametrize('remove_watermark', [True, False])
+def test_process_matches_reference(sheet, remove_watermark):
+    img, region, grid = sheet
+    job = process(img, region, grid, ProcessOptions(remove_watermark=remove_watermark))
+    assert np.array_equal(job.output, reference_process(img, region, grid, remove_watermark))
+
+
+def test_threads_match_single_thread(sheet):
+    img, region, grid = sheet
+    single = process(img, region, grid, ProcessOptions(threads=1)).output
+    assert np.array_equal(process(img, region, grid, ProcessOptions(threads=4)).output, single)
+
+
+def test_bands_share_cell_cache(sheet):
+    """分条时共用 CellCache：结果和整个区域一次处理相同，实际计算的格子数也相同"""
+    img, region, grid = sheet
+    mirror_map = build_mirror_map(*region, *grid)
+    x_edges, y_edges = mirror_map.x_edges, mirror_map.y_edges
+    whole = {}
+    expected = remove_watermark_grid(img, x_edges, y_edges, stats=whole)
+    cache = CellCache()
+    banded = {}
+    parts = [remove_watermark_grid(img, x_edges, y_edges[start:end + 1], stats=banded, cache=cache)
+             for start, end in row_bands(y_edges, 3 * 16)]
+    assert len(parts) > 1
+    assert np.array_equal(np.concatenate(parts), expected)
+    assert banded['unique_cells'] == whole['unique_cells']
+
+
+def test_hash_collisions(sheet, monkeypatch):
+    """所有格子的哈希都相同时，去重和 CellCache 仍然按内容区分 (段也要合并)"""
+    monkeypatch.setattr(watermark, '_cell_hashes', lambda flat: np.zeros(len(flat), dtype=np.uint64))
+    monkeypatch.setattr(watermark, 'CACHE_SEGMENTS', 2)
+    img, region, grid = sheet
+    mirror_map = build_mirror_map(*region, *grid)
+    x_edges, y_edges = mirror_map.x_edges, mirror_map.y_edges
+    expected = remove_watermark_grid(img, x_edges, y_edges, dedup=False)
+    cache = CellCache()
+    parts = [remove_watermark_grid(img, x_edges, y_edges[start:end + 1], cache=cache)
+             for start, end in row_bands(y_edges, 2 * 16)]
+    assert np.array_equal(np.concatenate(parts), expected)
+    assert len(cache.segments[(16, 16)]) < len(parts)